@@ -1 +1 @@
-from .core import assert_pipeline, build, generate_span_id, generate_trace_id, generate_span, create_log_sender, generate_log, request, utcnow, exec_status_to_otel
\ No newline at end of file
+from .core import assert_pipeline, build, generate_span_id, generate_trace_id, generate_span, create_span_sender, create_log_sender, generate_log, request, utcnow, exec_status_to_otel, TelemetryExporter, get_exporter, set_telemetry_spool
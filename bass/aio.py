@@ -0,0 +1,327 @@
+"""Pipeline execution in a single asyncio event loop, as an alternative to the thread-based build_inner().
+
+Takes the same pipeline format and IoContext, but runs steps by IoContext.run_async()/run_streaming_async(), and
+sibling steps of unordered nodes as tasks rather than threads. The cwd of every node is passed down explicitly,
+and never changed for the process, so concurrent steps can not affect each other's cwd.
+
+Not supported compared to build_inner(): resource usage attributes on step spans, as asyncio reaps the processes."""
+import asyncio
+import logging
+import os
+import subprocess
+import time
+from contextlib import asynccontextmanager
+from typing import Callable
+
+from .cache import StepCache, step_cache_key
+from .core import (CancelToken, ChangesetMatcher, ExecStatus, IoContext, OutputStream, ResourcePool, Scheduler, TelemetryExporter, TestIoContext,
+                   create_log_sender, create_span_sender, dummy_argparse, exec_status_to_otel, generate_span_id, is_step_graph, step_command, utcnow, worst_status)
+
+class AsyncResourcePool(ResourcePool):
+    """ResourcePool for tasks of one event loop: acquire() awaits rather than blocks"""
+
+    def __init__(self, budget: dict[str, float]):
+        super().__init__(budget)
+        self._changed = asyncio.Condition()
+
+    async def acquire(self, request: dict[str, float]) -> dict[str, float]:
+        request = self._clamp(request)
+        async with self._changed:
+            self._waiting.append(request)
+            await self._changed.wait_for(lambda: self._fits(request))
+            self._waiting = [r for r in self._waiting if r is not request]
+            for (k, v) in request.items():
+                self._available[k] -= v
+            self._changed.notify_all()
+        return request
+
+    async def release(self, granted: dict[str, float]):
+        async with self._changed:
+            for (k, v) in granted.items():
+                self._available[k] += v
+            self._changed.notify_all()
+
+    def available(self) -> dict[str, float]:
+        return dict(self._available)
+
+class AsyncScheduler(Scheduler):
+    """Scheduler for tasks of one event loop. Step durations are recorded the same way"""
+
+    def __init__(self, max_parallel: int = 4, cpus: None|float = None, mem: None|int = None):
+        super().__init__(max_parallel, cpus, mem)
+        self.resources = AsyncResourcePool(self.resources.budget)
+
+    @asynccontextmanager
+    async def slot(self, node):
+        granted = await self.resources.acquire(self.resource_request(node))
+        time_start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._durations[id(node)] = time.monotonic() - time_start
+            await self.resources.release(granted)
+
+    async def run_graph(self, steps: list[dict], run: Callable[[dict], "asyncio.Future[ExecStatus]"]) -> list[None|ExecStatus]:
+        """Runs every step as a task as soon as all steps it needs have succeeded.
+        Returns the result of each step, or None for steps skipped due to a failed dependency"""
+        index = {step["name"]: i for (i, step) in enumerate(steps)}
+        remaining_needs = [len(step.get("needs", [])) for step in steps]
+        dependents: list[list[int]] = [[] for _ in steps]
+        for (i, step) in enumerate(steps):
+            for need in step.get("needs", []):
+                dependents[index[need]].append(i)
+
+        results: list[None|ExecStatus] = [None] * len(steps)
+
+        async def run_step(i: int) -> tuple[int, ExecStatus]:
+            try:
+                return (i, await run(steps[i]))
+            except Exception as e:
+                logging.exception("Failure running step '%s': %s", steps[i]["name"], e)
+                return (i, ExecStatus.ERROR)
+
+        running = {asyncio.create_task(run_step(i)) for (i, count) in enumerate(remaining_needs) if count == 0}
+        while running:
+            (done, running) = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                (i, result) = task.result()
+                results[i] = result
+                if result != ExecStatus.OK:
+                    continue
+                for j in dependents[i]:
+                    remaining_needs[j] -= 1
+                    if remaining_needs[j] == 0:
+                        running.add(asyncio.create_task(run_step(j)))
+
+        return results
+
+async def exec_step_async(io: IoContext, step, cwd: str, on_output: None|Callable[[OutputStream, str], None] = None, cancel: None|CancelToken = None) -> tuple[ExecStatus, str, str]:
+    """As exec_step(), running the step in cwd"""
+    timeout = step["timeout"] if "timeout" in step else None
+    try:
+        cmd = step_command(step)
+        if not cmd:
+            logging.error(f"Unknown command type: {type(step["exec"])}")
+            return (ExecStatus.UNKNOWN, "", f"Unknown command type: {type(step["exec"])}")
+
+        if on_output:
+            (returncode, stdout, stderr) = (await io.run_streaming_async(cmd, timeout, on_output, cwd=cwd, cancel=cancel), "", "")
+        else:
+            (returncode, stdout, stderr) = await io.run_async(cmd, timeout, cwd=cwd, cancel=cancel)
+
+        # Unless it completed before being killed
+        if cancel and cancel.is_cancelled() and returncode != 0:
+            return (ExecStatus.CANCELLED, stdout, stderr)
+        return (ExecStatus.OK if returncode == 0 else ExecStatus.ERROR, stdout, stderr)
+    except subprocess.TimeoutExpired as e:
+        return (ExecStatus.TIMEOUT, "", str(e))
+
+async def build_async(io: IoContext, args, node, parent_span_id, changeset: list[str]|ChangesetMatcher, cwd: None|str = None, scheduler: None|AsyncScheduler = None, cancel: None|CancelToken = None, cache: None|StepCache = None) -> ExecStatus:
+    """As build_inner(), with every node running in cwd - its parent's cwd joined with its own 'cwd', if any"""
+    if scheduler is None:
+        scheduler = AsyncScheduler(args.max_parallel, args.cpu_budget, args.mem_budget)
+    if cancel is None:
+        cancel = CancelToken()
+    if cwd is None:
+        cwd = io.getcwd()
+
+    if not isinstance(changeset, ChangesetMatcher):
+        changeset = ChangesetMatcher(node, changeset)
+
+    time_step_start = utcnow()
+    span_id = generate_span_id()
+    aggregated_result = ExecStatus.OK
+
+    spanner = create_span_sender(args.traces_endpoint, args.service_name, args.trace_id)
+    logger = create_log_sender(args.logs_endpoint, args.service_name, args.trace_id)
+
+    skip_all = False
+    skip_remaining_steps = False
+    cache_hit = False
+
+    if not changeset.matches(node.get("if-changeset-matches", None)):
+        spanner(f"step:{node['name']} - skipped", parent_span_id, span_id, utcnow(), utcnow(), 0)
+        return ExecStatus.OK
+
+    if cancel.is_cancelled():
+        spanner(f"step:{node['name']} - cancelled", parent_span_id, span_id, utcnow(), utcnow(), exec_status_to_otel[ExecStatus.CANCELLED.value])
+        return ExecStatus.CANCELLED
+
+    # Steps of the node are cancelled upon timeout of the node, or upon the first failure if fail-fast.
+    # Setup and teardown are only cancelled along with the parent
+    steps_cancel = cancel
+    timeout_timers = []
+    if "steps" in node and ("timeout" in node or node.get("fail-fast", False)):
+        steps_cancel = CancelToken(cancel)
+        if "timeout" in node:
+            # Counting from when the first of its steps starts executing, as for build_inner()
+            loop = asyncio.get_running_loop()
+            steps_cancel.on_start(lambda: timeout_timers.append(loop.call_later(float(node["timeout"]), steps_cancel.cancel, "timeout")))
+
+    if "cwd" in node:
+        # Relative to the parent's cwd even if starting with '/', as for build_inner()
+        node_cwd = os.path.normpath(f"{cwd}/{node["cwd"]}")
+        if not io.dir_contains(args.root, node_cwd):
+            logging.critical("cwd denied as requested dir is outside of repository")
+            logger(span_id, "ERROR", "cwd denied as requested dir is outside of repository")
+            skip_all = True
+        cwd = node_cwd
+
+    async def build_step(step) -> ExecStatus:
+        step_result = await build_async(io, args, step, span_id, changeset, cwd, scheduler, steps_cancel, cache)
+        if node.get("fail-fast", False) and step_result not in (ExecStatus.OK, ExecStatus.CANCELLED):
+            steps_cancel.cancel(f"fail-fast: step '{step['name']}' failed")
+        return step_result
+
+    if not skip_all and "setup" in node:
+        step_result = await build_async(io, args, node["setup"], span_id, changeset, cwd, scheduler, cancel, cache)
+        if step_result != ExecStatus.OK:
+            skip_remaining_steps = True
+
+        aggregated_result = worst_status(aggregated_result, step_result)
+
+    if not skip_all and not skip_remaining_steps:
+        if "exec" in node:
+            on_output = None
+            if args.output_mode == "streaming":
+                on_output = lambda stream, text: logger(span_id, "ERROR" if stream == "stderr" else "INFO", text)
+
+            # Hashing inputs and restoring outputs is file I/O, kept off the event loop
+            cache_key = None
+            if cache and "inputs" in node:
+                try:
+                    cache_key = await asyncio.to_thread(step_cache_key, node, cwd)
+                except OSError as e:
+                    logger(span_id, "WARN", f"Could not hash inputs, not using cache: {e}")
+
+            cache_hit = cache_key is not None and await asyncio.to_thread(cache.restore, cache_key, cwd)
+
+            try:
+                async with scheduler.slot(node):
+                    if cache_hit:
+                        (step_result, step_stdout, step_stderr) = (ExecStatus.OK, "", "")
+                    elif cancel.is_cancelled():
+                        (step_result, step_stdout, step_stderr) = (ExecStatus.CANCELLED, "", "")
+                    else:
+                        cancel.start()
+                        (step_result, step_stdout, step_stderr) = await exec_step_async(io, node, cwd, on_output, cancel)
+            except Exception as e:
+                (step_result, step_stdout, step_stderr) = (ExecStatus.ERROR, "", str(e))
+            scheduler.record_result(node, step_result, cache_hit)
+
+            aggregated_result = worst_status(aggregated_result, step_result)
+
+            if cache_key and not cache_hit and step_result == ExecStatus.OK:
+                try:
+                    await asyncio.to_thread(cache.store, cache_key, cwd, node.get("outputs", []))
+                except OSError as e:
+                    logger(span_id, "WARN", f"Could not store result in cache: {e}")
+
+            if len(step_stderr) > 0:
+                logger(span_id, "ERROR", step_stderr)
+
+            if len(step_stdout) > 0:
+                logger(span_id, "INFO", step_stdout)
+        elif "steps" in node:
+            if is_step_graph(node):
+                results = await scheduler.run_graph(node["steps"], build_step)
+                for (step, step_result) in zip(node["steps"], results):
+                    if step_result is None and steps_cancel.is_cancelled():
+                        spanner(f"step:{step['name']} - cancelled", span_id, generate_span_id(), utcnow(), utcnow(), exec_status_to_otel[ExecStatus.CANCELLED.value])
+                    elif step_result is None:
+                        # A step it needs failed
+                        spanner(f"step:{step['name']} - skipped", span_id, generate_span_id(), utcnow(), utcnow(), 0)
+                    else:
+                        aggregated_result = worst_status(aggregated_result, step_result)
+            else:
+                for step in node["steps"]:
+                    if not skip_remaining_steps:
+                        step_result = await build_step(step)
+                        aggregated_result = worst_status(aggregated_result, step_result)
+
+                        if aggregated_result != ExecStatus.OK:
+                            skip_remaining_steps = True
+                    elif steps_cancel.is_cancelled():
+                        spanner(f"step:{step['name']} - cancelled", span_id, generate_span_id(), utcnow(), utcnow(), exec_status_to_otel[ExecStatus.CANCELLED.value])
+                    else:
+                        spanner(f"step:{step['name']} - skipped", span_id, generate_span_id(), utcnow(), utcnow(), 0)
+
+    for timeout_timer in timeout_timers:
+        timeout_timer.cancel()
+    if steps_cancel.reason == "timeout" and not cancel.is_cancelled():
+        logger(span_id, "ERROR", f"Timed out after {node['timeout']}s")
+        aggregated_result = worst_status(aggregated_result, ExecStatus.TIMEOUT)
+    elif steps_cancel.is_cancelled():
+        logger(span_id, "WARN", f"Remaining steps cancelled: {steps_cancel.reason}")
+
+    if not skip_all and "teardown" in node:
+        await build_async(io, args, node["teardown"], span_id, changeset, cwd, scheduler, cancel, cache)
+
+    time_step_end = utcnow()
+
+    span_name = f"step:{node['name']}" + (" - cancelled" if aggregated_result == ExecStatus.CANCELLED else " - cache hit" if cache_hit else "")
+    spanner(span_name, parent_span_id, span_id, time_step_start, time_step_end, exec_status_to_otel[aggregated_result.value])
+
+    return aggregated_result
+
+def test_async_engine_runs_steps_in_their_cwd_without_chdir():
+    ctx = TestIoContext({
+        (("fail.sh",), None): (1, "", ""),
+    })
+    pipeline = {
+        "name": "root",
+        "steps": [
+            {"name": "build", "cwd": "src", "exec": "build.sh"},
+            {"name": "tests", "order": "unordered", "steps": [
+                {"name": "unit", "exec": "unit.sh"},
+                {"name": "integration", "cwd": "it", "exec": "fail.sh"},
+            ]},
+            {"name": "never", "exec": "never-executed.sh"},
+        ]
+    }
+    assert asyncio.run(build_async(ctx, dummy_argparse(), pipeline, "", [], cwd=os.getcwd())) == ExecStatus.ERROR
+    assert sorted(ctx.run_history) == [(["build.sh"], None), (["fail.sh"], None), (["unit.sh"], None)]
+    assert sorted(zip([cmd[0] for (cmd, _) in ctx.run_history], ctx.run_cwds)) == [
+        ("build.sh", os.path.join(os.getcwd(), "src")),
+        ("fail.sh", os.path.join(os.getcwd(), "it")),
+        ("unit.sh", os.getcwd()),
+    ]
+    assert ctx.chdir_history == []
+
+def test_async_engine_runs_processes(tmp_path):
+    (tmp_path / "sub").mkdir()
+    pipeline = {
+        "name": "root",
+        "order": "unordered",
+        "steps": [
+            {"name": f"step{i}", "cwd": "sub", "exec": ["sh", "-c", f"echo {i} > out{i}.txt"]} for i in range(20)
+        ] + [
+            {"name": "streaming", "exec": ["sh", "-c", "pwd > pwd.txt"]},
+        ]
+    }
+    args = dummy_argparse()
+    args.root = str(tmp_path)
+    args.output_mode = "streaming"
+    assert asyncio.run(build_async(IoContext(), args, pipeline, "", [], cwd=str(tmp_path))) == ExecStatus.OK
+    assert sorted(os.listdir(tmp_path / "sub")) == sorted(f"out{i}.txt" for i in range(20))
+    assert (tmp_path / "pwd.txt").read_text().strip() == os.path.realpath(tmp_path)
+
+def test_async_engine_times_out_and_cancels(tmp_path, monkeypatch):
+    spans = []
+    exporter = TelemetryExporter()
+    exporter.submit = lambda endpoint, kind, service, record: spans.append(record["name"]) if kind == "spans" else None
+    monkeypatch.setattr("bass.core._exporter", exporter)
+    fail_fast = {"name": "root", "order": "unordered", "fail-fast": True, "steps": [
+        {"name": "fail", "exec": ["sh", "-c", "sleep 0.1; exit 1"]},
+        {"name": "slow", "exec": ["sleep", "10"]},
+    ]}
+    timeout = {"name": "root", "steps": [{"name": "slow", "exec": ["sleep", "10"], "timeout": 0.1}]}
+    node_timeout = {"name": "root", "timeout": 0.1, "steps": [{"name": "slow", "exec": ["sleep", "10"]}, {"name": "never", "exec": ["true"]}]}
+
+    time_start = time.monotonic()
+    assert asyncio.run(build_async(IoContext(), dummy_argparse(), fail_fast, "", [], cwd=str(tmp_path))) == ExecStatus.ERROR
+    assert asyncio.run(build_async(IoContext(), dummy_argparse(), timeout, "", [], cwd=str(tmp_path))) == ExecStatus.TIMEOUT
+    assert asyncio.run(build_async(IoContext(), dummy_argparse(), node_timeout, "", [], cwd=str(tmp_path))) == ExecStatus.TIMEOUT
+    assert time.monotonic() - time_start < 5
+    assert spans[-3:] == ["step:slow - cancelled", "step:never - cancelled", "step:root"]
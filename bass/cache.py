@@ -0,0 +1,162 @@
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tarfile
+import threading
+import time
+
+def _expand_globs(root: str, patterns: list[str]) -> list[str]:
+    """Returns the files below root matching any of patterns, as sorted paths relative to root"""
+    matches = set()
+    for pattern in patterns:
+        for path in glob.glob(pattern, root_dir=root, recursive=True):
+            if os.path.isfile(os.path.join(root, path)):
+                matches.add(os.path.normpath(path))
+    return sorted(matches)
+
+def step_cache_key(step, cwd: str) -> str:
+    """Returns a hash of everything declared to affect the result of step: its command, the env vars and
+    the contents of the files listed in its 'inputs'. Relative file patterns are resolved from cwd"""
+    inputs = step.get("inputs", {})
+    cmd = [step["exec"]] if type(step["exec"]) == str else step["exec"]
+
+    h = hashlib.sha256()
+    h.update(json.dumps({
+        "exec": [os.path.expandvars(v) for v in cmd],
+        "env": {name: os.environ.get(name) for name in sorted(inputs.get("env", []))},
+    }, sort_keys=True).encode("utf-8"))
+
+    for path in _expand_globs(cwd, inputs.get("files", [])):
+        h.update(path.encode("utf-8") + b"\0")
+        with open(os.path.join(cwd, path), "rb") as f:
+            h.update(hashlib.file_digest(f, "sha256").digest())
+
+    return h.hexdigest()
+
+class StepCache:
+    """On-disk cache of successful step results, keyed by step_cache_key().
+
+    Every entry is a directory holding a manifest and an archive of the step's declared 'outputs'. The least
+    recently used entries are evicted once the cache exceeds max_bytes."""
+
+    def __init__(self, path: str, max_bytes: int = 1024**3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        os.makedirs(path, exist_ok=True)
+
+    def _entry(self, key: str) -> str:
+        return os.path.join(self.path, key)
+
+    def restore(self, key: str, cwd: str) -> bool:
+        """Restores the outputs of the entry for key into cwd. Returns False if there is no such entry"""
+        entry = self._entry(key)
+        try:
+            with open(os.path.join(entry, "manifest.json")) as f:
+                manifest = json.load(f)
+            if manifest["outputs"]:
+                with tarfile.open(os.path.join(entry, "outputs.tar")) as tar:
+                    tar.extractall(cwd, filter="data")
+            # The manifest's mtime is the time of last use
+            os.utime(os.path.join(entry, "manifest.json"))
+        except (OSError, ValueError, KeyError, tarfile.TarError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logging.warning(f"Ignoring broken cache entry {key}: {e}")
+            with self._lock:
+                self.counters["misses"] += 1
+            return False
+
+        with self._lock:
+            self.counters["hits"] += 1
+        return True
+
+    def store(self, key: str, cwd: str, outputs: list[str]):
+        """Stores an entry for key, holding the files below cwd matching the patterns of outputs"""
+        paths = _expand_globs(cwd, outputs)
+        tmp_entry = f"{self._entry(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        os.makedirs(tmp_entry, exist_ok=True)
+        try:
+            if paths:
+                with tarfile.open(os.path.join(tmp_entry, "outputs.tar"), "w") as tar:
+                    for path in paths:
+                        tar.add(os.path.join(cwd, path), arcname=path)
+            with open(os.path.join(tmp_entry, "manifest.json"), "w") as f:
+                json.dump({"outputs": paths, "created": time.time()}, f)
+
+            with self._lock:
+                shutil.rmtree(self._entry(key), ignore_errors=True)
+                os.rename(tmp_entry, self._entry(key))
+                self.counters["stores"] += 1
+                self._evict()
+        except:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            raise
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.path):
+            entry = self._entry(name)
+            try:
+                last_used = os.stat(os.path.join(entry, "manifest.json")).st_mtime
+                size = sum(os.stat(os.path.join(entry, f)).st_size for f in os.listdir(entry))
+            except OSError:
+                # Entries being written by someone else
+                continue
+            entries.append((last_used, size, entry))
+            total += size
+
+        for (_, size, entry) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            self.counters["evictions"] += 1
+
+def test_cache_key_follows_inputs(tmp_path):
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "a.py").write_text("a")
+    step = {"name": "lint", "exec": ["lint", "src"], "inputs": {"files": ["src/**/*.py"], "env": ["BASS_TEST_CACHE_ENV"]}}
+
+    key = step_cache_key(step, str(tmp_path))
+    assert step_cache_key(step, str(tmp_path)) == key
+    (tmp_path / "src" / "b.txt").write_text("not an input")
+    assert step_cache_key(step, str(tmp_path)) == key
+
+    (tmp_path / "src" / "a.py").write_text("b")
+    assert step_cache_key(step, str(tmp_path)) != key
+    key = step_cache_key(step, str(tmp_path))
+
+    os.environ["BASS_TEST_CACHE_ENV"] = "1"
+    try:
+        assert step_cache_key(step, str(tmp_path)) != key
+    finally:
+        del os.environ["BASS_TEST_CACHE_ENV"]
+
+    assert step_cache_key({**step, "exec": ["lint", "."]}, str(tmp_path)) != key
+
+def test_cache_restores_outputs_and_evicts_least_recently_used(tmp_path):
+    work = tmp_path / "work"
+    (work / "dist").mkdir(parents=True)
+    (work / "dist" / "out.bin").write_bytes(b"x" * 1000)
+
+    cache = StepCache(str(tmp_path / "cache"), max_bytes=25000)
+    assert not cache.restore("a", str(work))
+    cache.store("a", str(work), ["dist/*"])
+    cache.store("b", str(work), ["dist/*"])
+
+    (work / "dist" / "out.bin").unlink()
+    # Make "b" the least recently used
+    os.utime(tmp_path / "cache" / "b" / "manifest.json", (0, 0))
+    assert cache.restore("a", str(work))
+    assert (work / "dist" / "out.bin").read_bytes() == b"x" * 1000
+
+    cache.store("c", str(work), ["dist/*"])
+    assert cache.counters["evictions"] == 1
+    assert not cache.restore("b", str(work))
+    assert cache.restore("a", str(work))
+    assert cache.restore("c", str(work))
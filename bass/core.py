@@ -1,14 +1,32 @@
 from enum import Enum
-from urllib import request as urq, error
+from urllib.parse import urlsplit
 from typing import Literal, Callable
 import json
 import os
+import sys
 import datetime
 import argparse
 import logging
 import re
 import subprocess
+import signal
+import selectors
+import codecs
+import tempfile
+import http.client
+import http.server as server
+import gzip
+import threading
+import queue
+import time
+import atexit
+import asyncio
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from .cache import StepCache, step_cache_key
+from .history import StepHistory
+from .spool import TelemetrySpool
+from .otlp import Encoding, create_encoder
 
 type Severity = Literal["TRACE", "DEBUG", "INFO", "WARN", "ERROR", "FATAL"]
 class ExecStatus(Enum):
@@ -16,20 +34,276 @@ class ExecStatus(Enum):
     UNKNOWN = 1
     TIMEOUT = 2
     ERROR = 3
+    CANCELLED = 4 # E.g. by a failing sibling in a fail-fast group, or by a timeout of a parent node
     # SKIPPED ?
 
 exec_status_to_otel = {
     0: 1, # OK
     1: 0, # unknown
     2: 2, # ERRPR
-    3: 2 # ERROR
+    3: 2, # ERROR
+    4: 2, # ERROR
 }
 
+# Order of severity when aggregating results of several steps. A cancellation is always caused by something more severe
+exec_status_severity = {
+    ExecStatus.OK: 0,
+    ExecStatus.UNKNOWN: 1,
+    ExecStatus.CANCELLED: 2,
+    ExecStatus.TIMEOUT: 3,
+    ExecStatus.ERROR: 4,
+}
+
+def worst_status(a: ExecStatus, b: ExecStatus) -> ExecStatus:
+    return b if exec_status_severity[b] > exec_status_severity[a] else a
+
+class CancelToken:
+    """Cancellation shared by the steps of a node. Cancelling a token cancels the tokens derived from it as well,
+    and calls every registered callback - e.g. to kill running processes"""
+
+    def __init__(self, parent: "None|CancelToken" = None):
+        self.reason: None|str = None
+        self._lock = threading.Lock()
+        self._callbacks: list[Callable[[], None]] = []
+        self._children: list[CancelToken] = []
+        self._parent = parent
+        self._start_callbacks: None|list[Callable[[], None]] = []
+        if parent:
+            parent._add_child(self)
+
+    def _add_child(self, child: "CancelToken"):
+        with self._lock:
+            if self.reason is None:
+                self._children.append(child)
+                return
+        child.cancel(self.reason)
+
+    def cancel(self, reason: str = "cancelled"):
+        with self._lock:
+            if self.reason is not None:
+                return
+            self.reason = reason
+            (callbacks, children) = (self._callbacks, self._children)
+            (self._callbacks, self._children) = ([], [])
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logging.error(f"Failure during cancellation: {e}")
+
+        for child in children:
+            child.cancel(reason)
+
+    def is_cancelled(self) -> bool:
+        return self.reason is not None
+
+    def on_cancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """Registers callback, or calls it right away if already cancelled. Returns a function unregistering it"""
+        with self._lock:
+            if self.reason is None:
+                self._callbacks.append(callback)
+                return lambda: self._remove_callback(callback)
+        callback()
+        return lambda: None
+
+    def _remove_callback(self, callback: Callable[[], None]):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def on_start(self, callback: Callable[[], None]):
+        """Registers callback to be called once a step under the token starts executing, or calls it right away if
+        one already has"""
+        with self._lock:
+            if self._start_callbacks is not None:
+                self._start_callbacks.append(callback)
+                return
+        callback()
+
+    def start(self):
+        """Marks a step under the token - and the tokens it is derived from - as executing, rather than waiting"""
+        token = self
+        while token:
+            with token._lock:
+                (callbacks, token._start_callbacks) = (token._start_callbacks, None)
+            if callbacks is None:
+                # Ancestors are started already as well
+                return
+            for callback in callbacks:
+                callback()
+            token = token._parent
+
+    def cancel_after(self, timeout: float, reason: str = "timeout", on_start: bool = False) -> threading.Timer:
+        """Cancels the token after timeout seconds, unless the returned timer is cancelled first. If on_start, the
+        timeout only counts from when a step under the token starts executing - not while steps wait for a slot"""
+        timer = threading.Timer(timeout, self.cancel, [reason])
+        timer.daemon = True
+        if on_start:
+            self.on_start(timer.start)
+        else:
+            timer.start()
+        return timer
+
+def kill_process_group(proc: subprocess.Popen):
+    """Kills proc and - if it leads a process group of its own - every process in that group"""
+    try:
+        if os.getpgid(proc.pid) == proc.pid:
+            os.killpg(proc.pid, signal.SIGKILL)
+            return
+    except ProcessLookupError:
+        return
+    except OSError:
+        pass
+
+    try:
+        proc.kill()
+    except ProcessLookupError:
+        pass
+
+type OutputStream = Literal["stdout", "stderr"]
+
+class UsagePopen(subprocess.Popen):
+    """Popen which records the resource usage of the process - and of the descendants it waited for - as it is
+    reaped by wait(). rusage is None until then, and if the process is reaped by poll() instead"""
+    rusage = None
+
+    def _try_wait(self, wait_flags):
+        if not hasattr(os, "wait4"):
+            return super()._try_wait(wait_flags)
+        try:
+            (pid, sts, rusage) = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            return (self.pid, 0)
+        if pid == self.pid:
+            self.rusage = rusage
+        return (pid, sts)
+
+def rusage_attributes(rusage) -> dict[str, int|float]:
+    """Returns span attributes of a resource.struct_rusage: CPU seconds, peak memory of the largest process, block I/O
+    operations and context switches"""
+    return {
+        "process.cpu.user": rusage.ru_utime,
+        "process.cpu.system": rusage.ru_stime,
+        # Kilobytes, except on macOS
+        "process.memory.max_rss": rusage.ru_maxrss if sys.platform == "darwin" else rusage.ru_maxrss * 1024,
+        "process.disk.blocks_in": rusage.ru_inblock,
+        "process.disk.blocks_out": rusage.ru_oublock,
+        "process.context_switches.voluntary": rusage.ru_nvcsw,
+        "process.context_switches.involuntary": rusage.ru_nivcsw,
+    }
+
+def test_usage_popen_records_rusage():
+    proc = UsagePopen(["sh", "-c", "i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done"])
+    assert proc.wait() == 0
+    usage = rusage_attributes(proc.rusage)
+    assert usage["process.cpu.user"] + usage["process.cpu.system"] > 0
+    assert usage["process.memory.max_rss"] > 0
+
 class IoContext:
     """Provides a convenient way to override realization of basic system/IO operations"""
-    def run(self, cmd: list[str], timeout: int) -> tuple[int, str, str]:
-        result = subprocess.run(cmd, capture_output=True, timeout=timeout)
-        return (result.returncode, result.stdout.decode(), result.stderr.decode())
+    def __init__(self, max_output: None|int = None, spill_dir: None|str = None):
+        self.max_output = max_output
+        self.spill_dir = spill_dir
+
+    def run(self, cmd: list[str], timeout: int, cancel: None|CancelToken = None, on_usage: None|Callable[[dict[str, int|float]], None] = None) -> tuple[int, str, str]:
+        """Runs cmd in a process group of its own, which is killed entirely on timeout or cancellation.
+        Passes the resource usage of the command on to on_usage, as rusage_attributes()"""
+        proc = UsagePopen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+        unregister = cancel.on_cancel(lambda: kill_process_group(proc)) if cancel else lambda: None
+        try:
+            (stdout, stderr) = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired as e:
+            kill_process_group(proc)
+            (e.output, e.stderr) = proc.communicate()
+            raise
+        finally:
+            unregister()
+            if on_usage and proc.rusage:
+                on_usage(rusage_attributes(proc.rusage))
+        return (proc.returncode, stdout.decode(), stderr.decode())
+
+    def run_streaming(self, cmd: list[str], timeout: int, on_output: Callable[[OutputStream, str], None], cancel: None|CancelToken = None, on_usage: None|Callable[[dict[str, int|float]], None] = None) -> int:
+        """As run(), but passes output on in line-batches while the command runs. Returns the exit code"""
+        spill_path = self._spill_path()
+        proc = UsagePopen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+        unregister = cancel.on_cancel(lambda: kill_process_group(proc)) if cancel else lambda: None
+        try:
+            returncode = stream_output(proc, on_output, timeout, max_output=self.max_output, spill_path=spill_path)
+        finally:
+            unregister()
+            if on_usage and proc.rusage:
+                on_usage(rusage_attributes(proc.rusage))
+
+        if spill_path and os.path.getsize(spill_path) == 0:
+            os.remove(spill_path)
+
+        return returncode
+
+    def _spill_path(self) -> None|str:
+        if not self.spill_dir:
+            return None
+        os.makedirs(self.spill_dir, exist_ok=True)
+        (fd, spill_path) = tempfile.mkstemp(prefix="bass-output-", suffix=".log", dir=self.spill_dir)
+        os.close(fd)
+        return spill_path
+
+    async def run_async(self, cmd: list[str], timeout: None|float, cwd: None|str = None, cancel: None|CancelToken = None) -> tuple[int, str, str]:
+        """As run(), but in the running event loop, and in cwd rather than the cwd of the process.
+        Output of a command which timed out is discarded"""
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True, cwd=cwd)
+        loop = asyncio.get_running_loop()
+        unregister = cancel.on_cancel(lambda: loop.call_soon_threadsafe(kill_process_group, proc)) if cancel else lambda: None
+        try:
+            (stdout, stderr) = await asyncio.wait_for(proc.communicate(), timeout)
+        except TimeoutError:
+            kill_process_group(proc)
+            await proc.wait()
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        finally:
+            unregister()
+        return (proc.returncode, stdout.decode(errors="replace"), stderr.decode(errors="replace"))
+
+    async def run_streaming_async(self, cmd: list[str], timeout: None|float, on_output: Callable[[OutputStream, str], None], cwd: None|str = None, cancel: None|CancelToken = None,
+                                  batch_bytes: int = 64 * 1024, batch_interval: float = 1.0) -> int:
+        """As run_streaming(), but in the running event loop, and in cwd rather than the cwd of the process"""
+        spill_path = self._spill_path()
+        limiter = _OutputLimiter(on_output, self.max_output, spill_path)
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True, cwd=cwd)
+        loop = asyncio.get_running_loop()
+        unregister = cancel.on_cancel(lambda: loop.call_soon_threadsafe(kill_process_group, proc)) if cancel else lambda: None
+
+        async def pump(reader: asyncio.StreamReader, buffer: _OutputBuffer):
+            while True:
+                try:
+                    async with asyncio.timeout(batch_interval):
+                        data = await reader.read(64 * 1024)
+                except TimeoutError:
+                    # Nothing new, but the pending batch may be due
+                    data = None
+                if data == b"":
+                    buffer.feed(b"", final=True)
+                    if buffer.batch:
+                        limiter.emit(buffer)
+                    return
+                if data:
+                    buffer.feed(data, max_partial=batch_bytes)
+                if buffer.batch and (buffer.batch_size >= batch_bytes or time.monotonic() - buffer.batch_started >= batch_interval):
+                    limiter.emit(buffer)
+
+        try:
+            await asyncio.wait_for(asyncio.gather(pump(proc.stdout, _OutputBuffer("stdout")), pump(proc.stderr, _OutputBuffer("stderr")), proc.wait()), timeout)
+        except TimeoutError:
+            kill_process_group(proc)
+            await proc.wait()
+            raise subprocess.TimeoutExpired(cmd, timeout)
+        finally:
+            unregister()
+            limiter.close()
+            if spill_path and os.path.getsize(spill_path) == 0:
+                os.remove(spill_path)
+
+        return proc.returncode
     
     def dir_contains(self, dir_expected_top: str, dir_expected_sub: str) -> bool:
         """Returns True if 'dir_expected_sub' is either the same as - or a subfolder of- 'dir_expected_top'"""
@@ -49,121 +323,735 @@ class IoContext:
     def getcwd(self) -> str:
         return os.getcwd()
 
-def generate_span(trace_id: str, parent_span_id: None|str, span_id: str, service: str, name: str, time_from: datetime.datetime, time_to: datetime.datetime, status: int):
+class _OutputBuffer:
+    """Decodes output from one pipe and collects complete lines into batches"""
+    def __init__(self, stream: OutputStream):
+        self.stream = stream
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.partial = ""
+        self.batch: list[str] = []
+        self.batch_size = 0
+        self.batch_started = None
+
+    def feed(self, data: bytes, final: bool = False, max_partial: None|int = None):
+        text = self.partial + self.decoder.decode(data, final)
+        (complete, _, self.partial) = text.rpartition("\n")
+        # Unterminated lines are passed on as-is at the end, or if they grow too large
+        if self.partial and (final or (max_partial is not None and len(self.partial) >= max_partial)):
+            (complete, self.partial) = (text, "")
+        elif complete:
+            complete += "\n"
+
+        if complete:
+            self.batch.append(complete)
+            self.batch_size += len(complete)
+            if self.batch_started is None:
+                self.batch_started = time.monotonic()
+
+    def take(self) -> str:
+        text = "".join(self.batch)
+        self.batch = []
+        self.batch_size = 0
+        self.batch_started = None
+        return text
+
+class _OutputLimiter:
+    """Passes batches of output on to on_output, until max_output bytes have been passed on. Writes the remaining
+    output to spill_path if provided, and discards it otherwise"""
+    def __init__(self, on_output: Callable[[OutputStream, str], None], max_output: None|int = None, spill_path: None|str = None):
+        self.on_output = on_output
+        self.max_output = max_output
+        self.spill_path = spill_path
+        self.emitted = 0
+        self.spill = None
+        self.truncated = False
+
+    def emit(self, buffer: _OutputBuffer):
+        text = buffer.take()
+        if self.max_output is None or self.emitted < self.max_output:
+            self.emitted += len(text)
+            self.on_output(buffer.stream, text)
+            return
+
+        if not self.truncated:
+            self.truncated = True
+            notice = f"Output exceeded {self.max_output} bytes"
+            self.on_output("stderr", f"{notice}, remaining output is written to: {self.spill_path}" if self.spill_path else f"{notice}, remaining output is discarded")
+
+        if self.spill_path:
+            if self.spill is None:
+                self.spill = open(self.spill_path, "a")
+            self.spill.write(text)
+
+    def close(self):
+        if self.spill:
+            self.spill.close()
+
+def stream_output(proc: subprocess.Popen, on_output: Callable[[OutputStream, str], None], timeout: None|float = None, max_output: None|int = None, spill_path: None|str = None, batch_bytes: int = 64 * 1024, batch_interval: float = 1.0) -> int:
+    """Reads stdout and stderr of proc incrementally, and passes them on to on_output as batches of complete lines.
+
+    A batch is passed on once it holds batch_bytes, or batch_interval seconds after its first line. Once max_output
+    bytes have been passed on, remaining output is written to spill_path if provided, and discarded otherwise.
+    Returns the exit code. Kills the process and raises subprocess.TimeoutExpired on timeout."""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    selector = selectors.DefaultSelector()
+    buffers: list[_OutputBuffer] = []
+    for (stream, pipe) in (("stdout", proc.stdout), ("stderr", proc.stderr)):
+        if pipe is not None:
+            buffer = _OutputBuffer(stream)
+            buffers.append(buffer)
+            selector.register(pipe, selectors.EVENT_READ, buffer)
+
+    limiter = _OutputLimiter(on_output, max_output, spill_path)
+    emit = limiter.emit
+
+    try:
+        while selector.get_map():
+            wait = batch_interval
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    kill_process_group(proc)
+                    proc.wait()
+                    raise subprocess.TimeoutExpired(proc.args, timeout)
+                wait = min(wait, remaining)
+
+            for (key, _) in selector.select(wait):
+                buffer = key.data
+                data = os.read(key.fd, 64 * 1024)
+                if not data:
+                    selector.unregister(key.fileobj)
+                    key.fileobj.close()
+                    buffer.feed(b"", final=True)
+                else:
+                    buffer.feed(data, max_partial=batch_bytes)
+
+            now = time.monotonic()
+            for buffer in buffers:
+                if buffer.batch and (buffer.batch_size >= batch_bytes or now - buffer.batch_started >= batch_interval or not selector.get_map()):
+                    emit(buffer)
+
+        return proc.wait(None if deadline is None else max(0.0, deadline - time.monotonic()))
+    except subprocess.TimeoutExpired:
+        kill_process_group(proc)
+        proc.wait()
+        raise
+    finally:
+        for buffer in buffers:
+            if buffer.batch:
+                emit(buffer)
+        selector.close()
+        limiter.close()
+
+def test_stream_output_passes_on_lines_from_both_streams():
+    output = []
+    proc = subprocess.Popen(["sh", "-c", "echo out1; echo err1 >&2; printf out2"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert stream_output(proc, lambda stream, text: output.append((stream, text))) == 0
+    assert "".join(text for (stream, text) in output if stream == "stdout") == "out1\nout2"
+    assert "".join(text for (stream, text) in output if stream == "stderr") == "err1\n"
+
+def test_stream_output_spills_beyond_max_output(tmp_path):
+    output = []
+    spill_path = str(tmp_path / "spill.log")
+    proc = subprocess.Popen(["sh", "-c", "for i in 1 2 3 4 5; do echo line$i; sleep 0.05; done"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert stream_output(proc, lambda stream, text: output.append(text), max_output=6, spill_path=spill_path, batch_interval=0) == 0
+    assert output[0] == "line1\n"
+    assert "spill.log" in output[1]
+    with open(spill_path) as f:
+        assert f.read() == "line2\nline3\nline4\nline5\n"
+
+def test_stream_output_kills_on_timeout():
+    proc = subprocess.Popen(["sleep", "5"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        stream_output(proc, lambda stream, text: None, timeout=0.1)
+        assert False
+    except subprocess.TimeoutExpired:
+        assert proc.returncode is not None
+
+def generate_attributes(attributes: dict[str, str|bool|int|float]) -> list[dict]:
+    def value(v):
+        if isinstance(v, bool):
+            return {"boolValue": v}
+        if isinstance(v, int):
+            return {"intValue": v}
+        if isinstance(v, float):
+            return {"doubleValue": v}
+        return {"stringValue": str(v)}
+    return [{"key": key, "value": value(v)} for (key, v) in attributes.items()]
+
+def generate_span_record(trace_id: str, parent_span_id: None|str, span_id: str, name: str, time_from: datetime.datetime, time_to: datetime.datetime, status: int, attributes: None|dict[str, str|bool|int|float] = None):
+    record = {
+        "traceId": trace_id,
+        "spanId": span_id,
+        "parentSpanId": parent_span_id,
+        "startTimeUnixNano": datetime_to_nano(time_from),
+        "endTimeUnixNano": datetime_to_nano(time_to),
+        "name": name,
+        "kind": 2,
+        "status": {
+            "code": status
+        }
+    }
+    if attributes:
+        record["attributes"] = generate_attributes(attributes)
+    return record
+
+def generate_resource(service: str):
+    return {
+        "attributes": [
+            {
+                "key": "service.name",
+                "value": {
+                    "stringValue": service
+                }
+            }
+        ]
+    }
+
+def generate_spans_payload(spans_by_service: dict[str, list[dict]]):
+    """Wraps span records - grouped by service name - in a single OTLP resourceSpans-payload"""
     return {
         "resourceSpans": [
             {
-                "resource": {
-                "attributes": [
-                    {
-                        "key": "service.name",
-                        "value": {
-                            "stringValue": service
-                        }
-                    }
-                ]
-                },
+                "resource": generate_resource(service),
                 "scopeSpans": [
                     {
-                        "spans": [
-                            {
-                                "traceId": trace_id,
-                                "spanId": span_id,
-                                "parentSpanId": parent_span_id,
-                                "startTimeUnixNano": datetime_to_nano(time_from),
-                                "endTimeUnixNano": datetime_to_nano(time_to),
-                                "name": name,
-                                "kind": 2,
-                                "status": {
-                                    "code": status
-                                }
-                            },
-                        ]
+                        "spans": spans
                     }
                 ]
-            }
+            } for (service, spans) in spans_by_service.items()
         ]
     }
 
-def create_span_sender(traces_endpoint: str, service_name: str, trace_id: str) -> Callable[[str, str, str, datetime.datetime, datetime.datetime, int], None]:
-    def span_sender(name: str, parent_span_id: None|str, span_id: str, time_from:datetime.datetime, time_to:datetime.datetime, status: int):
-        span = generate_span(trace_id, parent_span_id, span_id, service_name, name, time_from, time_to, status)
-        (status, body) = request("POST", traces_endpoint, span, headers={"Content-Type": "application/json"})
-        if status != 200:
-            logging.error(f"Could not post span. Reason: {body}")
+def generate_span(trace_id: str, parent_span_id: None|str, span_id: str, service: str, name: str, time_from: datetime.datetime, time_to: datetime.datetime, status: int, attributes: None|dict[str, str|bool|int|float] = None):
+    return generate_spans_payload({service: [generate_span_record(trace_id, parent_span_id, span_id, name, time_from, time_to, status, attributes)]})
+
+def test_generate_spans_payload_groups_by_service():
+    span = generate_span_record("trace", None, "span", "name", utcnow(), utcnow(), 1)
+    payload = generate_spans_payload({"a": [span, span], "b": [span]})
+    assert len(payload["resourceSpans"]) == 2
+    assert len(payload["resourceSpans"][0]["scopeSpans"][0]["spans"]) == 2
+    assert payload["resourceSpans"][1]["resource"]["attributes"][0]["value"]["stringValue"] == "b"
+
+def test_generate_span_record_attributes():
+    span = generate_span_record("trace", None, "span", "name", utcnow(), utcnow(), 1, {"cpu": 1.5, "rss": 300, "ok": True, "host": "a"})
+    assert span["attributes"] == [
+        {"key": "cpu", "value": {"doubleValue": 1.5}},
+        {"key": "rss", "value": {"intValue": 300}},
+        {"key": "ok", "value": {"boolValue": True}},
+        {"key": "host", "value": {"stringValue": "a"}},
+    ]
+    assert "attributes" not in generate_span_record("trace", None, "span", "name", utcnow(), utcnow(), 1)
+
+def create_span_sender(traces_endpoint: str, service_name: str, trace_id: str, exporter: "None|TelemetryExporter" = None) -> Callable[..., None]:
+    """Returns a function which queues spans for batched export. Defaults to the shared exporter"""
+    exporter = exporter or get_exporter()
+
+    def span_sender(name: str, parent_span_id: None|str, span_id: str, time_from:datetime.datetime, time_to:datetime.datetime, status: int, attributes: None|dict[str, str|bool|int|float] = None):
+        span = generate_span_record(trace_id, parent_span_id, span_id, name, time_from, time_to, status, attributes)
+        exporter.submit(traces_endpoint, "spans", service_name, span)
 
     return span_sender
 
-def generate_log(trace_id: str, span_id: str, service: str, severity: Severity, message: str):
-    sevMap = {
-        "TRACE": 1,
-        "DEBUG": 5,
-        "INFO": 9,
-        "WARN": 13,
-        "ERROR": 17,
-        "FATAL": 21
+severity_map = {
+    "TRACE": 1,
+    "DEBUG": 5,
+    "INFO": 9,
+    "WARN": 13,
+    "ERROR": 17,
+    "FATAL": 21
+}
+
+def generate_log_record(trace_id: str, span_id: str, severity: Severity, message: str):
+    now = time.time_ns()
+    return {
+        "timeUnixNano": now,
+        "observedTimeUnixNano": now,
+        "severityNumber": severity_map[severity],
+        # "severityText": "Information",
+        "traceId": trace_id,
+        "spanId": span_id,
+        "body": {
+            "stringValue": message
+        }
     }
 
+def generate_logs_payload(logs_by_service: dict[str, list[dict]]):
+    """Wraps log records - grouped by service name - in a single OTLP resourceLogs-payload"""
     return {
         "resourceLogs": [
             {
-                "resource": {
-                    "attributes": [
-                        {
-                            "key": "service.name",
-                            "value": {
-                                "stringValue": service
-                            }
-                        }
-                    ]
-                },
+                "resource": generate_resource(service),
                 "scopeLogs": [
                     {
-                        "logRecords": [
-                            {
-                                "timeUnixNano": datetime_to_nano(utcnow()),
-                                "observedTimeUnixNano": datetime_to_nano(utcnow()),
-                                "severityNumber": sevMap[severity],
-                                # "severityText": "Information",
-                                "traceId": trace_id,
-                                "spanId": span_id,
-                                "body": {
-                                    "stringValue": message
-                                }
-                            }
-                        ]
+                        "logRecords": logs
                     }
                 ]
-            }
+            } for (service, logs) in logs_by_service.items()
         ]
     }
 
-def create_log_sender(logs_endpoint: str, service_name: str, trace_id: str) -> Callable[[str, Severity, str], None]:
+def generate_log(trace_id: str, span_id: str, service: str, severity: Severity, message: str):
+    return generate_logs_payload({service: [generate_log_record(trace_id, span_id, severity, message)]})
+
+def create_log_sender(logs_endpoint: str, service_name: str, trace_id: str, exporter: "None|TelemetryExporter" = None) -> Callable[[str, Severity, str], None]:
+    """Returns a function which queues log records for batched export. Defaults to the shared exporter"""
+    exporter = exporter or get_exporter()
+
     def log_sender(span_id: str, severity: Severity, message: str):
         logging.debug(message)
-        log = generate_log(trace_id, span_id, service_name, severity, message)
-        (status, body) = request("POST", logs_endpoint, log, headers={"Content-Type": "application/json"})
-        if status != 200:
-            logging.error(f"Could not post log. Reason: {body}")
+        log = generate_log_record(trace_id, span_id, severity, message)
+        exporter.submit(logs_endpoint, "logs", service_name, log)
 
     return log_sender
 
-def request(method: Literal["GET", "POST", "PUT", "DELETE"], url, payload=None, headers={}) -> tuple[int, str|None]:
-    req = urq.Request(url)
-    req.method = method
-    if payload:
-        req.data = json.dumps(payload).encode("utf-8")
+class _FlushRequest:
+    def __init__(self, stop: bool = False):
+        self.stop = stop
+        self.done = threading.Event()
+
+class TelemetryExporter:
+    """Queues spans and log records, and posts them to the collector in batches from a background thread.
+
+    Records are coalesced into one payload pr endpoint, grouped by service name. A batch is posted once it
+    reaches max_batch_size, once the oldest record has waited flush_interval seconds, or upon flush()/shutdown().
+    Submitting never blocks: if the queue is full the record is dropped and counted.
+
+    With a spool, payloads which could not be posted are written to disk instead of being lost. While the
+    collector is failing, later payloads go straight to the spool - keeping their order, and not waiting for
+    one more request to time out. The spool is replayed in the background, retrying after retry_interval
+    seconds, doubled upon every failure up to max_retry_interval. Given spool_poll_interval, the spool is also
+    checked that often for segments sealed by other processes sharing it, and those are replayed as well.
+
+    Payloads are encoded as OTLP/JSON, or OTLP/protobuf by encoding="protobuf" (see bass.otlp)."""
+
+    def __init__(self, max_queue_size: int = 10000, max_batch_size: int = 512, flush_interval: float = 1.0, compress: bool = False,
+                 spool: None|TelemetrySpool = None, retry_interval: float = 1.0, max_retry_interval: float = 60.0, request_timeout: float = 10.0,
+                 encoding: Encoding = "json", spool_poll_interval: None|float = None):
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.compress = compress
+        self.encoder = create_encoder(encoding)
+        self.spool = spool
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.request_timeout = request_timeout
+        # Monotonic time of the next replay of the spool, while the collector is failing
+        self._next_replay: None|float = time.monotonic() if spool and spool.has_backlog() else None
+        self._backoff = retry_interval
+        self.spool_poll_interval = spool_poll_interval
+        self._next_spool_poll: None|float = time.monotonic() if spool and spool_poll_interval else None
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._counters = {
+            "submitted": 0,
+            "dropped": 0,
+            "exported": 0,
+            "failed": 0,
+            "flushes": 0,
+        }
+
+    def _count(self, counter: str, n: int = 1):
+        with self._lock:
+            self._counters[counter] += n
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="bass-telemetry-exporter", daemon=True)
+                self._thread.start()
+
+    def submit(self, endpoint: str, kind: Literal["spans", "logs"], service: str, record: dict) -> bool:
+        """Queues a record for export. Returns False if the record was dropped"""
+        if self._closed:
+            self._count("dropped")
+            return False
 
-    for k,v in headers.items():
-        req.add_header(k, v)
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((endpoint, kind, service, record))
+        except queue.Full:
+            self._count("dropped")
+            return False
+
+        self._count("submitted")
+        return True
+
+    def flush(self, timeout: None|float = None) -> bool:
+        """Blocks until every record submitted so far has been posted. Returns False on timeout. Returns at once after shutdown(), which flushes by itself"""
+        return self._request_flush(_FlushRequest(), timeout)
+
+    def shutdown(self, timeout: None|float = None) -> bool:
+        """Flushes all pending records and stops the background thread. Later submits are dropped"""
+        if self._closed:
+            return True
+        self._closed = True
+        return self._request_flush(_FlushRequest(stop=True), timeout)
 
+    def _request_flush(self, flush_request: _FlushRequest, timeout: None|float) -> bool:
+        if self._thread is None or (self._closed and not flush_request.stop):
+            # Nothing to flush, or flushed upon shutdown
+            return True
+
+        try:
+            self._queue.put(flush_request, timeout=timeout)
+        except queue.Full:
+            return False
+
+        return flush_request.done.wait(timeout)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            stats = {**self._counters, "queued": self._queue.qsize()}
+        if self.spool:
+            stats.update({f"spool_{name}": n for (name, n) in self.spool.counters.items()})
+            stats.update({f"spool_backlog_{name}": n for (name, n) in self.spool.backlog().items()})
+        return stats
+
+    def _run(self):
+        pending: dict[tuple[str, str], dict[str, list[dict]]] = {}
+        pending_count = 0
+        deadline = None
+
+        while True:
+            if self._next_replay is not None and time.monotonic() >= self._next_replay:
+                self._replay()
+            if self._next_spool_poll is not None and time.monotonic() >= self._next_spool_poll:
+                self._next_spool_poll = time.monotonic() + self.spool_poll_interval
+                if self._next_replay is None and self.spool.has_backlog():
+                    self._replay()
+
+            wakeups = [t for t in (deadline, self._next_replay, self._next_spool_poll) if t is not None]
+            timeout = None if not wakeups else max(0.0, min(wakeups) - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, tuple):
+                (endpoint, kind, service, record) = item
+                pending.setdefault((endpoint, kind), {}).setdefault(service, []).append(record)
+                pending_count += 1
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+                if pending_count < self.max_batch_size:
+                    continue
+
+            if pending_count > 0:
+                self._post(pending)
+                pending = {}
+                pending_count = 0
+            deadline = None
+
+            if isinstance(item, _FlushRequest):
+                if item.stop and self.spool:
+                    # Leave the backlog to be replayed by whoever uses the spool next
+                    self.spool.close()
+                item.done.set()
+                if item.stop:
+                    return
+
+    def _send(self, endpoint: str, body: bytes, content_type: str) -> tuple[int, str|None]:
+        try:
+            return request("POST", endpoint, body, headers={"Content-Type": content_type}, compress=self.compress, timeout=self.request_timeout)
+        except Exception as e:
+            return (0, str(e))
+
+    def _post(self, pending: dict[tuple[str, str], dict[str, list[dict]]]):
+        self._count("flushes")
+        for ((endpoint, kind), records_by_service) in pending.items():
+            num_records = sum(len(records) for records in records_by_service.values())
+            payload = self.encoder.encode(kind, records_by_service)
+            content_type = self.encoder.content_type
+
+            if self.spool and self._next_replay is not None:
+                (status, body) = (0, "collector unavailable, awaiting replay")
+            else:
+                (status, body) = self._send(endpoint, payload, content_type)
+
+            if status == 200:
+                self._count("exported", num_records)
+                continue
+
+            if self.spool:
+                if self._next_replay is None:
+                    logging.warning(f"Could not post {num_records} {kind} to {endpoint}, spooling telemetry until the collector is back. Reason: {body}")
+                    self._next_replay = time.monotonic() + self._backoff
+                if self.spool.append(endpoint, kind, content_type, payload, num_records):
+                    continue
+                logging.error(f"Telemetry spool is full, dropping {num_records} {kind}")
+
+            self._count("failed", num_records)
+            logging.error(f"Could not post {num_records} {kind} to {endpoint}. Reason: {body}")
+
+    def _replay(self):
+        def post(endpoint: str, kind: str, content_type: str, payload: bytes) -> bool:
+            (status, body) = self._send(endpoint, payload, content_type)
+            if status != 200:
+                logging.warning(f"Could not replay spooled {kind} to {endpoint}, retrying in {min(self._backoff * 2, self.max_retry_interval):.0f}s. Reason: {body}")
+            return status == 200
+
+        result = self.spool.replay(post)
+        if result == "drained":
+            if self._next_replay is not None:
+                logging.info(f"Replayed spooled telemetry: {self.spool.counters}")
+            (self._next_replay, self._backoff) = (None, self.retry_interval)
+        elif result == "failed":
+            self._backoff = min(self._backoff * 2, self.max_retry_interval)
+            self._next_replay = time.monotonic() + self._backoff
+        elif self._next_replay is not None:
+            # Another process is replaying. Check back, as what this process spooled may be sealed after its replay started
+            self._next_replay = time.monotonic() + self._backoff
+
+_exporter: None|TelemetryExporter = None
+_exporter_lock = threading.Lock()
+
+def get_exporter() -> TelemetryExporter:
+    """Returns the process-wide exporter. It is flushed upon interpreter exit"""
+    global _exporter
+    with _exporter_lock:
+        if _exporter is None:
+            _exporter = TelemetryExporter()
+            atexit.register(_exporter.shutdown, 5)
+        return _exporter
+
+def set_telemetry_spool(path: str, max_bytes: int = 256 * 1024 * 1024, poll_interval: None|float = None):
+    """Spools telemetry of the process-wide exporter to path while the collector is unavailable,
+    and starts replaying whatever an earlier process left there. Given poll_interval, keeps replaying
+    what other processes sharing the spool leave there"""
+    exporter = get_exporter()
+    exporter.spool = TelemetrySpool(path, max_bytes)
+    exporter.spool_poll_interval = poll_interval
+    if poll_interval:
+        exporter._next_spool_poll = time.monotonic()
+    if exporter.spool.has_backlog():
+        exporter._next_replay = time.monotonic()
+    if poll_interval or exporter._next_replay is not None:
+        exporter._ensure_started()
+
+def test_telemetry_exporter_coalesces_records_pr_endpoint():
+    posted = []
+    exporter = TelemetryExporter(max_batch_size=100, flush_interval=60)
+    exporter._post = lambda pending: posted.append(pending)
+    for i in range(3):
+        exporter.submit("http://spans", "spans", "svc", {"i": i})
+    exporter.submit("http://logs", "logs", "svc", {"i": 3})
+    assert exporter.flush(5)
+    assert len(posted) == 1
+    assert len(posted[0][("http://spans", "spans")]["svc"]) == 3
+    assert len(posted[0][("http://logs", "logs")]["svc"]) == 1
+
+def test_telemetry_exporter_flushes_on_batch_size():
+    posted = []
+    exporter = TelemetryExporter(max_batch_size=2, flush_interval=60)
+    exporter._post = lambda pending: posted.append(pending)
+    for i in range(5):
+        exporter.submit("http://spans", "spans", "svc", {"i": i})
+    assert exporter.shutdown(5)
+    assert [len(p[("http://spans", "spans")]["svc"]) for p in posted] == [2, 2, 1]
+
+def test_telemetry_exporter_flush_after_shutdown_returns():
+    exporter = TelemetryExporter()
+    exporter._post = lambda pending: None
+    exporter.submit("http://spans", "spans", "svc", {})
+    assert exporter.shutdown(5)
+    assert exporter.flush()
+
+def test_telemetry_exporter_drops_when_full():
+    exporter = TelemetryExporter(max_queue_size=1)
+    exporter._ensure_started = lambda: None # No consumer: queue stays full
+    assert exporter.submit("http://spans", "spans", "svc", {})
+    assert not exporter.submit("http://spans", "spans", "svc", {})
+    assert exporter.stats()["dropped"] == 1
+
+def test_telemetry_exporter_spools_while_collector_is_down(tmp_path):
+    _RecordingHandler.received = []
+    httpd = server.ThreadingHTTPServer(("127.0.0.1", 0), _RecordingHandler)
+    port = httpd.server_address[1]
+    httpd.server_close() # Collector down
+    url = f"http://127.0.0.1:{port}/v1/traces"
+
+    exporter = TelemetryExporter(flush_interval=60, spool=TelemetrySpool(str(tmp_path)), retry_interval=0.05, max_retry_interval=0.2)
+    for i in range(3):
+        exporter.submit(url, "spans", "svc", {"i": i})
+        assert exporter.flush(5)
+    stats = exporter.stats()
+    assert (stats["exported"], stats["failed"], stats["spool_spooled"]) == (0, 0, 3)
+    assert stats["spool_backlog_records"] == 3
+
+    httpd = server.ThreadingHTTPServer(("127.0.0.1", port), _RecordingHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
     try:
-        with urq.urlopen(req) as response:
-            return (response.status, response.read().decode("utf-8"))
-    except error.HTTPError as e:
-        return (e.code, e.read().decode("utf-8"))
-    except error.URLError  as e:
-        return (0, e.reason)
+        deadline = time.monotonic() + 10
+        while exporter.stats()["spool_replayed"] < 3 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        exporter.submit(url, "spans", "svc", {"i": 3})
+        assert exporter.shutdown(5)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+    stats = exporter.stats()
+    assert (stats["exported"], stats["spool_replayed"], stats["spool_backlog_records"]) == (1, 3, 0)
+    # Spooled payloads arrive in order, before the ones exported after the collector came back
+    assert [json.loads(body)["resourceSpans"][0]["scopeSpans"][0]["spans"][0]["i"] for (_, _, body) in _RecordingHandler.received] == [0, 1, 2, 3]
+
+def test_telemetry_exporter_replays_what_other_processes_spool(tmp_path):
+    _RecordingHandler.received = []
+    httpd = server.ThreadingHTTPServer(("127.0.0.1", 0), _RecordingHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    exporter = TelemetryExporter(spool=TelemetrySpool(str(tmp_path)), spool_poll_interval=0.05)
+    exporter._ensure_started()
+    try:
+        # E.g. a build, which exited before the collector was back
+        build_spool = TelemetrySpool(str(tmp_path))
+        build_spool.append(f"http://127.0.0.1:{httpd.server_address[1]}/v1/logs", "logs", "application/json", b'{"i": 0}', 1)
+        build_spool.close()
+
+        deadline = time.monotonic() + 10
+        while exporter.stats()["spool_replayed"] < 1 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert exporter.shutdown(5)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+    assert [body for (_, _, body) in _RecordingHandler.received] == [b'{"i": 0}']
+
+class ConnectionPool:
+    """Thread-safe pool of keep-alive connections, keyed by scheme, host and port.
+
+    A connection is checked out for the duration of a single request, and returned to the pool afterwards
+    unless the server asked to close it. A request on a reused connection which turns out to have been
+    closed by the server is retried once on a fresh connection."""
+
+    def __init__(self, max_idle_per_host: int = 8):
+        self.max_idle_per_host = max_idle_per_host
+        self._idle: dict[tuple[str, str, int], list[http.client.HTTPConnection]] = {}
+        self._lock = threading.Lock()
+
+    def _checkout(self, key: tuple[str, str, int], timeout: None|float) -> tuple[http.client.HTTPConnection, bool]:
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                conn = idle.pop()
+                conn.timeout = timeout
+                if conn.sock:
+                    conn.sock.settimeout(timeout)
+                return (conn, True)
+
+        (scheme, host, port) = key
+        if scheme == "https":
+            return (http.client.HTTPSConnection(host, port, timeout=timeout), False)
+        return (http.client.HTTPConnection(host, port, timeout=timeout), False)
+
+    def _checkin(self, key: tuple[str, str, int], conn: http.client.HTTPConnection):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle_per_host:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, method: str, url: str, body: None|bytes = None, headers: dict = {}, timeout: None|float = None) -> tuple[int, bytes]:
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError(f"Unsupported URL: {url}")
+
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == "https" else 80))
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+
+        while True:
+            (conn, reused) = self._checkout(key, timeout)
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if reused:
+                    continue
+                raise
+            except:
+                conn.close()
+                raise
+
+            if response.will_close:
+                conn.close()
+            else:
+                self._checkin(key, conn)
+
+            return (response.status, data)
+
+    def close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+connection_pool = ConnectionPool()
+
+def request(method: Literal["GET", "POST", "PUT", "DELETE"], url, payload=None, headers={}, compress: bool = False, timeout: None|float = None) -> tuple[int, str|None]:
+    """Sends payload as JSON - or as is, if already encoded to bytes - optionally gzip'ed, over a pooled keep-alive
+    connection. Returns (0, reason) upon network errors"""
+    headers = dict(headers)
+    data = None
+    if payload:
+        data = payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")
+        if compress:
+            data = gzip.compress(data)
+            headers["Content-Encoding"] = "gzip"
+
+    try:
+        (status, body) = connection_pool.request(method, url, data, headers, timeout)
+        return (status, body.decode("utf-8"))
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        return (0, str(e))
+
+class _RecordingHandler(server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    received: list[tuple[int, dict, bytes]] = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        self.received.append((self.client_address[1], dict(self.headers), body))
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+def test_request_reuses_connection_and_supports_gzip():
+    _RecordingHandler.received = []
+    httpd = server.ThreadingHTTPServer(("127.0.0.1", 0), _RecordingHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    try:
+        url = f"http://127.0.0.1:{httpd.server_address[1]}/v1/traces"
+        assert request("POST", url, {"a": 1}) == (200, "ok")
+        assert request("POST", url, {"a": 2}, compress=True) == (200, "ok")
+        assert len(_RecordingHandler.received) == 2
+        # Same client port => same TCP connection
+        assert _RecordingHandler.received[0][0] == _RecordingHandler.received[1][0]
+        assert json.loads(_RecordingHandler.received[1][2]) == {"a": 2}
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+def test_request_reports_network_errors():
+    (status, reason) = request("GET", "http://127.0.0.1:1/")
+    assert status == 0
+    assert reason
 
 def utcnow() -> datetime.datetime:
     return datetime.datetime.now(tz=datetime.timezone.utc)
@@ -216,6 +1104,206 @@ def test_any_item_matches():
     assert any_item_matches(["some/path", "another/path"], "^another")
     assert not any_item_matches(["some/path"], "^another")
 
+def changeset_patterns(node) -> set[str]:
+    """Returns every 'if-changeset-matches' pattern of node and its sub nodes"""
+    patterns = {node["if-changeset-matches"]} if node.get("if-changeset-matches") else set()
+    for sub_node in node.get("steps", []) + [node[x] for x in ("setup", "teardown") if x in node]:
+        patterns |= changeset_patterns(sub_node)
+    return patterns
+
+def literal_prefix(pattern: str) -> None|str:
+    """Returns the prefix matched by pattern, if pattern only matches items starting with a literal string, e.g. '^src/'"""
+    if not pattern.startswith("^"):
+        return None
+
+    rest = pattern[1:].removesuffix(".*")
+    prefix = []
+    i = 0
+    while i < len(rest):
+        c = rest[i]
+        if c == "\\" and i + 1 < len(rest) and not rest[i + 1].isalnum():
+            prefix.append(rest[i + 1])
+            i += 2
+        elif c in ".^$*+?{}[]\\|()":
+            return None
+        else:
+            prefix.append(c)
+            i += 1
+    return "".join(prefix)
+
+def test_literal_prefix():
+    assert literal_prefix("^src/") == "src/"
+    assert literal_prefix(r"^docs/index\.md.*") == "docs/index.md"
+    assert literal_prefix("^") == ""
+    assert literal_prefix("src/") is None
+    assert literal_prefix("^src/.*\\.py$") is None
+    assert literal_prefix(r"^\d") is None
+
+def required_literal(pattern: str) -> None|str:
+    """Returns the longest literal string any item matched by pattern contains, e.g. '/tests/' of '^src/.*/tests/.*\\.py$'.
+    None if there is none to be sure of, e.g. due to alternation at the top level or flags"""
+    runs = [[]]
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\" and i + 1 < len(pattern):
+            if pattern[i + 1].isalnum():
+                # A class such as \d, or an escape such as \n - neither is kept
+                runs.append([])
+            elif depth == 0:
+                runs[-1].append(pattern[i + 1])
+            i += 2
+            continue
+
+        if c == "[":
+            # Skip the set: ']' is literal first in it, and may be escaped
+            i += 2 if pattern[i + 1:i + 2] == "^" else 1
+            i += 1 if pattern[i:i + 1] == "]" else 0
+            while i < len(pattern) and pattern[i] != "]":
+                i += 2 if pattern[i] == "\\" else 1
+            runs.append([])
+        elif c == "(":
+            if pattern[i + 1:i + 2] == "?" and pattern[i + 2:i + 3].isalpha():
+                # Inline flags, e.g. '(?i)'
+                return None
+            depth += 1
+            runs.append([])
+        elif c == ")":
+            depth -= 1
+            runs.append([])
+        elif c == "|" and depth == 0:
+            return None
+        elif c in "?*{" and depth == 0:
+            # The preceding character is optional
+            if runs[-1]:
+                runs[-1].pop()
+            runs.append([])
+        elif c in ".^$+|":
+            runs.append([])
+        elif depth == 0:
+            runs[-1].append(c)
+        i += 1
+
+    longest = max(runs, key=len)
+    return "".join(longest) if longest else None
+
+def test_required_literal():
+    assert required_literal(r"/c1/.*\.py$") == "/c1/"
+    assert required_literal(r"\.md$") == ".md"
+    assert required_literal("^src/(a|b)/tests?/") == "/test"
+    assert required_literal("docs?/index") == "/index"
+    assert required_literal("ab+cde") == "cde"
+    assert required_literal(r"[]x]\dyy[^\]z]") == "yy"
+    assert required_literal("src/|docs/") is None
+    assert required_literal("(?i)readme") is None
+    assert required_literal(r"\d+") is None
+
+class ChangesetMatcher:
+    """Decides up front for every 'if-changeset-matches' pattern of a pipeline whether any item of the changeset matches it.
+
+    Patterns only matching a literal prefix (e.g. '^src/') are looked up in a prefix trie, in a single pass over
+    the changeset costing the length of each item rather than the number of patterns. Other patterns are indexed by a
+    literal string they require (see required_literal()): all of these are combined into one alternation, searched
+    for once pr item, and only the patterns whose literal the item contains are matched against it. Combining the
+    patterns themselves is far slower with the backtracking re module. Any remaining pattern is searched for until its
+    first match. Behaves as any_item_matches() pr pattern."""
+
+    def __init__(self, pipeline, changeset: list[str]):
+        self.changeset_size = len(changeset)
+        self.matching: set[str] = set()
+        if not changeset:
+            return
+
+        # Trie of the literal prefixes: nested dicts keyed by character, with the patterns ending at a node under None
+        trie: dict = {}
+        prefixes_left = 0
+        # <required literal>: the patterns requiring it
+        by_literal: dict[str, list[re.Pattern]] = {}
+        for pattern in changeset_patterns(pipeline):
+            prefix = literal_prefix(pattern)
+            if prefix is None:
+                compiled = re.compile(pattern)
+                literal = required_literal(pattern)
+                if literal is not None:
+                    by_literal.setdefault(literal, []).append(compiled)
+                elif any(map(compiled.search, changeset)):
+                    self.matching.add(pattern)
+                continue
+
+            node = trie
+            for c in prefix:
+                node = node.setdefault(c, {})
+            node.setdefault(None, []).append(pattern)
+            prefixes_left += 1
+
+        for change in changeset:
+            if not prefixes_left:
+                break
+
+            node = trie
+            for c in change:
+                if None in node:
+                    prefixes_left -= self._resolve(node.pop(None))
+                node = node.get(c)
+                if node is None:
+                    break
+            else:
+                if None in node:
+                    prefixes_left -= self._resolve(node.pop(None))
+
+        self._match_literals(by_literal, changeset)
+
+    def _match_literals(self, by_literal: dict[str, list[re.Pattern]], changeset: list[str]):
+        # Literals of patterns since matched stay in the alternation until an item only contains those
+        stale = 0
+        candidates = None
+        for change in changeset:
+            if not by_literal:
+                return
+            if candidates is None:
+                candidates = re.compile("|".join(map(re.escape, sorted(by_literal, key=len, reverse=True))))
+                stale = 0
+            if candidates.search(change) is None:
+                continue
+
+            matched = False
+            for literal in [literal for literal in by_literal if literal in change]:
+                patterns = by_literal[literal]
+                for compiled in [compiled for compiled in patterns if compiled.search(change)]:
+                    self.matching.add(compiled.pattern)
+                    patterns.remove(compiled)
+                    matched = True
+                if not patterns:
+                    del by_literal[literal]
+                    stale += 1
+            if not matched and stale:
+                candidates = None
+
+    def _resolve(self, patterns: list[str]) -> int:
+        self.matching.update(patterns)
+        return len(patterns)
+
+    def matches(self, match_criteria: None|str, default=True) -> bool:
+        if self.changeset_size == 0 or not match_criteria:
+            return default
+        return match_criteria in self.matching
+
+def test_changeset_matcher_agrees_with_any_item_matches():
+    steps = [{"name": str(i), "if-changeset-matches": p, "exec": "true"} for (i, p) in enumerate(["^src/", "^src/a", r"\.md$", "^none", "a", r"/tests?/.*\.py$", r"\.(c|h)$", "x|y"])]
+    pipeline = {"name": "root", "steps": steps, "setup": {"name": "setup", "if-changeset-matches": "^doc", "exec": "true"}}
+    for changeset in ([], ["src/a.py"], ["doc/x.md", "b"], ["x"]):
+        matcher = ChangesetMatcher(pipeline, changeset)
+        for pattern in changeset_patterns(pipeline) | {None}:
+            assert matcher.matches(pattern) == any_item_matches(changeset, pattern), (changeset, pattern)
+
+def test_changeset_matcher_of_prefixes_and_other_patterns():
+    patterns = ["^src/", "^docs/", r"/c1/.*\.py$", r"/c2/.*\.py$", r"/c1/.*\.md$", r"\.(c|h)$", "^build/|^ci/"]
+    pipeline = {"name": "root", "order": "unordered", "steps": [{"name": str(i), "if-changeset-matches": p, "exec": "true"} for (i, p) in enumerate(patterns)]}
+    changeset = ["src/c1/a.py", "lib/c1/b.py", "lib/c1/c.py", "lib/c2/d.txt", "ci/run.sh", "lib/x.h"]
+    matcher = ChangesetMatcher(pipeline, changeset)
+    assert [p for p in patterns if matcher.matches(p)] == ["^src/", r"/c1/.*\.py$", r"\.(c|h)$", "^build/|^ci/"]
+
 def job_argparse(pipeline_name:str):
     parser = argparse.ArgumentParser(
                     prog = pipeline_name,
@@ -231,6 +1319,22 @@ def job_argparse(pipeline_name:str):
     parser.add_argument("-t", "--traces-endpoint", type=str, action="store", default="http://localhost:4318/v1/traces", help="")
     parser.add_argument("-l", "--logs-endpoint", type=str, action="store", default="http://localhost:4318/v1/logs", help="")
     # parser.add_argument("-f", "--force", action="store_true", default=False, help="Will force build all steps")
+    parser.add_argument("-z", "--compress-telemetry", action="store_true", default=False, help="gzip telemetry payloads posted to the otel collector")
+    parser.add_argument("--telemetry-encoding", choices=["json", "protobuf"], default=os.environ.get("BASS_TELEMETRY_ENCODING", "json"), help="Encoding of telemetry payloads posted to the otel collector. Default: $BASS_TELEMETRY_ENCODING or json")
+    parser.add_argument("--timeout", type=float, action="store", default=None, help="Seconds before the entire pipeline is cancelled")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default=os.environ.get("BASS_ENGINE", "threads"), help="Run steps in threads, or as tasks of a single asyncio event loop. Default: $BASS_ENGINE or threads")
+    parser.add_argument("-p", "--max-parallel", type=int, action="store", default=int(os.environ.get("BASS_MAX_PARALLEL", 0)) or default_max_parallel(), help=f"Max number of steps executing at once, across the entire pipeline. Default: $BASS_MAX_PARALLEL or the number of CPUs, at least {MIN_DEFAULT_PARALLEL}")
+    parser.add_argument("--cpu-budget", type=float, action="store", default=float(os.environ.get("BASS_CPU_BUDGET", 0)) or None, help="CPUs shared by concurrently executing steps of this build, as claimed by their 'resources'. Default: $BASS_CPU_BUDGET or the number of CPUs available")
+    parser.add_argument("--mem-budget", type=parse_size, action="store", default=parse_size(os.environ.get("BASS_MEM_BUDGET", "0")) or None, help="Memory (e.g. 16G) shared by concurrently executing steps of this build, as claimed by their 'resources'. Default: $BASS_MEM_BUDGET or the memory available")
+    parser.add_argument("-o", "--output-mode", choices=["streaming", "buffered"], default="streaming", help="Whether step output is logged while the step runs, or once it has finished")
+    parser.add_argument("--max-step-output", type=int, action="store", default=64 * 1024 * 1024, help="Max bytes of output to log pr step in streaming mode")
+    parser.add_argument("--output-spill-dir", type=str, action="store", default=None, help="Folder to write step output exceeding --max-step-output to. Discarded if not set")
+    parser.add_argument("--cache-dir", type=str, action="store", default=os.environ.get("BASS_CACHE_DIR"), help="Directory caching results of steps declaring 'inputs'. Default: $BASS_CACHE_DIR. No caching if unset")
+    parser.add_argument("--cache-max-size", type=parse_size, action="store", default=parse_size("1G"), help="Size (e.g. 1G) of the step cache, before the least recently used results are evicted")
+    parser.add_argument("--history-file", type=str, action="store", default=os.environ.get("BASS_HISTORY_FILE"), help="File recording step durations of past builds, used to estimate --plan. Default: $BASS_HISTORY_FILE. Not recorded if unset")
+    parser.add_argument("--telemetry-spool", type=str, action="store", default=os.environ.get("BASS_TELEMETRY_SPOOL"), help="Folder to spool telemetry to while the otel collector is unavailable, to be replayed later. Default: $BASS_TELEMETRY_SPOOL. Dropped if unset")
+    parser.add_argument("--telemetry-spool-max-size", type=parse_size, action="store", default=parse_size(os.environ.get("BASS_TELEMETRY_SPOOL_MAX_SIZE", "256M")), help="Size (e.g. 256M) of the telemetry spool, beyond which telemetry is dropped")
+    parser.add_argument("--plan", action="store_true", help="Only print which steps would run given the changeset, and the estimated wall time. Executes nothing")
     parser.add_argument("-c", "--changeset", type=str, action="store", default=None, help="Path to file with list of modified files, allows steps to be conditionally executed")
     
     return parser.parse_args()
@@ -248,6 +1352,25 @@ def assert_pipeline(node) -> bool:
     if "exec" in node:
         assert type(node["exec"]) == list or type(node["exec"]) == str
 
+    if "fail-fast" in node:
+        assert type(node["fail-fast"]) == bool
+
+    if "inputs" in node or "outputs" in node:
+        assert "exec" in node, f"Only exec steps can declare inputs and outputs: {node['name']}"
+        assert type(node.get("inputs", {})) == dict
+        assert set(node.get("inputs", {}).keys()) <= {"files", "env"}, f"Unknown inputs for step: {node['name']}"
+        assert all(type(x) == list for x in node.get("inputs", {}).values())
+        assert type(node.get("outputs", [])) == list
+
+    if "timeout" in node:
+        assert float(node["timeout"]) > 0
+
+    if "resources" in node:
+        assert type(node["resources"]) == dict
+        assert set(node["resources"].keys()) <= {"cpu", "mem"}, f"Unknown resources for step: {node['name']}"
+        assert float(node["resources"].get("cpu", 1)) > 0
+        assert parse_size(node["resources"].get("mem", 0)) >= 0
+
     if "steps" in node:
         assert type(node["steps"]) == list
         assert len(node["steps"]) > 0
@@ -255,31 +1378,428 @@ def assert_pipeline(node) -> bool:
         for step in node["steps"]:
             assert_pipeline(step)
 
-def exec_step(io: IoContext, step) -> tuple[ExecStatus, str, str]:
-    """Returns tuple of (status, stdout, stderr)"""
+        if any("needs" in step for step in node["steps"]):
+            assert_step_graph(node)
+
+def assert_step_graph(node):
+    """Asserts that 'needs' of the steps of node only refers to uniquely named siblings, without cycles"""
+    assert node.get("order", "unordered") == "unordered", f"'needs' is not supported for ordered steps: {node['name']}"
+
+    names = [step["name"] for step in node["steps"]]
+    assert len(set(names)) == len(names), f"Steps with 'needs' must have unique names: {node['name']}"
+
+    for step in node["steps"]:
+        needs = step.get("needs", [])
+        assert type(needs) == list
+        for need in needs:
+            assert need in names and need != step["name"], f"Step '{step['name']}' needs unknown step: {need}"
+
+    # Kahn's algorithm: every step must eventually have all its needs fulfilled
+    remaining = {step["name"]: set(step.get("needs", [])) for step in node["steps"]}
+    while remaining:
+        ready = [name for (name, needs) in remaining.items() if not needs]
+        assert ready, f"Cyclic 'needs' between steps: {', '.join(sorted(remaining))}"
+        for name in ready:
+            del remaining[name]
+        for needs in remaining.values():
+            needs.difference_update(ready)
+
+def step_command(step) -> None|list[str]:
+    """Returns the command of an exec step with variables resolved, or None if its type is unknown"""
+    cmd = None
+    if type(step["exec"]) == str:
+        cmd = [step["exec"]]
+
+    if type(step["exec"]) == list:
+        cmd = step["exec"]
+
+    if not cmd:
+        return None
+    return [os.path.expandvars(v) for v in cmd]
+
+def exec_step(io: IoContext, step, on_output: None|Callable[[OutputStream, str], None] = None, cancel: None|CancelToken = None, on_usage: None|Callable[[dict[str, int|float]], None] = None) -> tuple[ExecStatus, str, str]:
+    """Returns tuple of (status, stdout, stderr). If on_output is provided, output is streamed to it instead, and stdout/stderr are empty.
+    The resource usage of the step is passed on to on_usage"""
     timeout = step["timeout"] if "timeout" in step else None
     try:
-        cmd = None
-        if type(step["exec"]) == str:
-            cmd = [step["exec"]]
-
-        if type(step["exec"]) == list:
-            cmd = step["exec"]
-        
-        if not cmd:
-            logging.error(f"Unknown command type: {type(exec["step"])}")
-            return (ExecStatus.UNKNOWN, "", f"Unknown command type: {type(exec["step"])}")
-        
-        # Resolve variables in cmd and execute
-        cmd_expanded = [os.path.expandvars(v) for v in cmd]
-        (returncode, stdout, stderr) = io.run(cmd_expanded, timeout=timeout)
+        cmd_expanded = step_command(step)
+        if not cmd_expanded:
+            logging.error(f"Unknown command type: {type(step["exec"])}")
+            return (ExecStatus.UNKNOWN, "", f"Unknown command type: {type(step["exec"])}")
+
+        if on_output:
+            (returncode, stdout, stderr) = (io.run_streaming(cmd_expanded, timeout=timeout, on_output=on_output, cancel=cancel, on_usage=on_usage), "", "")
+        else:
+            (returncode, stdout, stderr) = io.run(cmd_expanded, timeout=timeout, cancel=cancel, on_usage=on_usage)
+
+        # Unless it completed before being killed
+        if cancel and cancel.is_cancelled() and returncode != 0:
+            return (ExecStatus.CANCELLED, stdout, stderr)
         return (ExecStatus.OK if returncode == 0 else ExecStatus.ERROR, stdout, stderr)
     except subprocess.TimeoutExpired as e:
-        return (ExecStatus.TIMEOUT, e.output, str(e))
+        output = e.output.decode(errors="replace") if isinstance(e.output, bytes) else (e.output or "")
+        return (ExecStatus.TIMEOUT, output, str(e))
+
+
+def parse_size(size: int|float|str) -> int:
+    """Parses sizes such as 512, "512M" or "4G" (powers of 1024) to bytes"""
+    if type(size) != str:
+        return int(size)
+
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    size = size.strip().upper().removesuffix("B").removesuffix("I")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+def test_parse_size():
+    assert parse_size(512) == 512
+    assert parse_size("512") == 512
+    assert parse_size("2K") == 2048
+    assert parse_size("1.5G") == int(1.5 * 1024 ** 3)
+    assert parse_size("4GiB") == 4 * 1024 ** 3
+
+# Unordered steps ran 5 at a time before the scheduler was shared by the entire pipeline. Never less by default
+MIN_DEFAULT_PARALLEL = 5
+
+def default_max_parallel() -> int:
+    return max(MIN_DEFAULT_PARALLEL, detect_cpus())
+
+def detect_cpus() -> int:
+    """Number of CPUs this process may run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def detect_available_memory() -> None|int:
+    """Bytes of memory available for new processes, or None if unknown"""
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
 
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+class ResourcePool:
+    """Machine-wide budget of resources (e.g. slots, cpu, mem) shared by concurrently executing steps.
+
+    acquire() blocks until the requested amount of every resource is available. Requests exceeding the budget
+    are reduced to the budget, so they run alone rather than never. To not starve large requests, the oldest
+    waiting request has its amounts reserved: later requests may only use what is left beyond it."""
+
+    def __init__(self, budget: dict[str, float]):
+        self.budget = dict(budget)
+        self._available = dict(budget)
+        self._waiting: list[dict[str, float]] = []
+        self._changed = threading.Condition()
+
+    def _clamp(self, request: dict[str, float]) -> dict[str, float]:
+        return {k: min(v, self.budget[k]) for (k, v) in request.items() if k in self.budget}
+
+    def _fits(self, request: dict[str, float]) -> bool:
+        reserved = self._waiting[0] if self._waiting and self._waiting[0] is not request else {}
+        return all(v <= self._available[k] - reserved.get(k, 0) for (k, v) in request.items())
+
+    def acquire(self, request: dict[str, float]) -> dict[str, float]:
+        """Blocks until request can be granted. Returns what was granted, to be passed to release()"""
+        request = self._clamp(request)
+        with self._changed:
+            self._waiting.append(request)
+            while not self._fits(request):
+                self._changed.wait()
+            # Identical requests may be waiting: remove by identity
+            self._waiting = [r for r in self._waiting if r is not request]
+            for (k, v) in request.items():
+                self._available[k] -= v
+            self._changed.notify_all()
+        return request
+
+    def release(self, granted: dict[str, float]):
+        with self._changed:
+            for (k, v) in granted.items():
+                self._available[k] += v
+            self._changed.notify_all()
+
+    def available(self) -> dict[str, float]:
+        with self._changed:
+            return dict(self._available)
+
+def test_resource_pool_clamps_and_reserves_for_oldest_request():
+    pool = ResourcePool({"cpu": 4})
+    assert pool.acquire({"cpu": 8}) == {"cpu": 4}
+    pool.release({"cpu": 4})
+
+    small = pool.acquire({"cpu": 1})
+    order = []
+    big = threading.Thread(target=lambda: (pool.acquire({"cpu": 4}), order.append("big"), pool.release({"cpu": 4})))
+    big.start()
+    while not pool._waiting:
+        time.sleep(0.001)
+    # 3 cpus are free, but reserved for the big request
+    later = threading.Thread(target=lambda: (pool.acquire({"cpu": 1}), order.append("later"), pool.release({"cpu": 1})))
+    later.start()
+    time.sleep(0.05)
+    assert order == []
+    pool.release(small)
+    big.join()
+    later.join()
+    assert order == ["big", "later"]
+
+class Scheduler:
+    """Shared by all nodes of a build. Limits which steps execute at once across all nesting levels - by count
+    and by their declared resources - runs sibling steps as soon as the steps they need have succeeded, and
+    records how long each step took.
+
+    Exec steps of a graph are only started once their slot is acquired, on one of at most max_parallel threads
+    shared by the entire build. Steps holding steps of their own wait for those, in a thread of their own"""
+
+    def __init__(self, max_parallel: None|int = None, cpus: None|float = None, mem: None|int = None):
+        max_parallel = max_parallel or default_max_parallel()
+        self.max_parallel = max_parallel
+        budget = {"slots": max_parallel, "cpu": cpus or detect_cpus()}
+        mem = mem or detect_available_memory()
+        if mem:
+            budget["mem"] = mem
+        self.resources = ResourcePool(budget)
+        self._lock = threading.Lock()
+        # id(node): seconds spent executing
+        self._durations: dict[int, float] = {}
+        # id(node): (result, whether restored from the cache) of exec steps
+        self._results: dict[int, tuple[ExecStatus, bool]] = {}
+        # id(node): resources acquired by reserve(), to be used by slot()
+        self._reserved: dict[int, dict[str, float]] = {}
+        self._executor: None|ThreadPoolExecutor = None
+
+    @staticmethod
+    def resource_request(node) -> dict[str, float]:
+        """Resources claimed by node while executing. Steps not declaring resources only claim a slot"""
+        resources = node.get("resources", {})
+        return {
+            "slots": 1,
+            "cpu": float(resources.get("cpu", 0)),
+            "mem": parse_size(resources.get("mem", 0)),
+        }
+
+    def reserve(self, node):
+        """Acquires the execution slot and resources of node ahead of executing it"""
+        granted = self.resources.acquire(self.resource_request(node))
+        with self._lock:
+            self._reserved[id(node)] = granted
+
+    def unreserve(self, node):
+        """Releases what was reserved for node, unless taken by slot(node) - e.g. as node was cancelled"""
+        with self._lock:
+            granted = self._reserved.pop(id(node), None)
+        if granted is not None:
+            self.resources.release(granted)
+
+    @contextmanager
+    def slot(self, node):
+        """Holds an execution slot and the resources declared by node while executing it, and records its duration"""
+        with self._lock:
+            granted = self._reserved.pop(id(node), None)
+        if granted is None:
+            granted = self.resources.acquire(self.resource_request(node))
+        time_start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._durations[id(node)] = time.monotonic() - time_start
+            self.resources.release(granted)
+
+    def duration(self, node) -> None|float:
+        """Seconds spent executing node. None if it wasn't executed"""
+        with self._lock:
+            return self._durations.get(id(node))
+
+    def record_result(self, node, result: ExecStatus, cache_hit: bool):
+        with self._lock:
+            self._results[id(node)] = (result, cache_hit)
+
+    def ran_ok(self, node) -> bool:
+        """Whether node was executed - not restored from the cache - and succeeded"""
+        with self._lock:
+            return self._results.get(id(node)) == (ExecStatus.OK, False)
+
+    def close(self):
+        """Stops the threads shared by exec steps"""
+        with self._lock:
+            (executor, self._executor) = (self._executor, None)
+        if executor:
+            executor.shutdown()
+
+    def _submit(self, fn: Callable, *args):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_parallel, thread_name_prefix="bass-step")
+            executor = self._executor
+        executor.submit(fn, *args)
+
+    def run_graph(self, steps: list[dict], run: Callable[[dict], ExecStatus]) -> list[None|ExecStatus]:
+        """Runs every step as soon as all steps it needs have succeeded. Returns the result of each step,
+        or None for steps skipped due to a failed dependency"""
+        index = {step["name"]: i for (i, step) in enumerate(steps)}
+        remaining_needs = [len(step.get("needs", [])) for step in steps]
+        dependents: list[list[int]] = [[] for _ in steps]
+        for (i, step) in enumerate(steps):
+            for need in step.get("needs", []):
+                dependents[index[need]].append(i)
+
+        results: list[None|ExecStatus] = [None] * len(steps)
+        finished = queue.Queue()
+
+        def run_step(i: int):
+            try:
+                result = run(steps[i])
+            except Exception as e:
+                logging.exception("Failure running step '%s': %s", steps[i]["name"], e)
+                result = ExecStatus.ERROR
+            finally:
+                self.unreserve(steps[i])
+            finished.put((i, result))
+
+        def start(i: int):
+            step = steps[i]
+            if "exec" in step and "setup" not in step and "teardown" not in step:
+                # Holds its slot from here on, so never waits for one on a shared thread
+                self.reserve(step)
+                self._submit(run_step, i)
+            else:
+                threading.Thread(target=run_step, args=(i,), name=f"bass-step-{step['name']}").start()
+
+        running = 0
+        for (i, count) in enumerate(remaining_needs):
+            if count == 0:
+                start(i)
+                running += 1
+
+        while running > 0:
+            (i, result) = finished.get()
+            running -= 1
+            results[i] = result
+            if result != ExecStatus.OK:
+                continue
+
+            for j in dependents[i]:
+                remaining_needs[j] -= 1
+                if remaining_needs[j] == 0:
+                    start(j)
+                    running += 1
+
+        return results
+
+def is_step_graph(node) -> bool:
+    return node.get("order") == "unordered" or any("needs" in step for step in node["steps"])
+
+def critical_path(node, duration_of: Callable[[dict], None|float], prefix: str = "") -> tuple[float, list[str]]:
+    """Returns the duration and the steps of the longest chain of exec-steps through node, given the
+    duration of each exec-step. Steps of unknown duration (e.g. skipped) are left out"""
+    path = f"{prefix}{node['name']}"
+    chain: list[tuple[float, list[str]]] = []
 
-def build_inner(io: IoContext, args, node, parent_span_id, changeset) -> ExecStatus:
+    if "setup" in node:
+        chain.append(critical_path(node["setup"], duration_of, f"{path}/"))
+
+    if "exec" in node:
+        duration = duration_of(node)
+        if duration is not None:
+            chain.append((duration, [path]))
+    elif "steps" in node:
+        children = [critical_path(step, duration_of, f"{path}/") for step in node["steps"]]
+        if is_step_graph(node):
+            # Longest path through the graph, in dependency order
+            index = {step["name"]: i for (i, step) in enumerate(node["steps"])}
+            finish: dict[int, tuple[float, list[str]]] = {}
+            def finish_of(i: int) -> tuple[float, list[str]]:
+                if i not in finish:
+                    before = max((finish_of(index[need]) for need in node["steps"][i].get("needs", [])), default=(0.0, []), key=lambda x: x[0])
+                    finish[i] = (before[0] + children[i][0], before[1] + children[i][1])
+                return finish[i]
+            chain.append(max((finish_of(i) for i in range(len(children))), key=lambda x: x[0]))
+        else:
+            chain.extend(children)
+
+    if "teardown" in node:
+        chain.append(critical_path(node["teardown"], duration_of, f"{path}/"))
+
+    return (sum(duration for (duration, _) in chain), [step for (_, steps) in chain for step in steps])
+
+def exec_steps(node, prefix: str = "") -> list[tuple[str, dict]]:
+    """Returns (path, node) of every exec-step in node, as named by critical_path()"""
+    path = f"{prefix}{node['name']}"
+    if "exec" in node:
+        steps = [(path, node)]
+    else:
+        steps = [x for step in node.get("steps", []) for x in exec_steps(step, f"{path}/")]
+    for sub_node in [node[x] for x in ("setup", "teardown") if x in node]:
+        steps += exec_steps(sub_node, f"{path}/")
+    return steps
+
+def plan(pipeline, changeset: ChangesetMatcher, estimate: Callable[[str], None|float], max_parallel: int) -> str:
+    """Returns a report of which exec-steps would run, and the estimated wall time given the expected duration of each
+    step path. Assumes every step succeeds"""
+    will_run = {}
+    def visit(node, runs: bool):
+        runs = runs and changeset.matches(node.get("if-changeset-matches", None))
+        will_run[id(node)] = runs
+        for sub_node in node.get("steps", []) + [node[x] for x in ("setup", "teardown") if x in node]:
+            visit(sub_node, runs)
+    visit(pipeline, True)
+
+    lines = []
+    estimates = {}
+    for (path, node) in exec_steps(pipeline):
+        if not will_run[id(node)]:
+            lines.append(f"skip  {path}")
+            continue
+        estimates[id(node)] = estimate(path)
+        lines.append(f"run   {path}" + (f"  ~{estimates[id(node)]:.1f}s" if estimates[id(node)] is not None else "  (no history)"))
+
+    (critical_duration, critical_steps) = critical_path(pipeline, lambda node: estimates.get(id(node)))
+    step_time = sum(x for x in estimates.values() if x is not None)
+    lines.append(f"{len(estimates)} of {len(exec_steps(pipeline))} steps would run, {step_time:.1f}s of step time")
+    lines.append(f"Estimated wall time: at least {max(critical_duration, step_time / max_parallel):.1f}s with up to {max_parallel} steps in parallel")
+    lines.append(f"Critical path ({critical_duration:.1f}s): {' > '.join(critical_steps)}")
+    unknown = sum(x is None for x in estimates.values())
+    if unknown:
+        lines.append(f"Not estimated: {unknown} steps without history")
+    return "\n".join(lines)
+
+def test_plan_estimates_from_history():
+    pipeline = {"name": "root", "order": "unordered", "steps": [
+        {"name": "build", "exec": "build.sh"},
+        {"name": "test", "needs": ["build"], "exec": "test.sh"},
+        {"name": "lint", "exec": "lint.sh"},
+        {"name": "docs", "if-changeset-matches": "^docs/", "exec": "docs.sh"},
+        {"name": "new", "exec": "new.sh"},
+    ]}
+    history = {"root/build": 10.0, "root/test": 5.0, "root/lint": 8.0, "root/docs": 100.0}
+    report = plan(pipeline, ChangesetMatcher(pipeline, ["src/main.c"]), history.get, max_parallel=2)
+    assert "skip  root/docs" in report
+    assert "run   root/build  ~10.0s" in report
+    assert "run   root/new  (no history)" in report
+    assert "4 of 5 steps would run, 23.0s of step time" in report
+    assert "Estimated wall time: at least 15.0s" in report
+    assert "Critical path (15.0s): root/build > root/test" in report
+
+def build_inner(io: IoContext, args, node, parent_span_id, changeset: list[str]|ChangesetMatcher, scheduler: None|Scheduler = None, cancel: None|CancelToken = None, cache: None|StepCache = None) -> ExecStatus:
     # Check node: if exec: execute directly. If steps: recurse.
+    owns_scheduler = scheduler is None
+    if scheduler is None:
+        scheduler = Scheduler(args.max_parallel, args.cpu_budget, args.mem_budget)
+    if cancel is None:
+        cancel = CancelToken()
+
+    if not isinstance(changeset, ChangesetMatcher):
+        changeset = ChangesetMatcher(node, changeset)
+
     time_step_start = utcnow()
     span_id = generate_span_id()
     aggregated_result = ExecStatus.OK
@@ -289,11 +1809,33 @@ def build_inner(io: IoContext, args, node, parent_span_id, changeset) -> ExecSta
 
     skip_all = False
     skip_remaining_steps = False
+    cache_hit = False
+    # Resource usage of exec steps, as span attributes
+    usage = {}
 
-    if not any_item_matches(changeset, node.get("if-changeset-matches", None)):
+    if not changeset.matches(node.get("if-changeset-matches", None)):
         spanner(f"step:{node['name']} - skipped", parent_span_id, span_id, utcnow(), utcnow(), 0)
         return ExecStatus.OK
 
+    if cancel.is_cancelled():
+        spanner(f"step:{node['name']} - cancelled", parent_span_id, span_id, utcnow(), utcnow(), exec_status_to_otel[ExecStatus.CANCELLED.value])
+        return ExecStatus.CANCELLED
+
+    # Steps of the node are cancelled upon timeout of the node, or upon the first failure if fail-fast.
+    # Setup and teardown are only cancelled along with the parent
+    steps_cancel = cancel
+    timeout_timer = None
+    if "steps" in node and ("timeout" in node or node.get("fail-fast", False)):
+        steps_cancel = CancelToken(cancel)
+        if "timeout" in node:
+            timeout_timer = steps_cancel.cancel_after(float(node["timeout"]), on_start=True)
+
+    def build_step(step) -> ExecStatus:
+        step_result = build_inner(io, args, step, span_id, changeset, scheduler, steps_cancel, cache)
+        if node.get("fail-fast", False) and step_result not in (ExecStatus.OK, ExecStatus.CANCELLED):
+            steps_cancel.cancel(f"fail-fast: step '{step['name']}' failed")
+        return step_result
+
     initial_cwd = io.getcwd()
     if "cwd" in node:
         logging.info(f"Changing chdir to: {os.getcwd()}")
@@ -308,22 +1850,47 @@ def build_inner(io: IoContext, args, node, parent_span_id, changeset) -> ExecSta
         io.chdir(assumed_dir)
 
     if not skip_all and "setup" in node:
-        step_result = build_inner(io, args, node["setup"], span_id, changeset)
+        step_result = build_inner(io, args, node["setup"], span_id, changeset, scheduler, cancel, cache)
         if step_result != ExecStatus.OK:
             skip_remaining_steps = True
 
-        if step_result.value > aggregated_result.value:
-            aggregated_result = step_result
+        aggregated_result = worst_status(aggregated_result, step_result)
 
     if not skip_all and not skip_remaining_steps:
         if "exec" in node:
+            on_output = None
+            if args.output_mode == "streaming":
+                on_output = lambda stream, text: logger(span_id, "ERROR" if stream == "stderr" else "INFO", text)
+
+            cache_key = None
+            if cache and "inputs" in node:
+                try:
+                    cache_key = step_cache_key(node, io.getcwd())
+                except OSError as e:
+                    logger(span_id, "WARN", f"Could not hash inputs, not using cache: {e}")
+
+            cache_hit = cache_key is not None and cache.restore(cache_key, io.getcwd())
+
             try:
-                (step_result, step_stdout, step_stderr) = exec_step(io, node)
+                with scheduler.slot(node):
+                    if cache_hit:
+                        (step_result, step_stdout, step_stderr) = (ExecStatus.OK, "", "")
+                    elif cancel.is_cancelled():
+                        (step_result, step_stdout, step_stderr) = (ExecStatus.CANCELLED, "", "")
+                    else:
+                        cancel.start()
+                        (step_result, step_stdout, step_stderr) = exec_step(io, node, on_output, cancel, usage.update)
             except Exception as e:
                 (step_result, step_stdout, step_stderr) = (ExecStatus.ERROR, "", str(e))
+            scheduler.record_result(node, step_result, cache_hit)
 
-            if step_result.value > aggregated_result.value:
-                aggregated_result = step_result
+            aggregated_result = worst_status(aggregated_result, step_result)
+
+            if cache_key and not cache_hit and step_result == ExecStatus.OK:
+                try:
+                    cache.store(cache_key, io.getcwd(), node.get("outputs", []))
+                except OSError as e:
+                    logger(span_id, "WARN", f"Could not store result in cache: {e}")
 
             if len(step_stderr) > 0:
                 logger(span_id, "ERROR", step_stderr)
@@ -331,43 +1898,81 @@ def build_inner(io: IoContext, args, node, parent_span_id, changeset) -> ExecSta
             if len(step_stdout) > 0:
                 logger(span_id, "INFO", step_stdout)
         elif "steps" in node:
-            if "order" in node and node["order"] == "unordered":
-                # TODO: Make num workers configurable
-                # TODO: Make threadpool respect timeout?
-                with ThreadPoolExecutor(max_workers=5) as executor:
-                    futures = []    
-                    for step in node["steps"]:
-                        futures.append(executor.submit(build_inner, io, args, step, span_id, changeset))
-
-                    for f in futures:
-                        step_result = f.result()
-                        if step_result.value > aggregated_result.value:
-                            aggregated_result = step_result
+            if is_step_graph(node):
+                results = scheduler.run_graph(node["steps"], build_step)
+                for (step, step_result) in zip(node["steps"], results):
+                    if step_result is None and steps_cancel.is_cancelled():
+                        spanner(f"step:{step['name']} - cancelled", span_id, generate_span_id(), utcnow(), utcnow(), exec_status_to_otel[ExecStatus.CANCELLED.value])
+                    elif step_result is None:
+                        # A step it needs failed
+                        spanner(f"step:{step['name']} - skipped", span_id, generate_span_id(), utcnow(), utcnow(), 0)
+                    else:
+                        aggregated_result = worst_status(aggregated_result, step_result)
             else:
                 for i, step in enumerate(node["steps"]):
                     if not skip_remaining_steps:
-                        step_result = build_inner(io, args, step, span_id, changeset)
-                        if step_result.value > aggregated_result.value:
-                            aggregated_result = step_result
+                        step_result = build_step(step)
+                        aggregated_result = worst_status(aggregated_result, step_result)
                         
                         if aggregated_result != ExecStatus.OK:
                             skip_remaining_steps = True
+                    elif steps_cancel.is_cancelled():
+                        spanner(f"step:{step['name']} - cancelled", span_id, generate_span_id(), utcnow(), utcnow(), exec_status_to_otel[ExecStatus.CANCELLED.value])
                     else:
                         spanner(f"step:{step['name']} - skipped", span_id, generate_span_id(), utcnow(), utcnow(), 0)
 
-
+    if timeout_timer:
+        timeout_timer.cancel()
+    if steps_cancel.reason == "timeout" and not cancel.is_cancelled():
+        logger(span_id, "ERROR", f"Timed out after {node['timeout']}s")
+        aggregated_result = worst_status(aggregated_result, ExecStatus.TIMEOUT)
+    elif steps_cancel.is_cancelled():
+        logger(span_id, "WARN", f"Remaining steps cancelled: {steps_cancel.reason}")
 
     if not skip_all and "teardown" in node:
-        build_inner(io, args, node["teardown"], span_id, changeset)
+        build_inner(io, args, node["teardown"], span_id, changeset, scheduler, cancel, cache)
 
     time_step_end = utcnow()
 
     io.chdir(initial_cwd)
 
-    spanner(f"step:{node['name']}", parent_span_id, span_id, time_step_start, time_step_end, exec_status_to_otel[aggregated_result.value])
+    span_name = f"step:{node['name']}" + (" - cancelled" if aggregated_result == ExecStatus.CANCELLED else " - cache hit" if cache_hit else "")
+    spanner(span_name, parent_span_id, span_id, time_step_start, time_step_end, exec_status_to_otel[aggregated_result.value], usage)
 
+    if owns_scheduler:
+        scheduler.close()
     return aggregated_result
 
+def record_history(history: StepHistory, pipeline, scheduler: Scheduler):
+    """Records the duration of every exec step which was executed and succeeded. Cache hits, failures and
+    cancellations say little about how long the step takes"""
+    for (path, node) in exec_steps(pipeline):
+        duration = scheduler.duration(node)
+        if duration is not None and scheduler.ran_ok(node):
+            history.record(path, duration)
+
+def test_history_records_succeeded_steps_only(tmp_path):
+    ctx = TestIoContext({
+        (("ok.sh",), None): (0, "", ""),
+        (("fail.sh",), None): (1, "", ""),
+    })
+    pipeline = {"name": "root", "order": "unordered", "steps": [
+        {"name": "ok", "exec": "ok.sh"},
+        {"name": "fails", "exec": "fail.sh"},
+        {"name": "cached", "exec": "cached.sh"},
+    ]}
+    scheduler = Scheduler(max_parallel=2)
+    build_inner(ctx, dummy_argparse(), pipeline, "", [], scheduler)
+    scheduler.close()
+    # As if restored from the cache
+    scheduler.record_result(pipeline["steps"][2], ExecStatus.OK, True)
+
+    history = StepHistory(str(tmp_path / "history.json"))
+    record_history(history, pipeline, scheduler)
+    assert history.estimate("root/ok") is not None
+    assert history.estimate("root/fails") is None
+    assert history.estimate("root/cached") is None
+
 def build(pipeline):
     args = job_argparse(pipeline["name"])
     logging.info(args)
@@ -375,20 +1980,76 @@ def build(pipeline):
     changeset = []
     if args.changeset:
         with open(args.changeset, "r") as f:
-            changeset + [x.strip() for x in f.readlines()]
+            changeset = [x.rstrip("\n") for x in f if x.strip()]
+
+    history = StepHistory(args.history_file) if args.history_file else None
 
+    if args.plan:
+        assert_pipeline(pipeline)
+        print(plan(pipeline, ChangesetMatcher(pipeline, changeset), history.estimate if history else lambda path: None, args.max_parallel))
+        exit(0)
+
+    get_exporter().compress = args.compress_telemetry
+    get_exporter().encoder = create_encoder(args.telemetry_encoding)
+    if args.telemetry_spool:
+        set_telemetry_spool(args.telemetry_spool, args.telemetry_spool_max_size)
     spanner = create_span_sender(args.traces_endpoint, args.service_name, args.trace_id)
-    # logger = create_log_sender(args.logs_endpoint, args.service_name, args.trace_id)
+    logger = create_log_sender(args.logs_endpoint, args.service_name, args.trace_id)
     root_span_id = args.root_span_id
+    if args.engine == "asyncio":
+        from .aio import AsyncScheduler, build_async
+        scheduler = AsyncScheduler(args.max_parallel, args.cpu_budget, args.mem_budget)
+    else:
+        scheduler = Scheduler(args.max_parallel, args.cpu_budget, args.mem_budget)
+    logging.info(f"Resource budget: {scheduler.resources.budget}")
+
+    cancel = CancelToken()
+    timeout_timer = cancel.cancel_after(args.timeout) if args.timeout else None
+    # E.g. by a worker stopping right away. Steps run in process groups of their own, so are killed by cancelling them.
+    # In a thread of its own, as the signal may interrupt this thread while it holds the token's lock
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=cancel.cancel, args=("terminated",), daemon=True).start())
+
+    cache = StepCache(args.cache_dir, args.cache_max_size) if args.cache_dir else None
 
     root_start = utcnow()
-    exit_code = build_inner(IoContext(), args, pipeline, root_span_id, changeset)
+    io = IoContext(max_output=args.max_step_output, spill_dir=args.output_spill_dir)
+    if args.engine == "asyncio":
+        exit_code = asyncio.run(build_async(io, args, pipeline, root_span_id, changeset, io.getcwd(), scheduler, cancel, cache))
+    else:
+        exit_code = build_inner(io, args, pipeline, root_span_id, changeset, scheduler, cancel, cache)
+        scheduler.close()
     root_end = utcnow()
+
+    if timeout_timer:
+        timeout_timer.cancel()
+    if cancel.reason == "timeout":
+        logging.error(f"Pipeline timed out after {args.timeout}s")
+        logger(root_span_id, "ERROR", f"Pipeline timed out after {args.timeout}s")
+        exit_code = ExecStatus.TIMEOUT
+
+    (critical_duration, critical_steps) = critical_path(pipeline, scheduler.duration)
+    critical_report = f"Critical path ({critical_duration:.2f}s of {(root_end - root_start).total_seconds():.2f}s): {' > '.join(critical_steps)}"
+    logging.info(critical_report)
+    logger(root_span_id, "INFO", critical_report)
+
+    if history:
+        record_history(history, pipeline, scheduler)
+        try:
+            history.save()
+        except OSError as e:
+            logging.error(f"Could not save step history: {e}")
     
     if args.generate_root_span:
         spanner(f"pipeline:{pipeline['name']}", None, root_span_id, root_start, root_end, exec_status_to_otel[exit_code.value])
     
     logging.info(f"Execution concluded with status: {exit_code} / {exit_code.value}")
+    if cache:
+        logging.info(f"Step cache: {cache.counters}")
+
+    exporter = get_exporter()
+    if not exporter.shutdown(timeout=30):
+        logging.error("Timed out flushing telemetry")
+    logging.info(f"Telemetry: {exporter.stats()}")
     exit(exit_code.value)
 
 class TestIoContext(IoContext):
@@ -398,20 +2059,39 @@ class TestIoContext(IoContext):
     predefs = {}
     run_history: list[tuple[list[str], int]] = []
     chdir_history: list[str] = []
+    # cwd of every command run by run_async()/run_streaming_async()
+    run_cwds: list[None|str] = []
     cwd = ""
 
     def __init__(self, predefs: dict = {}):
         self.run_history = []
         self.chdir_history = []
+        self.run_cwds = []
         self.cwd = ""
         if predefs:
             self.predefs = predefs
 
-    def run(self, cmd: list[str], timeout: int):
+    def run(self, cmd: list[str], timeout: int, cancel: None|CancelToken = None, on_usage: None|Callable[[dict[str, int|float]], None] = None):
         self.run_history.append((cmd, timeout))
         result = self.predefs.get((tuple(cmd), timeout), (0, "", ""))
         return result
 
+    def run_streaming(self, cmd: list[str], timeout: int, on_output: Callable[[OutputStream, str], None], cancel: None|CancelToken = None, on_usage: None|Callable[[dict[str, int|float]], None] = None) -> int:
+        (returncode, stdout, stderr) = self.run(cmd, timeout, cancel, on_usage)
+        if stdout:
+            on_output("stdout", stdout)
+        if stderr:
+            on_output("stderr", stderr)
+        return returncode
+
+    async def run_async(self, cmd: list[str], timeout: None|float, cwd: None|str = None, cancel: None|CancelToken = None) -> tuple[int, str, str]:
+        self.run_cwds.append(cwd)
+        return self.run(cmd, timeout, cancel)
+
+    async def run_streaming_async(self, cmd: list[str], timeout: None|float, on_output: Callable[[OutputStream, str], None], cwd: None|str = None, cancel: None|CancelToken = None) -> int:
+        self.run_cwds.append(cwd)
+        return self.run_streaming(cmd, timeout, on_output, cancel)
+
 
     def chdir(self, dir:str) -> bool:
         self.chdir_history.append(dir)
@@ -424,7 +2104,7 @@ class TestIoContext(IoContext):
 
 def dummy_argparse():
     """Provides a Namespace-object similar to job_argparse() - to use for testing"""
-    return argparse.Namespace(root=".", traces_endpoint="http://localhost:4318/v1/traces", logs_endpoint="http://localhost:4318/v1/traces", service_name="test", trace_id="")
+    return argparse.Namespace(root=".", traces_endpoint="http://localhost:4318/v1/traces", logs_endpoint="http://localhost:4318/v1/traces", service_name="test", trace_id="", output_mode="buffered", max_parallel=4, cpu_budget=4, mem_budget=None)
 
 def test_pipeline_with_no_commands_executes_nothing():
     ctx = TestIoContext()
@@ -492,4 +2172,250 @@ def test_pipeline_if_setup_fails_run_no_exec():
     }
     build_inner(ctx, dummy_argparse(), pipeline, "", [])
     assert len(ctx.run_history) == 1
-    assert ctx.run_history == [(["fail.sh"], None)]
\ No newline at end of file
+    assert ctx.run_history == [(["fail.sh"], None)]
+
+def test_pipeline_in_streaming_mode_logs_output_while_running(monkeypatch):
+    logged = []
+    exporter = TelemetryExporter()
+    exporter.submit = lambda endpoint, kind, service, record: logged.append(record) if kind == "logs" else None
+    ctx = TestIoContext({
+        (("build.sh",), None): (0, "built\n", ""),
+    })
+    args = dummy_argparse()
+    args.output_mode = "streaming"
+    monkeypatch.setattr(sys.modules[__name__], "_exporter", exporter)
+    build_inner(ctx, args, {"name": "root", "exec": "build.sh"}, "", [])
+    assert [x["body"]["stringValue"] for x in logged] == ["built\n"]
+
+def test_exec_step_spans_carry_resource_usage(monkeypatch):
+    spans = []
+    exporter = TelemetryExporter()
+    exporter.submit = lambda endpoint, kind, service, record: spans.append(record) if kind == "spans" else None
+    monkeypatch.setattr(sys.modules[__name__], "_exporter", exporter)
+    for output_mode in ("buffered", "streaming"):
+        args = dummy_argparse()
+        args.output_mode = output_mode
+        build_inner(IoContext(), args, {"name": "root", "steps": [{"name": "busy", "exec": ["sh", "-c", "i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done"]}]}, "", [])
+
+    for output_mode in ("buffered", "streaming"):
+        [step, root] = spans[:2]
+        spans = spans[2:]
+        attributes = {x["key"]: x["value"] for x in step["attributes"]}
+        assert attributes["process.cpu.user"]["doubleValue"] + attributes["process.cpu.system"]["doubleValue"] > 0
+        assert attributes["process.memory.max_rss"]["intValue"] > 0
+        assert "attributes" not in root
+
+def test_assert_pipeline_rejects_invalid_needs():
+    def rejected(steps) -> bool:
+        try:
+            assert_pipeline({"name": "root", "steps": steps})
+            return False
+        except AssertionError:
+            return True
+
+    assert not rejected([{"name": "a", "exec": "a.sh"}, {"name": "b", "exec": "b.sh", "needs": ["a"]}])
+    assert rejected([{"name": "a", "exec": "a.sh"}, {"name": "b", "exec": "b.sh", "needs": ["unknown"]}])
+    assert rejected([{"name": "a", "exec": "a.sh", "needs": ["b"]}, {"name": "b", "exec": "b.sh", "needs": ["a"]}])
+    assert rejected([{"name": "a", "exec": "a.sh"}, {"name": "a", "exec": "b.sh", "needs": ["a"]}])
+
+def test_pipeline_with_needs_runs_dependents_after_dependencies_and_skips_on_failure():
+    ctx = TestIoContext({
+        (("fail.sh",), None): (1, "", ""),
+    })
+    pipeline = {
+        "name": "root",
+        "steps": [
+            {"name": "test", "exec": "test.sh", "needs": ["build"]},
+            {"name": "build", "exec": "build.sh"},
+            {"name": "lint", "exec": "fail.sh"},
+            {"name": "publish", "exec": "publish.sh", "needs": ["test", "lint"]},
+        ]}
+    assert_pipeline(pipeline)
+    assert build_inner(ctx, dummy_argparse(), pipeline, "", []) == ExecStatus.ERROR
+    cmds = [cmd for (cmd, _) in ctx.run_history]
+    assert sorted(cmds) == [["build.sh"], ["fail.sh"], ["test.sh"]]
+    assert cmds.index(["build.sh"]) < cmds.index(["test.sh"])
+
+def test_critical_path():
+    durations = {"build": 2.0, "unit": 5.0, "lint": 1.0, "publish": 1.0, "setup": 0.5}
+    pipeline = {
+        "name": "root",
+        "setup": {"name": "setup", "exec": "setup.sh"},
+        "steps": [
+            {"name": "build", "exec": "build.sh"},
+            {"name": "tests", "order": "unordered", "steps": [
+                {"name": "unit", "exec": "unit.sh"},
+                {"name": "lint", "exec": "lint.sh"},
+                {"name": "skipped", "exec": "skipped.sh"},
+            ]},
+            {"name": "publish", "exec": "publish.sh"},
+        ]}
+    (duration, steps) = critical_path(pipeline, lambda node: durations.get(node["name"]))
+    assert duration == 8.5
+    assert steps == ["root/setup", "root/build", "root/tests/unit", "root/publish"]
+
+def test_scheduler_limits_concurrency_by_declared_cpus():
+    running = [0]
+    max_running = [0]
+    lock = threading.Lock()
+
+    class SlowIoContext(TestIoContext):
+        def run(self, cmd, timeout, cancel=None, on_usage=None):
+            with lock:
+                running[0] += 1
+                max_running[0] = max(max_running[0], running[0])
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+            return super().run(cmd, timeout)
+
+    pipeline = {"name": "root", "order": "unordered", "steps": [{"name": f"{i}", "exec": "x.sh", "resources": {"cpu": 2}} for i in range(6)]}
+    assert_pipeline(pipeline)
+    build_inner(SlowIoContext(), dummy_argparse(), pipeline, "", [], Scheduler(max_parallel=8, cpus=4))
+    assert max_running[0] == 2
+
+def test_scheduler_runs_undeclared_steps_in_parallel_by_default():
+    pipeline = {"name": "root", "order": "unordered", "steps": [{"name": f"{i}", "exec": ["sleep", "0.5"]} for i in range(2)]}
+    args = dummy_argparse()
+    (args.max_parallel, args.cpu_budget) = (None, None)
+    # Even on a single CPU
+    for scheduler in (None, Scheduler(cpus=1)):
+        time_start = time.monotonic()
+        assert build_inner(IoContext(), args, pipeline, "", [], scheduler) == ExecStatus.OK
+        assert time.monotonic() - time_start < 0.9
+        if scheduler:
+            scheduler.close()
+
+def test_scheduler_bounds_threads_of_nested_graphs():
+    threads_before = threading.active_count()
+    max_threads = [0]
+    lock = threading.Lock()
+
+    class CountingIoContext(TestIoContext):
+        def run(self, cmd, timeout, cancel=None, on_usage=None):
+            with lock:
+                max_threads[0] = max(max_threads[0], threading.active_count() - threads_before)
+            time.sleep(0.001)
+            return super().run(cmd, timeout)
+
+    pipeline = {"name": "root", "order": "unordered", "steps": [
+        {"name": f"group{g}", "order": "unordered", "steps": [{"name": f"{i}", "exec": "x.sh"} for i in range(20)]}
+        for g in range(5)
+    ]}
+    assert_pipeline(pipeline)
+    scheduler = Scheduler(max_parallel=3, cpus=3)
+    assert build_inner(CountingIoContext(), dummy_argparse(), pipeline, "", [], scheduler) == ExecStatus.OK
+    scheduler.close()
+    # A thread pr group, waiting for its steps, and those shared by the steps
+    assert 0 < max_threads[0] <= 5 + 3
+
+def test_fail_fast_kills_running_siblings():
+    pipeline = {
+        "name": "root",
+        "order": "unordered",
+        "fail-fast": True,
+        "steps": [
+            {"name": "fails", "exec": ["sh", "-c", "sleep 0.1; exit 1"]},
+            {"name": "slow", "exec": ["sh", "-c", "sleep 10 & wait"]},
+        ]}
+    assert_pipeline(pipeline)
+    time_start = time.monotonic()
+    assert build_inner(IoContext(), dummy_argparse(), pipeline, "", []) == ExecStatus.ERROR
+    assert time.monotonic() - time_start < 5
+
+def test_group_timeout_cancels_steps(monkeypatch):
+    spans = []
+    exporter = TelemetryExporter()
+    exporter.submit = lambda endpoint, kind, service, record: spans.append(record) if kind == "spans" else None
+    monkeypatch.setattr(sys.modules[__name__], "_exporter", exporter)
+    pipeline = {
+        "name": "root",
+        "timeout": 0.2,
+        "steps": [
+            {"name": "slow", "exec": ["sleep", "10"]},
+            {"name": "never", "exec": ["true"]},
+        ],
+        "teardown": {"name": "teardown", "exec": ["true"]},
+    }
+    assert_pipeline(pipeline)
+    time_start = time.monotonic()
+    assert build_inner(IoContext(), dummy_argparse(), pipeline, "", []) == ExecStatus.TIMEOUT
+    assert time.monotonic() - time_start < 5
+    cancelled = exec_status_to_otel[ExecStatus.CANCELLED.value]
+    assert [(x["name"], x["status"]["code"]) for x in spans] == [("step:slow - cancelled", cancelled), ("step:never - cancelled", cancelled), ("step:teardown", 1), ("step:root", 2)]
+
+def test_group_timeout_does_not_count_waiting_for_a_slot(monkeypatch):
+    monkeypatch.setattr(sys.modules[__name__], "_exporter", TelemetryExporter())
+    args = dummy_argparse()
+    args.max_parallel = 1
+    pipeline = {
+        "name": "root",
+        "order": "unordered",
+        "steps": [
+            {"name": "busy", "exec": ["sleep", "0.5"]},
+            {"name": "group", "timeout": 0.3, "steps": [{"name": "quick", "exec": ["true"]}]},
+        ],
+    }
+    assert_pipeline(pipeline)
+    assert build_inner(IoContext(), args, pipeline, "", []) == ExecStatus.OK
+
+def test_step_completed_before_cancel_is_not_cancelled():
+    cancel = CancelToken()
+    class CancellingIoContext(IoContext):
+        def run(self, cmd, timeout, cancel=None, on_usage=None):
+            result = super().run(cmd, timeout, cancel, on_usage)
+            cancel.cancel()
+            return result
+    assert exec_step(CancellingIoContext(), {"name": "done", "exec": ["true"]}, cancel=cancel)[0] == ExecStatus.OK
+    cancel = CancelToken()
+    assert exec_step(CancellingIoContext(), {"name": "failed", "exec": ["false"]}, cancel=cancel)[0] == ExecStatus.CANCELLED
+
+def test_cancel_token_starts_once_for_its_ancestors():
+    started = []
+    root = CancelToken()
+    root.on_start(lambda: started.append("root"))
+    group = CancelToken(root)
+    group.on_start(lambda: started.append("group"))
+    sibling = CancelToken(root)
+    group.start()
+    sibling.start()
+    group.start()
+    assert started == ["group", "root"]
+    group.on_start(lambda: started.append("late"))
+    assert started == ["group", "root", "late"]
+
+def test_cancelled_token_skips_steps():
+    ctx = TestIoContext()
+    cancel = CancelToken()
+    cancel.cancel()
+    assert build_inner(ctx, dummy_argparse(), {"name": "root", "exec": "build.sh"}, "", [], cancel=cancel) == ExecStatus.CANCELLED
+    assert len(ctx.run_history) == 0
+
+def test_step_cache_skips_unchanged_steps(tmp_path):
+    (tmp_path / "src.txt").write_text("v1")
+    pipeline = {"name": "build", "exec": ["sh", "-c", "mkdir -p dist && cat src.txt > dist/out.txt"], "inputs": {"files": ["*.txt"]}, "outputs": ["dist/**"]}
+    assert_pipeline(pipeline)
+    cache = StepCache(str(tmp_path / "cache"))
+
+    class CountingIoContext(IoContext):
+        runs = 0
+        def run(self, cmd, timeout, cancel=None, on_usage=None):
+            CountingIoContext.runs += 1
+            return super().run(cmd, timeout, cancel, on_usage)
+
+    initial_cwd = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        ctx = CountingIoContext()
+        assert build_inner(ctx, dummy_argparse(), pipeline, "", [], cache=cache) == ExecStatus.OK
+        (tmp_path / "dist" / "out.txt").unlink()
+        assert build_inner(ctx, dummy_argparse(), pipeline, "", [], cache=cache) == ExecStatus.OK
+        assert CountingIoContext.runs == 1
+        assert (tmp_path / "dist" / "out.txt").read_text() == "v1"
+
+        (tmp_path / "src.txt").write_text("v2")
+        assert build_inner(ctx, dummy_argparse(), pipeline, "", [], cache=cache) == ExecStatus.OK
+        assert CountingIoContext.runs == 2
+        assert (tmp_path / "dist" / "out.txt").read_text() == "v2"
+    finally:
+        os.chdir(initial_cwd)
\ No newline at end of file
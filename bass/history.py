@@ -0,0 +1,51 @@
+import json
+import logging
+import os
+
+class StepHistory:
+    """Local record of how long steps took, as an exponentially weighted moving average pr step path (e.g. 'root/build').
+    Stored as a JSON file, replaced atomically on save()"""
+
+    def __init__(self, path: str, alpha: float = 0.3):
+        self.path = path
+        self.alpha = alpha
+        self.steps: dict[str, dict] = {}
+        try:
+            with open(path) as f:
+                self.steps = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            logging.warning(f"Ignoring unreadable step history {path}: {e}")
+
+    def estimate(self, step_path: str) -> None|float:
+        """Returns the expected duration of the step in seconds, or None if it has never been run"""
+        step = self.steps.get(step_path)
+        return step["seconds"] if step else None
+
+    def record(self, step_path: str, seconds: float):
+        step = self.steps.get(step_path)
+        if step:
+            step["seconds"] = self.alpha * seconds + (1 - self.alpha) * step["seconds"]
+            step["runs"] += 1
+        else:
+            self.steps[step_path] = {"seconds": seconds, "runs": 1}
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.steps, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+def test_step_history_averages_durations(tmp_path):
+    path = str(tmp_path / "history.json")
+    history = StepHistory(path, alpha=0.5)
+    assert history.estimate("root/build") is None
+    history.record("root/build", 10)
+    history.record("root/build", 20)
+    history.save()
+
+    history = StepHistory(path)
+    assert history.estimate("root/build") == 15
+    assert history.steps["root/build"]["runs"] == 2
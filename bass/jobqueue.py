@@ -0,0 +1,625 @@
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Hashable
+
+class _Group:
+    """Scheduling state of a group of jobs, e.g. those of one pipeline"""
+    __slots__ = ("name", "priority", "weight", "max_concurrent", "vtime", "queued", "in_flight", "dequeued", "wait_total", "wait_max")
+
+    def __init__(self, name: None|str):
+        self.name = name
+        self.priority = 0
+        self.weight = 1.0
+        self.max_concurrent: None|int = None
+        # Virtual time: advanced by 1/weight pr dequeued job
+        self.vtime = 0.0
+        self.queued = 0
+        self.in_flight = 0
+        self.dequeued = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+class JobQueue:
+    """Thread-safe job queue, indexed by the set of worker-tags each job requires.
+
+    Jobs are kept in one FIFO bucket pr distinct tag set and group (e.g. pipeline). A worker gets a job from one
+    of the buckets whose tag set is equal to or a subset of the worker's tags. Which non-empty buckets are eligible
+    for a given set of worker tags is kept up to date as buckets fill and drain, so a dequeue costs O(number of
+    eligible buckets with jobs queued) regardless of the number of queued jobs, or of pipelines without any.
+
+    Among the eligible buckets, the group with the highest priority goes first. Groups of equal priority get
+    turns in proportion to their weight (weighted fair share, by the virtual time of each group), and a group
+    never has more than its max_concurrent jobs in flight - see release(). Jobs of a group, and jobs put
+    without a group, are handed out oldest first.
+
+    Jobs may be put with a key, e.g. identifying pipeline and ref, letting a later job with the same key be
+    combined with the one still queued instead of queued as well."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._groups: dict[None|str, _Group] = {}
+        # Entries are (seq, job, time queued)
+        self._buckets: dict[tuple[frozenset[str], None|str], deque[tuple[int, dict, float]]] = {}
+        # <worker tags>: <bucket key>: (group, bucket) of the non-empty buckets eligible for them
+        self._eligible: dict[frozenset[str], dict[tuple[frozenset[str], None|str], tuple[_Group, deque[tuple[int, dict, float]]]]] = {}
+        # <bucket key>: the worker tags it is eligible for
+        self._bucket_eligible: dict[tuple[frozenset[str], None|str], list[frozenset[str]]] = {}
+        self._waiters: list[tuple[frozenset[str], threading.Condition]] = []
+        self._seq = itertools.count()
+        self._len = 0
+        # Virtual time of the most recently dequeued job. Groups with nothing queued catch up to it, not to hoard turns
+        self._vclock = 0.0
+        # <key>: (bucket key, entry) of queued jobs put with a key, and <seq>: <key> to forget them when dequeued
+        self._keyed: dict[Hashable, tuple[tuple[frozenset[str], None|str], tuple[int, dict, float]]] = {}
+        self._keys: dict[int, Hashable] = {}
+        # Called with group and seconds queued of every dequeued job, under the queue's lock - e.g. to record metrics
+        self.on_dequeue: None|Callable[[None|str, float], None] = None
+
+    def __len__(self) -> int:
+        return self._len
+
+    def _group(self, name: None|str) -> _Group:
+        group = self._groups.get(name)
+        if group is None:
+            group = self._groups[name] = _Group(name)
+        return group
+
+    def configure_group(self, name: str, priority: int = 0, weight: float = 1.0, max_concurrent: None|int = None):
+        """Sets the scheduling of a group. Groups not configured have priority 0, weight 1 and no concurrency cap"""
+        assert weight > 0
+        with self._lock:
+            group = self._group(name)
+            (group.priority, group.weight, group.max_concurrent) = (priority, weight, max_concurrent)
+            self._wake_for_group(name)
+
+    def _bucket(self, tags: frozenset[str], group_name: None|str) -> deque[tuple[int, dict, float]]:
+        bucket = self._buckets.get((tags, group_name))
+        if bucket is None:
+            bucket = self._buckets[(tags, group_name)] = deque()
+            self._group(group_name)
+            self._bucket_eligible[(tags, group_name)] = [worker_tags for worker_tags in self._eligible if tags <= worker_tags]
+        return bucket
+
+    def _filled(self, key: tuple[frozenset[str], None|str]):
+        # Called once a bucket is no longer empty
+        entry = (self._groups[key[1]], self._buckets[key])
+        for worker_tags in self._bucket_eligible[key]:
+            self._eligible[worker_tags][key] = entry
+
+    def _drained(self, key: tuple[frozenset[str], None|str]):
+        for worker_tags in self._bucket_eligible[key]:
+            self._eligible[worker_tags].pop(key, None)
+
+    def _eligible_buckets(self, worker_tags: frozenset[str]) -> dict[tuple[frozenset[str], None|str], tuple[_Group, deque[tuple[int, dict, float]]]]:
+        eligible = self._eligible.get(worker_tags)
+        if eligible is None:
+            keys = [key for key in self._buckets if key[0] <= worker_tags]
+            for key in keys:
+                self._bucket_eligible[key].append(worker_tags)
+            eligible = self._eligible[worker_tags] = {key: (self._groups[key[1]], self._buckets[key]) for key in keys if self._buckets[key]}
+        return eligible
+
+    def _wake(self, tags: frozenset[str]) -> bool:
+        # Wake the longest waiting worker able to take a job requiring tags
+        for (i, (worker_tags, waiter)) in enumerate(self._waiters):
+            if tags <= worker_tags:
+                del self._waiters[i]
+                waiter.notify()
+                return True
+        return False
+
+    def _wake_for_group(self, group_name: None|str):
+        for ((tags, name), bucket) in self._buckets.items():
+            if name == group_name and bucket:
+                self._wake(tags)
+
+    def put(self, job: dict, tags: frozenset[str], key: None|Hashable = None, combine: None|Callable[[dict, dict], None|dict] = None, group: None|str = None) -> None|dict:
+        """Queues job for workers having all of tags.
+
+        If a job with the same key is still queued, combine(queued, job) decides, under the queue's lock: returning
+        None means job was merged into the queued one, which keeps its place. Returning a job means it replaces the
+        queued one, at the end of the queue. Returns the queued job combined with, if any"""
+        with self._lock:
+            queued = self._keyed.get(key) if key is not None and combine else None
+            if queued:
+                (queued_bucket_key, queued_entry) = queued
+                replacement = combine(queued_entry[1], job)
+                if replacement is None:
+                    return queued_entry[1]
+                self._buckets[queued_bucket_key].remove(queued_entry)
+                if not self._buckets[queued_bucket_key]:
+                    self._drained(queued_bucket_key)
+                del self._keys[queued_entry[0]]
+                self._group(queued_bucket_key[1]).queued -= 1
+                self._len -= 1
+                job = replacement
+
+            group_state = self._group(group)
+            if group_state.queued == 0:
+                group_state.vtime = max(group_state.vtime, self._vclock)
+            group_state.queued += 1
+
+            entry = (next(self._seq), job, time.monotonic())
+            bucket = self._bucket(tags, group)
+            bucket.append(entry)
+            if len(bucket) == 1:
+                self._filled((tags, group))
+            self._len += 1
+            if key is not None:
+                self._keyed[key] = ((tags, group), entry)
+                self._keys[entry[0]] = key
+
+            self._wake(tags)
+            return queued[1][1] if queued else None
+
+    def _pop(self, worker_tags: frozenset[str]) -> None|dict:
+        best = None
+        best_rank = None
+        for (key, (group, bucket)) in self._eligible_buckets(worker_tags).items():
+            if group.max_concurrent is not None and group.in_flight >= group.max_concurrent:
+                continue
+            rank = (-group.priority, group.vtime, bucket[0][0])
+            if best_rank is None or rank < best_rank:
+                (best, best_rank) = ((key, group, bucket), rank)
+
+        if best is None:
+            return None
+
+        (key, group, bucket) = best
+        (seq, job, time_queued) = bucket.popleft()
+        if not bucket:
+            self._drained(key)
+        self._len -= 1
+        combine_key = self._keys.pop(seq, None)
+        if combine_key is not None and self._keyed[combine_key][1][0] == seq:
+            del self._keyed[combine_key]
+
+        self._vclock = group.vtime
+        group.vtime += 1 / group.weight
+        group.queued -= 1
+        group.in_flight += 1
+        group.dequeued += 1
+        wait = time.monotonic() - time_queued
+        group.wait_total += wait
+        group.wait_max = max(group.wait_max, wait)
+        if self.on_dequeue:
+            self.on_dequeue(group.name, wait)
+        return job
+
+    def get(self, worker_tags: frozenset[str], wait: float = 0) -> None|dict:
+        """Removes and returns the next job the worker is eligible for. Waits up to 'wait' seconds for one to be queued.
+        The job counts as in flight for its group until release()"""
+        # Not waiting for ever on nan
+        deadline = time.monotonic() + (wait if wait > 0 else 0)
+        waiter = None
+        with self._lock:
+            while True:
+                job = self._pop(worker_tags)
+                if job is not None:
+                    return job
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    if waiter:
+                        self._waiters = [w for w in self._waiters if w[1] is not waiter]
+                    return None
+
+                if waiter is None:
+                    waiter = threading.Condition(self._lock)
+                if not any(w[1] is waiter for w in self._waiters):
+                    self._waiters.append((worker_tags, waiter))
+                waiter.wait(remaining)
+
+    def release(self, group: None|str):
+        """Lets the queue know a job of group is no longer in flight, e.g. completed"""
+        with self._lock:
+            group_state = self._group(group)
+            group_state.in_flight = max(0, group_state.in_flight - 1)
+            if group_state.max_concurrent is not None:
+                self._wake_for_group(group)
+
+    def stats(self) -> dict[None|str, dict]:
+        """Returns pr group: jobs queued, in flight and dequeued, and the average and max seconds dequeued jobs were queued"""
+        with self._lock:
+            return {name: {
+                "queued": group.queued,
+                "in-flight": group.in_flight,
+                "dequeued": group.dequeued,
+                "wait-avg": group.wait_total / group.dequeued if group.dequeued else 0.0,
+                "wait-max": group.wait_max,
+            } for (name, group) in self._groups.items()}
+
+    def depths(self) -> dict[frozenset[str], int]:
+        """Returns the number of jobs queued pr required tag set"""
+        with self._lock:
+            depths: dict[frozenset[str], int] = {}
+            for ((tags, _), bucket) in self._buckets.items():
+                depths[tags] = depths.get(tags, 0) + len(bucket)
+            return depths
+
+    def jobs(self) -> list[dict]:
+        """Returns all queued jobs, oldest first"""
+        with self._lock:
+            return [entry[1] for entry in sorted(itertools.chain(*self._buckets.values()), key=lambda x: x[0])]
+
+    def clear(self):
+        with self._lock:
+            for bucket in self._buckets.values():
+                bucket.clear()
+            for eligible in self._eligible.values():
+                eligible.clear()
+            for group in self._groups.values():
+                (group.queued, group.in_flight) = (0, 0)
+            self._keyed.clear()
+            self._keys.clear()
+            self._len = 0
+
+def test_jobqueue_is_fifo_across_eligible_buckets():
+    q = JobQueue()
+    q.put({"name": "a"}, frozenset())
+    q.put({"name": "b"}, frozenset({"linux"}))
+    q.put({"name": "c"}, frozenset({"linux", "gpu"}))
+    q.put({"name": "d"}, frozenset())
+
+    assert q.get(frozenset({"linux"}))["name"] == "a"
+    assert q.get(frozenset({"linux"}))["name"] == "b"
+    assert q.get(frozenset({"linux"}))["name"] == "d"
+    assert q.get(frozenset({"linux"})) is None
+    assert len(q) == 1
+    assert q.get(frozenset({"linux", "gpu", "arm"}))["name"] == "c"
+
+def test_jobqueue_combines_jobs_with_same_key():
+    def merge(queued, job):
+        queued["refs"] += job["refs"]
+    q = JobQueue()
+    assert q.put({"name": "a", "refs": [1]}, frozenset(), key="a", combine=merge) is None
+    q.put({"name": "b", "refs": [2]}, frozenset(), key="b", combine=merge)
+    assert q.put({"name": "a", "refs": [3]}, frozenset(), key="a", combine=merge)["refs"] == [1, 3]
+    assert len(q) == 2
+
+    # Superseding moves the job to the back of the queue
+    assert q.put({"name": "b", "refs": [4]}, frozenset(), key="b", combine=lambda queued, job: job)["refs"] == [2]
+    assert [job["refs"] for job in q.jobs()] == [[1, 3], [4]]
+    assert len(q) == 2
+
+    # Dequeued jobs are not combined with
+    assert q.get(frozenset())["name"] == "a"
+    assert q.put({"name": "a", "refs": [5]}, frozenset(), key="a", combine=merge) is None
+    assert len(q) == 2
+
+def test_jobqueue_shares_fairly_by_priority_and_weight():
+    q = JobQueue()
+    q.configure_group("release", priority=1)
+    q.configure_group("heavy", weight=2)
+    for i in range(6):
+        q.put({"name": "nightly"}, frozenset(), group="nightly")
+    for i in range(6):
+        q.put({"name": "heavy"}, frozenset(), group="heavy")
+    q.put({"name": "release"}, frozenset(), group="release")
+
+    names = [q.get(frozenset())["name"] for _ in range(7)]
+    assert names[0] == "release"
+    assert names[1:].count("heavy") == 4 and names[1:].count("nightly") == 2
+
+def test_jobqueue_caps_concurrency_pr_group():
+    q = JobQueue()
+    q.configure_group("capped", max_concurrent=1)
+    q.put({"name": "a"}, frozenset(), group="capped")
+    q.put({"name": "b"}, frozenset(), group="capped")
+    assert q.get(frozenset())["name"] == "a"
+    assert q.get(frozenset()) is None
+
+    # Waiting workers are woken once the group has capacity again
+    threading.Timer(0.05, q.release, ["capped"]).start()
+    assert q.get(frozenset(), wait=5)["name"] == "b"
+    stats = q.stats()["capped"]
+    assert (stats["queued"], stats["in-flight"], stats["dequeued"]) == (0, 1, 2)
+    assert stats["wait-max"] >= 0.05
+
+def test_jobqueue_eligibility_cache_sees_new_tag_sets():
+    q = JobQueue()
+    assert q.get(frozenset({"linux"})) is None
+    q.put({"name": "a"}, frozenset({"linux"}))
+    assert q.get(frozenset({"linux"}))["name"] == "a"
+
+def test_jobqueue_only_visits_buckets_with_jobs():
+    q = JobQueue()
+    for group in ("a", "b", "c"):
+        q.put({"name": group}, frozenset(), group=group)
+    assert [q.get(frozenset({"linux"}))["name"] for _ in range(3)] == ["a", "b", "c"]
+    assert q._eligible[frozenset({"linux"})] == {}
+
+    # Filled again, and drained by a job replacing the queued one in another bucket
+    q.put({"name": "b"}, frozenset(), key="b", combine=lambda queued, job: job, group="b")
+    q.put({"name": "b2"}, frozenset({"linux"}), key="b", combine=lambda queued, job: job, group="b")
+    assert list(q._eligible[frozenset({"linux"})]) == [(frozenset({"linux"}), "b")]
+    assert q.get(frozenset({"linux"}))["name"] == "b2"
+    assert q.get(frozenset({"linux"})) is None
+
+def test_jobqueue_get_does_not_wait_on_nan():
+    assert JobQueue().get(frozenset(), float("nan")) is None
+
+def test_jobqueue_wakes_matching_waiter():
+    q = JobQueue()
+    threading.Timer(0.05, q.put, [{"name": "other"}, frozenset({"other"})]).start()
+    threading.Timer(0.1, q.put, [{"name": "mine"}, frozenset({"mine"})]).start()
+    time_start = time.monotonic()
+    assert q.get(frozenset({"mine"}), wait=5)["name"] == "mine"
+    assert time.monotonic() - time_start < 1
+    assert q.get(frozenset({"mine"}), wait=0.05) is None
+
+class JournalError(RuntimeError):
+    """The journal could not be written, and no more operations can be recorded"""
+
+class JobJournal:
+    """Append-only, crash-safe journal of job queue operations: enqueue, update, dequeue and complete.
+
+    Records are written as JSON lines by a background thread, which writes and fsyncs every record submitted
+    since its previous write in one go (group commit). Callers may wait for their record to be durable.
+    Once compact_every records have been written, the journal is rewritten to only hold jobs not yet completed.
+    replay() restores the queue state on startup."""
+
+    def __init__(self, path: str, compact_every: int = 10000, fsync: bool = True):
+        self.path = path
+        self.compact_every = compact_every
+        self.fsync = fsync
+        # <id>: {"job": ..., "tags": [...], "dequeued": bool}, in order of enqueueing. Only accessed by the writer once started
+        self._jobs: dict[str, dict] = {}
+        self._pending: list[tuple[dict, None|threading.Event]] = []
+        self._lock = threading.Lock()
+        self._has_pending = threading.Condition(self._lock)
+        self._file = None
+        self._thread = None
+        self._closed = False
+        # The error which stopped the writer, if any. Appending fails from then on
+        self._failed: None|Exception = None
+        self._writing: list[tuple[dict, None|threading.Event]] = []
+        self._written_since_compaction = 0
+        self.counters = {"records": 0, "commits": 0, "compactions": 0}
+
+    def replay(self) -> tuple[list[tuple[dict, frozenset[str]]], list[tuple[dict, frozenset[str]]]]:
+        """Reads the journal and starts the writer. Returns (queued, in-flight) jobs, oldest first, as (job, tags)"""
+        valid_size = 0
+        try:
+            with open(self.path, "rb") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn write from a crash can only affect the last line
+                        logging.warning("Ignoring incomplete journal record at offset %d in %s", valid_size, self.path)
+                        break
+                    try:
+                        self._apply(record)
+                    except (KeyError, TypeError) as e:
+                        # E.g. edited by hand. Skipped rather than refusing to start, and dropped upon compaction
+                        logging.warning("Ignoring malformed journal record at offset %d in %s: %r", valid_size, self.path, e)
+                    valid_size += len(line)
+        except FileNotFoundError:
+            pass
+
+        self._file = open(self.path, "ab")
+        self._file.truncate(valid_size)
+        self._thread = threading.Thread(target=self._run, name="bass-job-journal", daemon=True)
+        self._thread.start()
+
+        queued = [(x["job"], frozenset(x["tags"])) for x in self._jobs.values() if not x["dequeued"]]
+        in_flight = [(x["job"], frozenset(x["tags"])) for x in self._jobs.values() if x["dequeued"]]
+        return (queued, in_flight)
+
+    def _apply(self, record: dict):
+        if record["op"] == "enqueue":
+            if not isinstance(record["job"], dict) or not isinstance(record["tags"], list):
+                raise TypeError("enqueue record without job or tags")
+            self._jobs[record["id"]] = {"job": record["job"], "tags": record["tags"], "dequeued": False}
+        elif record["op"] == "dequeue" and record["id"] in self._jobs:
+            self._jobs[record["id"]]["dequeued"] = True
+        elif record["op"] == "update" and record["id"] in self._jobs:
+            self._jobs[record["id"]]["job"] = record["job"]
+        elif record["op"] == "requeue" and record["id"] in self._jobs:
+            self._jobs[record["id"]]["dequeued"] = False
+        elif record["op"] == "complete":
+            self._jobs.pop(record["id"], None)
+
+    def enqueue(self, job_id: str, job: dict, tags: frozenset[str], wait: bool = True):
+        self.append({"op": "enqueue", "id": job_id, "tags": sorted(tags), "job": job}, wait)
+
+    def update(self, job_id: str, job: dict, wait: bool = False):
+        """Replaces the contents of a job, whether queued or in flight"""
+        self.append({"op": "update", "id": job_id, "job": job}, wait)
+
+    def dequeue(self, job_id: str, wait: bool = False):
+        """Not waited for by default, so the job is handed out without waiting for the disk: if the orchestrator
+        crashes before the record is durable, the job is queued again upon restart. Jobs are handed out at least once"""
+        self.append({"op": "dequeue", "id": job_id}, wait)
+
+    def requeue(self, job_id: str, wait: bool = False):
+        self.append({"op": "requeue", "id": job_id}, wait)
+
+    def complete(self, job_id: str, status: str, wait: bool = False):
+        self.append({"op": "complete", "id": job_id, "status": status}, wait)
+
+    def append(self, record: dict, wait: bool = True):
+        """Submits record to be written. If wait: blocks until it is durable. Raises JournalError if the journal can not be written"""
+        done = threading.Event() if wait else None
+        with self._has_pending:
+            self._raise_if_failed()
+            if self._closed or self._thread is None:
+                raise RuntimeError("Journal is not open")
+            self._pending.append((record, done))
+            self._has_pending.notify()
+
+        if done:
+            done.wait()
+            with self._has_pending:
+                self._raise_if_failed()
+
+    def _raise_if_failed(self):
+        if self._failed:
+            raise JournalError(f"Journal {self.path} failed: {self._failed}") from self._failed
+
+    def close(self):
+        with self._has_pending:
+            if self._closed:
+                return
+            self._closed = True
+            self._has_pending.notify()
+
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        try:
+            self._write_batches()
+        except Exception as e:
+            logging.exception("Journal %s failed, no more jobs can be recorded", self.path)
+            with self._has_pending:
+                self._failed = e
+                (pending, self._pending) = (self._writing + self._pending, [])
+            for (_, done) in pending:
+                if done:
+                    done.set()
+            try:
+                self._file.close()
+            except OSError:
+                pass
+
+    def _write_batches(self):
+        while True:
+            with self._has_pending:
+                while not self._pending and not self._closed:
+                    self._has_pending.wait()
+                (batch, self._pending) = (self._pending, [])
+                closed = self._closed
+            # Released by _run() should writing fail
+            self._writing = batch
+
+            if batch:
+                self._file.write(b"".join(json.dumps(record).encode("utf-8") + b"\n" for (record, _) in batch))
+                self._file.flush()
+                if self.fsync:
+                    os.fsync(self._file.fileno())
+
+                for (record, _) in batch:
+                    self._apply(record)
+                self.counters["records"] += len(batch)
+                self.counters["commits"] += 1
+                self._written_since_compaction += len(batch)
+
+                for (_, done) in batch:
+                    if done:
+                        done.set()
+
+                if self._written_since_compaction >= self.compact_every:
+                    self._compact()
+
+            if closed:
+                self._file.close()
+                return
+
+    def _compact(self):
+        """Atomically replaces the journal with one holding only the jobs not yet completed"""
+        tmp_path = f"{self.path}.compact"
+        with open(tmp_path, "wb") as f:
+            for (job_id, x) in self._jobs.items():
+                f.write(json.dumps({"op": "enqueue", "id": job_id, "tags": x["tags"], "job": x["job"]}).encode("utf-8") + b"\n")
+                if x["dequeued"]:
+                    f.write(json.dumps({"op": "dequeue", "id": job_id}).encode("utf-8") + b"\n")
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+
+        self._file.close()
+        os.replace(tmp_path, self.path)
+        if self.fsync:
+            dir_fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+        self._file = open(self.path, "ab")
+        self._written_since_compaction = 0
+        self.counters["compactions"] += 1
+
+def test_journal_replays_pending_jobs(tmp_path):
+    path = str(tmp_path / "journal")
+    journal = JobJournal(path)
+    assert journal.replay() == ([], [])
+    for i in range(4):
+        journal.enqueue(str(i), {"name": str(i)}, frozenset({"linux"}))
+    journal.dequeue("0")
+    journal.complete("0", "OK")
+    journal.dequeue("2")
+    journal.close()
+
+    # Simulate a torn write
+    with open(path, "ab") as f:
+        f.write(b'{"op": "enq')
+
+    journal = JobJournal(path)
+    (queued, in_flight) = journal.replay()
+    assert [job["name"] for (job, _) in queued] == ["1", "3"]
+    assert [job["name"] for (job, _) in in_flight] == ["2"]
+    assert queued[0][1] == frozenset({"linux"})
+    journal.enqueue("4", {"name": "4"}, frozenset())
+    journal.close()
+
+    (queued, _) = JobJournal(path).replay()
+    assert [job["name"] for (job, _) in queued] == ["1", "3", "4"]
+
+def test_journal_skips_malformed_records(tmp_path):
+    path = str(tmp_path / "journal")
+    with open(path, "wb") as f:
+        f.write(b'{"op": "enqueue", "id": "0", "tags": [], "job": {"name": "0"}}\n')
+        f.write(b'{"id": "0"}\n')
+        f.write(b'[1, 2]\n')
+        f.write(b'{"op": "enqueue", "id": "1", "job": {"name": "1"}}\n')
+        f.write(b'{"op": "dequeue", "id": ["0"]}\n')
+        f.write(b'{"op": "enqueue", "id": "2", "tags": ["linux"], "job": {"name": "2"}}\n')
+
+    journal = JobJournal(path)
+    (queued, in_flight) = journal.replay()
+    assert [job["name"] for (job, _) in queued] == ["0", "2"]
+    assert in_flight == []
+    # Kept rather than truncated
+    journal.enqueue("3", {"name": "3"}, frozenset())
+    journal.close()
+    (queued, _) = JobJournal(path).replay()
+    assert [job["name"] for (job, _) in queued] == ["0", "2", "3"]
+
+def test_journal_compacts_completed_jobs(tmp_path):
+    path = str(tmp_path / "journal")
+    journal = JobJournal(path, compact_every=4)
+    journal.replay()
+    for i in range(3):
+        journal.enqueue(str(i), {"name": str(i)}, frozenset())
+    journal.dequeue("0")
+    journal.complete("0", "OK", wait=True)
+    journal.close()
+
+    assert journal.counters["compactions"] == 1
+    with open(path) as f:
+        assert [json.loads(line)["id"] for line in f] == ["1", "2"]
+
+def test_journal_failure_is_raised_to_appenders(tmp_path):
+    journal = JobJournal(str(tmp_path / "journal"))
+    journal.replay()
+    journal.enqueue("0", {"name": "0"}, frozenset())
+    def write(data):
+        raise OSError(28, "No space left on device")
+    journal._file.write = write
+
+    for wait in (True, False):
+        # Appends after the failure fail at once, without waiting for the writer
+        try:
+            journal.append({"op": "dequeue", "id": "0"}, wait)
+            assert False
+        except JournalError as e:
+            assert "No space left" in str(e)
+    journal.close()
@@ -0,0 +1,169 @@
+import bisect
+import math
+import threading
+from typing import Callable
+
+# Histogram buckets in seconds, suiting latencies from sub-millisecond requests to jobs queued for hours
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+class _Sharded:
+    """Values recorded in a shard pr thread, so recording never contends on a lock. Collecting sums the shards.
+    Shards of finished threads are folded into a single total, as servers may start a thread pr connection"""
+
+    def __init__(self, new_shard: Callable[[], list[float]]):
+        self._new_shard = new_shard
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # [(thread, labelvalues, shard)] of live threads, and the totals of finished ones
+        self._shards: list[tuple[threading.Thread, tuple[str, ...], list[float]]] = []
+        self._retired: dict[tuple[str, ...], list[float]] = {}
+
+    def shard(self, labelvalues: tuple[str, ...]) -> list[float]:
+        shards = getattr(self._local, "shards", None)
+        if shards is None:
+            shards = self._local.shards = {}
+        shard = shards.get(labelvalues)
+        if shard is None:
+            shard = shards[labelvalues] = self._new_shard()
+            with self._lock:
+                self._shards.append((threading.current_thread(), labelvalues, shard))
+                if len(self._shards) % 256 == 0:
+                    self._retire()
+        return shard
+
+    @staticmethod
+    def _add(totals: dict[tuple[str, ...], list[float]], labelvalues: tuple[str, ...], shard: list[float]):
+        total = totals.get(labelvalues)
+        if total is None:
+            totals[labelvalues] = list(shard)
+        else:
+            for (i, x) in enumerate(shard):
+                total[i] += x
+
+    def _retire(self):
+        live = []
+        for (thread, labelvalues, shard) in self._shards:
+            if thread.is_alive():
+                live.append((thread, labelvalues, shard))
+            else:
+                self._add(self._retired, labelvalues, shard)
+        self._shards = live
+
+    def collect(self) -> dict[tuple[str, ...], list[float]]:
+        with self._lock:
+            self._retire()
+            totals = {labelvalues: list(shard) for (labelvalues, shard) in self._retired.items()}
+            shards = list(self._shards)
+        for (_, labelvalues, shard) in shards:
+            self._add(totals, labelvalues, shard)
+        return totals
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _labels(labelnames: tuple[str, ...], labelvalues: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for (name, value) in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return str(int(value)) if value == int(value) else repr(value)
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        (self.name, self.help, self.labelnames) = (name, help, labelnames)
+        self._values = _Sharded(lambda: [0.0])
+
+    def inc(self, *labelvalues: str, amount: float = 1.0):
+        self._values.shard(labelvalues)[0] += amount
+
+    def values(self) -> dict[tuple[str, ...], float]:
+        return {labelvalues: x[0] for (labelvalues, x) in self._values.collect().items()}
+
+    def render(self) -> list[str]:
+        return [f"{self.name}{_labels(self.labelnames, labelvalues)} {_number(value)}" for (labelvalues, value) in sorted(self.values().items())]
+
+class Gauge:
+    """Value computed upon collection, by fn returning {labelvalues: value}"""
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...], fn: Callable[[], dict[tuple[str, ...], float]]):
+        (self.name, self.help, self.labelnames, self.fn) = (name, help, labelnames, fn)
+
+    def render(self) -> list[str]:
+        return [f"{self.name}{_labels(self.labelnames, labelvalues)} {_number(value)}" for (labelvalues, value) in sorted(self.fn().items())]
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        (self.name, self.help, self.labelnames) = (name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Shard: count pr bucket (the last one being +Inf), then sum
+        self._values = _Sharded(lambda: [0.0] * (len(self.buckets) + 2))
+
+    def observe(self, value: float, *labelvalues: str):
+        shard = self._values.shard(labelvalues)
+        shard[bisect.bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    def render(self) -> list[str]:
+        lines = []
+        for (labelvalues, shard) in sorted(self._values.collect().items()):
+            cumulative = 0.0
+            for (le, count) in zip(self.buckets + (math.inf,), shard):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labelvalues, f'le="{_number(le)}"')} {_number(cumulative)}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labelvalues)} {_number(shard[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labelvalues)} {_number(cumulative)}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Counter|Gauge|Histogram] = []
+
+    def register[T: (Counter, Gauge, Histogram)](self, metric: T) -> T:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Returns all metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            kind = {Counter: "counter", Gauge: "gauge", Histogram: "histogram"}[type(metric)]
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+def test_metrics_render_prometheus_text():
+    registry = Registry()
+    requests = registry.register(Counter("requests_total", "Requests", ("outcome",)))
+    latency = registry.register(Histogram("latency_seconds", "Latency", buckets=(0.1, 1)))
+    registry.register(Gauge("depth", "Depth", ("tags",), lambda: {("a,b",): 3, ('"q"',): 0}))
+
+    threads = [threading.Thread(target=lambda: [requests.inc("ok") for _ in range(1000)]) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    requests.inc("error", amount=2)
+    for value in (0.05, 0.5, 0.5, 5):
+        latency.observe(value)
+
+    assert registry.render().splitlines() == [
+        "# HELP requests_total Requests",
+        "# TYPE requests_total counter",
+        'requests_total{outcome="error"} 2',
+        'requests_total{outcome="ok"} 4000',
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        "latency_seconds_sum 6.05",
+        "latency_seconds_count 4",
+        "# HELP depth Depth",
+        "# TYPE depth gauge",
+        'depth{tags="\\"q\\""} 0',
+        'depth{tags="a,b"} 3',
+    ]
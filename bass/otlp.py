@@ -0,0 +1,201 @@
+"""Encoding of span and log records - as generated by bass.core in their OTLP/JSON shape - to OTLP/HTTP request bodies.
+
+Records are grouped by service name. The resource and scope envelope of a service is encoded once and reused for
+every later payload, so only the records themselves are serialized pr export. Besides JSON, the records may be
+encoded as protobuf (application/x-protobuf) by the minimal encoder below - no protobuf package required."""
+import json
+import struct
+from typing import Literal
+
+type Kind = Literal["spans", "logs"]
+type Encoding = Literal["json", "protobuf"]
+
+# Services are few (one pr pipeline), but do not grow without bounds in long running processes
+_MAX_ENVELOPES = 1024
+
+class JsonEncoder:
+    content_type = "application/json"
+
+    def __init__(self):
+        self._envelopes: dict[tuple[Kind, str], tuple[bytes, bytes]] = {}
+
+    def _envelope(self, kind: Kind, service: str) -> tuple[bytes, bytes]:
+        envelope = self._envelopes.get((kind, service))
+        if envelope is None:
+            (scope_key, records_key) = ("scopeSpans", "spans") if kind == "spans" else ("scopeLogs", "logRecords")
+            resource = json.dumps({"attributes": [{"key": "service.name", "value": {"stringValue": service}}]}, separators=(",", ":"))
+            envelope = (f'{{"resource":{resource},"{scope_key}":[{{"{records_key}":'.encode("utf-8"), b"}]}")
+            if len(self._envelopes) >= _MAX_ENVELOPES:
+                self._envelopes.clear()
+            self._envelopes[(kind, service)] = envelope
+        return envelope
+
+    def encode(self, kind: Kind, records_by_service: dict[str, list[dict]]) -> bytes:
+        parts = []
+        for (service, records) in records_by_service.items():
+            (prefix, suffix) = self._envelope(kind, service)
+            parts.append(prefix + json.dumps(records, separators=(",", ":")).encode("utf-8") + suffix)
+        return (b'{"resourceSpans":[' if kind == "spans" else b'{"resourceLogs":[') + b",".join(parts) + b"]}"
+
+# Protobuf wire format: https://protobuf.dev/programming-guides/encoding/
+# Field numbers from opentelemetry-proto: collector/{trace,logs}/v1, trace/v1/trace.proto, logs/v1/logs.proto, common/v1/common.proto
+
+def _varint(n: int) -> bytes:
+    if n < 0x80:
+        return bytes((n,))
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+def _tag(field: int, wire_type: int) -> bytes:
+    return _varint(field << 3 | wire_type)
+
+def _length_delimited(field: int, data: bytes) -> bytes:
+    if field < 16 and len(data) < 0x80:
+        # Most fields: 1 byte tag and 1 byte length
+        return bytes((field << 3 | 2, len(data))) + data
+    return _tag(field, 2) + _varint(len(data)) + data
+
+def _string(field: int, value: str) -> bytes:
+    return _length_delimited(field, value.encode("utf-8"))
+
+def _fixed64(field: int, value: int) -> bytes:
+    return _tag(field, 1) + struct.pack("<Q", value)
+
+def _any_value(value: dict) -> bytes:
+    if "stringValue" in value:
+        return _string(1, value["stringValue"])
+    if "boolValue" in value:
+        return _tag(2, 0) + _varint(int(bool(value["boolValue"])))
+    if "intValue" in value:
+        # int64 as varint, negative numbers in two's complement. OTLP/JSON allows int64 as strings
+        return _tag(3, 0) + _varint(int(value["intValue"]) & 0xffffffffffffffff)
+    if "doubleValue" in value:
+        return _tag(4, 1) + struct.pack("<d", float(value["doubleValue"]))
+    raise ValueError(f"Unsupported attribute value: {value}")
+
+def _attributes(field: int, attributes: list[dict]) -> bytes:
+    return b"".join(_length_delimited(field, _string(1, kv["key"]) + _length_delimited(2, _any_value(kv["value"]))) for kv in attributes)
+
+# Tags and fixed size fields of spans and log records, packed at once
+_span_times = struct.Struct("<BQBQ") # start_time_unix_nano = 7, end_time_unix_nano = 8
+_log_time = struct.Struct("<BQ") # time_unix_nano = 1 (observed_time_unix_nano = 11 has a 1 byte tag as well)
+
+def _span(span: dict) -> bytes:
+    parent_span_id = span.get("parentSpanId")
+    name = span["name"].encode("utf-8")
+    out = b"".join((
+        _length_delimited(1, bytes.fromhex(span["traceId"])),
+        _length_delimited(2, bytes.fromhex(span["spanId"])),
+        _length_delimited(4, bytes.fromhex(parent_span_id)) if parent_span_id else b"",
+        b"\x2a", _varint(len(name)), name,
+        b"\x30", _varint(span["kind"]),
+        _span_times.pack(0x39, span["startTimeUnixNano"], 0x41, span["endTimeUnixNano"]),
+        _attributes(9, span["attributes"]) if span.get("attributes") else b"",
+    ))
+    # status = 15: {code = 3}
+    return out + b"\x7a\x02\x18" + bytes((span["status"]["code"],))
+
+def _log_record(log: dict) -> bytes:
+    return b"".join((
+        _log_time.pack(0x09, log["timeUnixNano"]),
+        b"\x10", _varint(log["severityNumber"]),
+        _length_delimited(5, _any_value(log["body"])),
+        _attributes(6, log["attributes"]) if log.get("attributes") else b"",
+        _length_delimited(9, bytes.fromhex(log["traceId"])),
+        _length_delimited(10, bytes.fromhex(log["spanId"])),
+        _log_time.pack(0x59, log["observedTimeUnixNano"]),
+    ))
+
+class ProtobufEncoder:
+    content_type = "application/x-protobuf"
+
+    def __init__(self):
+        self._resources: dict[str, bytes] = {}
+
+    def _resource(self, service: str) -> bytes:
+        """Returns the encoded resource field, shared by ResourceSpans and ResourceLogs"""
+        resource = self._resources.get(service)
+        if resource is None:
+            resource = _length_delimited(1, _attributes(1, [{"key": "service.name", "value": {"stringValue": service}}]))
+            if len(self._resources) >= _MAX_ENVELOPES:
+                self._resources.clear()
+            self._resources[service] = resource
+        return resource
+
+    def encode(self, kind: Kind, records_by_service: dict[str, list[dict]]) -> bytes:
+        encode_record = _span if kind == "spans" else _log_record
+        out = bytearray()
+        for (service, records) in records_by_service.items():
+            scope = b"".join(_length_delimited(2, encode_record(record)) for record in records)
+            # {Export*ServiceRequest.resource_*: {resource, scope_*: {records}}}
+            out += _length_delimited(1, self._resource(service) + _length_delimited(2, scope))
+        return bytes(out)
+
+def create_encoder(encoding: Encoding) -> JsonEncoder|ProtobufEncoder:
+    return ProtobufEncoder() if encoding == "protobuf" else JsonEncoder()
+
+def _parse(data: bytes) -> list[tuple[int, int|bytes]]:
+    """Decodes one level of protobuf fields as [(field, value)]. Length-delimited values are left as bytes"""
+    (fields, i) = ([], 0)
+    while i < len(data):
+        (key, i) = _parse_varint(data, i)
+        (field, wire_type) = (key >> 3, key & 7)
+        if wire_type == 0:
+            (value, i) = _parse_varint(data, i)
+        elif wire_type == 1:
+            (value, i) = (struct.unpack_from("<Q", data, i)[0], i + 8)
+        elif wire_type == 2:
+            (length, i) = _parse_varint(data, i)
+            (value, i) = (data[i:i + length], i + length)
+        else:
+            raise ValueError(f"Unsupported wire type {wire_type}")
+        fields.append((field, value))
+    return fields
+
+def _parse_varint(data: bytes, i: int) -> tuple[int, int]:
+    (value, shift) = (0, 0)
+    while True:
+        b = data[i]
+        value |= (b & 0x7f) << shift
+        i += 1
+        if b < 0x80:
+            return (value, i)
+        shift += 7
+
+_test_span = {"traceId": "0af7651916cd43dd8448eb211c80319c", "spanId": "b7ad6b7169203331", "parentSpanId": None,
+              "startTimeUnixNano": 1700000000000000000, "endTimeUnixNano": 1700000001000000000, "name": "step: build", "kind": 2, "status": {"code": 1},
+              "attributes": [{"key": "process.cpu.user", "value": {"doubleValue": 1.5}}, {"key": "process.rss", "value": {"intValue": 300}}]}
+
+def test_json_encoder_matches_generic_payload():
+    payload = json.loads(JsonEncoder().encode("spans", {"a": [_test_span, _test_span], "b": [_test_span]}))
+    assert payload == {"resourceSpans": [
+        {"resource": {"attributes": [{"key": "service.name", "value": {"stringValue": service}}]}, "scopeSpans": [{"spans": [_test_span] * n}]}
+        for (service, n) in (("a", 2), ("b", 1))
+    ]}
+    log = {"timeUnixNano": 1, "observedTimeUnixNano": 1, "severityNumber": 9, "traceId": "t", "spanId": "s", "body": {"stringValue": "\"hi\"\n"}}
+    assert json.loads(JsonEncoder().encode("logs", {"a": [log]}))["resourceLogs"][0]["scopeLogs"][0]["logRecords"] == [log]
+
+def _single(fields: list[tuple[int, int|bytes]], field: int) -> int|bytes:
+    values = [value for (f, value) in fields if f == field]
+    assert len(values) == 1, fields
+    return values[0]
+
+def test_protobuf_encoder_follows_otlp_field_numbers():
+    encoder = ProtobufEncoder()
+    resource_spans = _parse(_single(_parse(encoder.encode("spans", {"svc": [_test_span]})), 1))
+    attribute = _single(_parse(_single(resource_spans, 1)), 1)
+    assert _parse(attribute) == [(1, b"service.name"), (2, _string(1, "svc"))]
+    span = _parse(_single(_parse(_single(resource_spans, 2)), 2))
+    assert span[:6] == [(1, bytes.fromhex(_test_span["traceId"])), (2, bytes.fromhex(_test_span["spanId"])), (5, b"step: build"), (6, 2), (7, 1700000000000000000), (8, 1700000001000000000)]
+    assert [field for (field, _) in span[6:]] == [9, 9, 15]
+    assert _parse(_single(_parse(span[7][1]), 2)) == [(3, 300)]
+    assert _parse(span[8][1]) == [(3, 1)]
+
+    log = {"timeUnixNano": 5, "observedTimeUnixNano": 6, "severityNumber": 17, "traceId": _test_span["traceId"], "spanId": _test_span["spanId"], "body": {"stringValue": "failed"}}
+    resource_logs = _parse(_single(_parse(encoder.encode("logs", {"svc": [log]})), 1))
+    record = _parse(_single(_parse(_single(resource_logs, 2)), 2))
+    assert record == [(1, 5), (2, 17), (5, _string(1, "failed")), (9, bytes.fromhex(log["traceId"])), (10, bytes.fromhex(log["spanId"])), (11, 6)]
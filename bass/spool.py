@@ -0,0 +1,271 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+from typing import Callable, Literal
+
+# "drained": nothing left to replay, "failed": post() failed, "busy": another process is replaying
+type ReplayResult = Literal["drained", "failed", "busy"]
+
+class TelemetrySpool:
+    """Append-only, on-disk spool of OTLP payloads which could not be posted, to be replayed once the collector is back.
+
+    Each spool appends to a segment file of its own ('<pid>-<n>.open'), which is sealed ('.seg') once it grows
+    beyond segment_bytes, before replaying, or upon close(). Sealed segments are replayed oldest first by whichever
+    process holds the replay lock - so several processes, e.g. a worker and its builds, may share a spool directory.
+    Open segments are flock'ed by their writer. Those no longer locked - left by a process which exited - are sealed
+    on startup and before replaying. Payloads are rejected once the spool holds max_bytes.
+
+    Every entry of a segment is a JSON header line, followed by the encoded payload of header["size"] bytes. The offset
+    of the first entry not yet posted is kept in '<segment>.pos' while replaying, so a replay which is interrupted -
+    e.g. by the process exiting - posts no entry twice the next time."""
+
+    def __init__(self, path: str, max_bytes: int = 256 * 1024 * 1024, segment_bytes: int = 4 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self._lock = threading.Lock()
+        self._file = None
+        self._file_path = None
+        self._segment_seq = 0
+        self.counters = {"spooled": 0, "rejected": 0, "replayed": 0}
+        os.makedirs(path, exist_ok=True)
+        self._seal_abandoned()
+        self._bytes = self._size()
+
+    def _seal_abandoned(self):
+        for name in os.listdir(self.path):
+            if not name.endswith(".open"):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                with open(path, "rb") as f:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        # Still being written
+                        continue
+                    os.replace(path, path.removesuffix(".open") + ".seg")
+            except FileNotFoundError:
+                # Sealed by another process
+                pass
+
+    def _create_segment(self):
+        """Creates a segment of a name no other segment has, and locks it before it is visible as open"""
+        while True:
+            self._segment_seq += 1
+            stem = os.path.join(self.path, f"{os.getpid()}-{self._segment_seq:06d}")
+            if os.path.exists(f"{stem}.open") or os.path.exists(f"{stem}.seg"):
+                # Left by an earlier process of the same pid, or by another spool of this one
+                continue
+            try:
+                fd = os.open(f"{stem}.new", os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND)
+            except FileExistsError:
+                continue
+            self._file = os.fdopen(fd, "ab")
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+            self._file_path = f"{stem}.open"
+            os.replace(f"{stem}.new", self._file_path)
+            return
+
+    def _position(self, segment_path: str) -> int:
+        """Returns the offset to replay the segment from"""
+        try:
+            with open(f"{segment_path}.pos") as f:
+                return int(f.read() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _segments(self) -> list[str]:
+        """Returns the sealed segments, oldest first"""
+        segments = [name for name in os.listdir(self.path) if name.endswith(".seg")]
+        return sorted(segments, key=lambda name: (os.stat(os.path.join(self.path, name)).st_mtime_ns, name))
+
+    def _size(self) -> int:
+        total = 0
+        for name in os.listdir(self.path):
+            if name.endswith(".seg") or name.endswith(".open"):
+                try:
+                    total += os.stat(os.path.join(self.path, name)).st_size
+                except FileNotFoundError:
+                    pass
+        return total
+
+    def append(self, endpoint: str, kind: str, content_type: str, payload: bytes, num_records: int) -> bool:
+        """Spools an encoded payload for later replay. Returns False if the spool is full"""
+        header = {"endpoint": endpoint, "kind": kind, "content_type": content_type, "records": num_records, "size": len(payload)}
+        line = json.dumps(header).encode("utf-8") + b"\n" + payload
+        with self._lock:
+            if self._bytes + len(line) > self.max_bytes:
+                # Other processes may have replayed in the meantime
+                self._bytes = self._size()
+                if self._bytes + len(line) > self.max_bytes:
+                    self.counters["rejected"] += num_records
+                    return False
+
+            if self._file is None:
+                self._create_segment()
+            self._file.write(line)
+            self._file.flush()
+            self._bytes += len(line)
+            self.counters["spooled"] += num_records
+
+            if self._file.tell() >= self.segment_bytes:
+                self._seal()
+        return True
+
+    def _seal(self):
+        if self._file is None:
+            return
+        # Renamed while still locked, not to be sealed by another process as well
+        os.replace(self._file_path, self._file_path.removesuffix(".open") + ".seg")
+        self._file.close()
+        (self._file, self._file_path) = (None, None)
+
+    def close(self):
+        with self._lock:
+            self._seal()
+
+    @staticmethod
+    def _entries(f):
+        """Yields (offset, header, payload) of the entries of a segment. Stops at an entry torn by a crashed process"""
+        while True:
+            offset = f.tell()
+            line = f.readline()
+            if not line:
+                return
+            try:
+                header = json.loads(line)
+                payload = f.read(header["size"])
+            except (ValueError, KeyError):
+                payload = None
+            if payload is None or len(payload) < header["size"]:
+                logging.warning(f"Skipping incomplete telemetry spool entry in {f.name}")
+                return
+            yield (offset, header, payload)
+
+    def backlog(self) -> dict[str, int]:
+        """Returns the number of payloads, records and bytes waiting to be replayed"""
+        (payloads, records, size) = (0, 0, 0)
+        for name in os.listdir(self.path):
+            if not (name.endswith(".seg") or name.endswith(".open")):
+                continue
+            try:
+                with open(os.path.join(self.path, name), "rb") as f:
+                    if name.endswith(".seg"):
+                        f.seek(self._position(f.name))
+                    for (_, header, _) in self._entries(f):
+                        payloads += 1
+                        records += header["records"]
+                    size += f.tell() - (self._position(f.name) if name.endswith(".seg") else 0)
+            except FileNotFoundError:
+                pass
+        return {"payloads": payloads, "records": records, "bytes": size}
+
+    def has_backlog(self) -> bool:
+        """Returns True if this process has spooled payloads, or any process has sealed segments to replay"""
+        with self._lock:
+            if self._file is not None:
+                return True
+        return any(name.endswith(".seg") for name in os.listdir(self.path))
+
+    def replay(self, post: Callable[[str, str, str, bytes], bool]) -> ReplayResult:
+        """Posts spooled payloads oldest first by post(endpoint, kind, content_type, payload), until it fails"""
+        with self._lock:
+            self._seal()
+            # Also those of processes which exited since, e.g. killed builds
+            self._seal_abandoned()
+
+        with open(os.path.join(self.path, "replay.lock"), "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return "busy"
+
+            for name in self._segments():
+                segment_path = os.path.join(self.path, name)
+                with open(segment_path, "rb") as f:
+                    f.seek(self._position(segment_path))
+                    for (_, header, payload) in self._entries(f):
+                        if not post(header["endpoint"], header["kind"], header["content_type"], payload):
+                            return "failed"
+
+                        # Not to post the same payloads twice, should the replay be interrupted
+                        with open(f"{segment_path}.pos", "w") as pos:
+                            pos.write(str(f.tell()))
+                        with self._lock:
+                            self.counters["replayed"] += header["records"]
+
+                os.remove(segment_path)
+                try:
+                    os.remove(f"{segment_path}.pos")
+                except FileNotFoundError:
+                    pass
+                with self._lock:
+                    self._bytes = self._size()
+
+        return "drained"
+
+def test_spool_replays_in_order_and_keeps_the_remainder(tmp_path):
+    spool = TelemetrySpool(str(tmp_path), segment_bytes=200)
+    for i in range(5):
+        assert spool.append("http://collector", "spans", "application/json", json.dumps({"i": i}).encode() + b"\n", 2)
+    assert spool.backlog() == {"payloads": 5, "records": 10, "bytes": spool.backlog()["bytes"]}
+
+    posted = []
+    def post(endpoint, kind, content_type, payload):
+        if len(posted) == 3:
+            return False
+        posted.append(json.loads(payload)["i"])
+        return True
+    assert spool.replay(post) == "failed"
+    assert spool.backlog()["payloads"] == 2
+
+    # Left to the process replaying
+    with open(os.path.join(str(tmp_path), "replay.lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        assert spool.replay(post) == "busy"
+
+    # A new process picks up where the previous one left
+    spool.close()
+    # Including a payload torn by a crash
+    with open(os.path.join(str(tmp_path), f"{2**22 + 1}-000001.open"), "wb") as f:
+        f.write(b'{"endpoint": "http://collector", "kind": "spans", "content_type": "application/json", "records": 1, "size": 100}\n{"i": 5')
+    spool = TelemetrySpool(str(tmp_path), segment_bytes=200)
+    assert spool.replay(lambda endpoint, kind, content_type, payload: posted.append(json.loads(payload)["i"]) or True) == "drained"
+    assert posted == [0, 1, 2, 3, 4]
+    assert not spool.has_backlog()
+    assert os.listdir(str(tmp_path)) == ["replay.lock"]
+
+def test_spool_leaves_segments_open_in_this_process_alone(tmp_path):
+    spool = TelemetrySpool(str(tmp_path))
+    assert spool.append("http://collector", "logs", "application/json", b'{"i": 0}', 1)
+    # E.g. replacing the exporter's spool
+    other = TelemetrySpool(str(tmp_path))
+    posted = []
+    post = lambda endpoint, kind, content_type, payload: posted.append(payload) or True
+    assert other.replay(post) == "drained"
+    assert posted == []
+
+    assert spool.append("http://collector", "logs", "application/json", b'{"i": 1}', 1)
+    assert other.append("http://collector", "logs", "application/json", b'{"i": 2}', 1)
+    assert spool._file_path != other._file_path
+    spool.close()
+    other.close()
+    assert other.replay(post) == "drained"
+    assert sorted(posted) == [b'{"i": 0}', b'{"i": 1}', b'{"i": 2}']
+
+def test_spool_sees_segments_sealed_by_other_processes(tmp_path):
+    spool = TelemetrySpool(str(tmp_path))
+    assert not spool.has_backlog()
+    other = TelemetrySpool(str(tmp_path))
+    other.append("http://collector", "logs", "application/json", b"{}", 1)
+    other.close()
+    assert spool.has_backlog()
+
+def test_spool_rejects_beyond_max_bytes(tmp_path):
+    spool = TelemetrySpool(str(tmp_path), max_bytes=300)
+    assert spool.append("http://collector", "logs", "application/x-protobuf", b"y" * 100, 1)
+    assert not spool.append("http://collector", "logs", "application/x-protobuf", b"y" * 200, 1)
+    assert spool.counters["rejected"] == 1
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""Measures what bass.core itself costs pr step, without the cost of the steps.
+
+Runs synthetic pipelines through build_inner() with a TestIoContext - so no process is started - exporting telemetry
+to an in-process stand-in collector. Reports wall and CPU time pr exec step, threads started and alive at most,
+telemetry posted and peak Python memory (traced in a separate run, not to skew the timings).
+
+Scenarios:
+    wide        --width exec steps in one unordered node
+    deep        --depth nested nodes, each with an exec step
+    unordered   --groups unordered nodes of --width exec steps each, in an unordered root
+    changeset   --width conditional exec steps, against a changeset of --paths paths
+
+Pipelines are run by build_inner(), or by bass.aio.build_async() given --engine asyncio.
+
+Results may be written as JSON, and compared against a JSON written earlier, e.g. by another commit:
+
+    python3 benchmarks/bench_builder.py --json before.json
+    git checkout other-branch
+    python3 benchmarks/bench_builder.py --compare before.json
+"""
+import argparse
+import asyncio
+import http.server as server
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import bass.core
+from bass.aio import build_async
+from bass.core import TestIoContext, TelemetryExporter, build_inner, exec_steps
+
+# Metrics where more is worse, compared by --compare
+METRICS = ["us_pr_step", "cpu_us_pr_step", "threads_started", "threads_peak", "telemetry_bytes", "telemetry_requests", "peak_memory_kb"]
+
+
+class BenchIoContext(TestIoContext):
+    """Returns output_lines lines of output for every command, without recording the commands"""
+
+    def __init__(self, output_lines: int):
+        super().__init__()
+        self.output = "".join(f"line {i} of step output\n" for i in range(output_lines))
+
+    def run(self, cmd, timeout, cancel=None, on_usage=None):
+        return (0, self.output, "")
+
+
+class Sink:
+    """Stand-in otel collector, counting what it receives"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        (self.bytes, self.requests) = (0, 0)
+        sink = self
+
+        class Handler(server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                with sink.lock:
+                    sink.bytes += len(body)
+                    sink.requests += 1
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def take(self) -> tuple[int, int]:
+        with self.lock:
+            counts = (self.bytes, self.requests)
+            (self.bytes, self.requests) = (0, 0)
+        return counts
+
+
+def scenarios(args) -> dict[str, tuple[dict, list[str]]]:
+    """Returns {name: (pipeline, changeset)}"""
+    rng = random.Random(args.seed)
+
+    wide = {"name": "root", "order": "unordered", "steps": [{"name": f"step{i}", "exec": f"step{i}.sh"} for i in range(args.width)]}
+
+    deep = {"name": "level0", "steps": []}
+    node = deep
+    for i in range(1, args.depth):
+        child = {"name": f"level{i}", "steps": []}
+        node["steps"] += [{"name": f"step{i}", "exec": f"step{i}.sh"}, child]
+        node = child
+    node["steps"].append({"name": "leaf", "exec": "leaf.sh"})
+
+    unordered = {"name": "root", "order": "unordered", "steps": [
+        {"name": f"group{g}", "order": "unordered", "steps": [{"name": f"step{i}", "exec": f"step{g}-{i}.sh"} for i in range(args.width)]}
+        for g in range(args.groups)
+    ]}
+
+    changed_dirs = rng.sample(range(args.width), max(1, args.width // 10))
+    changeset = [f"components/c{rng.choice(changed_dirs)}/src/file{i}.py" for i in range(args.paths)]
+    conditional = {"name": "root", "steps": [
+        {"name": f"step{i}", "if-changeset-matches": f"^components/c{i}/", "exec": f"step{i}.sh"} for i in range(args.width)
+    ]}
+
+    return {"wide": (wide, []), "deep": (deep, []), "unordered": (unordered, []), "changeset": (conditional, changeset)}
+
+
+def run_once(args, sink: Sink, pipeline: dict, changeset: list[str], trace_memory: bool) -> dict:
+    exporter = TelemetryExporter()
+    bass.core._exporter = exporter
+    namespace = argparse.Namespace(root=".", traces_endpoint=f"{sink.url}/v1/traces", logs_endpoint=f"{sink.url}/v1/logs", service_name="bench", trace_id=bass.core.generate_trace_id(),
+                                   output_mode=args.output_mode, max_parallel=args.max_parallel, cpu_budget=args.max_parallel, mem_budget=None)
+    io = BenchIoContext(args.output_lines)
+
+    # Counting threads started, and sampling how many are alive
+    started = [0]
+    original_start = threading.Thread.start
+    def counting_start(thread):
+        started[0] += 1
+        original_start(thread)
+    threads_before = threading.active_count()
+    peak = [0]
+    sampling = threading.Event()
+    def sample():
+        while not sampling.wait(0.001):
+            peak[0] = max(peak[0], threading.active_count() - threads_before - 1)
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    threading.Thread.start = counting_start
+
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        time_start = time.perf_counter()
+        cpu_start = time.process_time()
+        if args.engine == "asyncio":
+            asyncio.run(build_async(io, namespace, pipeline, bass.core.generate_span_id(), changeset))
+        else:
+            build_inner(io, namespace, pipeline, bass.core.generate_span_id(), changeset)
+        wall = time.perf_counter() - time_start
+        cpu = time.process_time() - cpu_start
+        peak_memory = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+        threading.Thread.start = original_start
+        sampling.set()
+        sampler.join()
+
+    exporter.shutdown(30)
+    (telemetry_bytes, telemetry_requests) = sink.take()
+    stats = exporter.stats()
+    return {"wall": wall, "cpu": cpu, "threads_started": started[0], "threads_peak": peak[0], "telemetry_bytes": telemetry_bytes,
+            "telemetry_requests": telemetry_requests, "telemetry_records": stats["exported"], "peak_memory": peak_memory}
+
+
+def run_scenario(args, sink: Sink, pipeline: dict, changeset: list[str]) -> dict:
+    steps = len(exec_steps(pipeline))
+    runs = [run_once(args, sink, pipeline, changeset, trace_memory=False) for _ in range(args.repeat)]
+    best = min(runs, key=lambda x: x["wall"])
+    memory = run_once(args, sink, pipeline, changeset, trace_memory=True)["peak_memory"]
+    return {
+        "steps": steps,
+        "us_pr_step": best["wall"] / steps * 1e6,
+        "cpu_us_pr_step": min(x["cpu"] for x in runs) / steps * 1e6,
+        "threads_started": best["threads_started"],
+        "threads_peak": max(x["threads_peak"] for x in runs),
+        "telemetry_bytes": best["telemetry_bytes"],
+        "telemetry_requests": best["telemetry_requests"],
+        "telemetry_records": best["telemetry_records"],
+        "peak_memory_kb": memory / 1024,
+    }
+
+
+def git_revision() -> None|str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=["wide", "deep", "unordered", "changeset"], default=["wide", "deep", "unordered", "changeset"])
+    parser.add_argument("--width", type=int, default=200, help="Steps pr node of the wide, unordered and changeset scenarios")
+    parser.add_argument("--depth", type=int, default=100, help="Nesting depth of the deep scenario")
+    parser.add_argument("--groups", type=int, default=10, help="Unordered nodes of the unordered scenario")
+    parser.add_argument("--paths", type=int, default=50000, help="Paths in the changeset of the changeset scenario")
+    parser.add_argument("--output-lines", type=int, default=10, help="Lines of output pr step")
+    parser.add_argument("--output-mode", choices=["buffered", "streaming"], default="buffered")
+    parser.add_argument("--max-parallel", type=int, default=8)
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads", help="Run pipelines by build_inner() or bass.aio.build_async()")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs pr scenario. Timings of the fastest one are reported")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", type=str, default=None, help="Write results to this file")
+    parser.add_argument("--compare", type=str, default=None, help="Compare results to those of an earlier --json")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    sink = Sink()
+    results = {}
+    for (name, (pipeline, changeset)) in scenarios(args).items():
+        if name in args.scenarios:
+            results[name] = run_scenario(args, sink, pipeline, changeset)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"Compared to {baseline.get('revision') or args.compare}")
+
+    print(f"{'':12} {'steps':>6} {'us/step':>9} {'cpu us/step':>12} {'threads':>8} {'peak':>5} {'telemetry':>10} {'requests':>9} {'peak mem':>10}")
+    for (name, r) in results.items():
+        print(f"{name:12} {r['steps']:6d} {r['us_pr_step']:9.1f} {r['cpu_us_pr_step']:12.1f} {r['threads_started']:8d} {r['threads_peak']:5d} {r['telemetry_bytes'] / 1024:8.1f}kB {r['telemetry_requests']:9d} {r['peak_memory_kb'] / 1024:8.1f}MB")
+        before = baseline["scenarios"].get(name) if baseline else None
+        if before:
+            deltas = [f"{metric} {(r[metric] - before[metric]) / before[metric] * 100:+.0f}%" for metric in METRICS if before.get(metric)]
+            print(f"{'':12} vs baseline: {', '.join(deltas)}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"revision": git_revision(), "python": platform.python_version(), "args": vars(args), "scenarios": results}, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
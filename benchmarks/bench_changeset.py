@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""Compares bass.core.ChangesetMatcher against evaluating any_item_matches() pr conditional step, as the builder did before.
+
+Generates a changeset of --paths paths spread over --dirs top level directories, and a pipeline with --steps steps,
+each conditional on changes in a directory of its own. Only --changed-dirs of the directories are in the changeset,
+so most steps are skipped - which is the worst case for a linear scan pr step.
+
+    python3 benchmarks/bench_changeset.py --paths 50000 --steps 300
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bass.core import ChangesetMatcher, any_item_matches
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--paths", type=int, default=50000)
+    parser.add_argument("--steps", type=int, default=300)
+    parser.add_argument("--dirs", type=int, default=1000)
+    parser.add_argument("--changed-dirs", type=int, default=20)
+    parser.add_argument("--pattern-style", choices=["prefix", "regex"], default="prefix", help="'prefix': '^components/c1/'. 'regex': '/c1/.*\\.py$', not limited to a literal prefix")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    changed_dirs = rng.sample(range(args.dirs), args.changed_dirs)
+    changeset = [f"components/c{rng.choice(changed_dirs)}/src/module{i}/file{i}.py" for i in range(args.paths)]
+    pattern = "^components/c{i}/" if args.pattern_style == "prefix" else r"/c{i}/.*\.py$"
+    pipeline = {"name": "root", "order": "unordered", "steps": [
+        {"name": f"step{i}", "if-changeset-matches": pattern.format(i=i), "exec": "true"} for i in range(args.steps)
+    ]}
+
+    time_start = time.perf_counter()
+    old = [any_item_matches(changeset, step["if-changeset-matches"]) for step in pipeline["steps"]]
+    time_old = time.perf_counter() - time_start
+
+    time_start = time.perf_counter()
+    matcher = ChangesetMatcher(pipeline, changeset)
+    new = [matcher.matches(step["if-changeset-matches"]) for step in pipeline["steps"]]
+    time_new = time.perf_counter() - time_start
+
+    assert old == new
+    print(f"{args.paths} paths, {args.steps} conditional steps ({args.pattern_style}), {sum(new)} to run")
+    print(f"    any_item_matches: {time_old * 1e3:9.2f}ms")
+    print(f"    ChangesetMatcher: {time_new * 1e3:9.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
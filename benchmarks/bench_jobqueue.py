@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""Compares bass.jobqueue.JobQueue against the previous list scan used by the orchestrator's /dequeue.
+
+Queues --jobs jobs spread over --pipelines pipelines with random worker-tags, then dequeues them all from workers
+with random tag sets. Also times the worst case for the scan: a worker only eligible for the most recent job, and
+the common case of most pipelines having nothing queued: only --busy-pipelines of them.
+
+    python3 benchmarks/bench_jobqueue.py --jobs 10000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bass.jobqueue import JobQueue
+
+
+class ListScanQueue:
+    """The previous orchestrator implementation: a list scanned from the front on every dequeue"""
+    def __init__(self):
+        self.jobs = []
+
+    def put(self, job: dict, tags: frozenset[str]):
+        self.jobs.append(job)
+
+    def get(self, worker_tags: frozenset[str], wait: float = 0) -> None|dict:
+        for i, job in enumerate(self.jobs):
+            if set(job["pipeline"]["worker-tags"]).issubset(worker_tags):
+                return self.jobs.pop(i)
+        return None
+
+
+def run(queue_type, jobs: list[tuple[dict, frozenset[str]]], workers: list[frozenset[str]]) -> tuple[float, float, int]:
+    queue = queue_type()
+    time_start = time.perf_counter()
+    for (job, tags) in jobs:
+        queue.put(job, tags)
+    time_enqueue = time.perf_counter() - time_start
+
+    # Round-robin over workers until no one gets a job
+    dequeued = 0
+    time_start = time.perf_counter()
+    while True:
+        got_any = False
+        for worker_tags in workers:
+            if queue.get(worker_tags) is not None:
+                dequeued += 1
+                got_any = True
+        if not got_any:
+            break
+    time_dequeue = time.perf_counter() - time_start
+
+    return (time_enqueue, time_dequeue, dequeued)
+
+
+def run_worst_case(queue_type, jobs: list[tuple[dict, frozenset[str]]], rounds: int) -> float:
+    queue = queue_type()
+    for (job, tags) in jobs:
+        # Jobs without required tags would be eligible for the rare worker as well
+        if tags:
+            queue.put(job, tags)
+
+    rare = frozenset({"rare"})
+    time_start = time.perf_counter()
+    for _ in range(rounds):
+        queue.put({"name": "rare", "pipeline": {"worker-tags": ["rare"]}}, rare)
+        assert queue.get(rare) is not None
+    return (time.perf_counter() - time_start) / rounds
+
+
+def run_mostly_idle(queue_type, jobs: list[tuple[dict, frozenset[str]]], busy_pipelines: int) -> float:
+    queue = queue_type()
+    everything = frozenset(tag for (_, tags) in jobs for tag in tags)
+    # Every pipeline had a job queued at some point
+    for (job, tags) in {job["name"]: (job, tags) for (job, tags) in jobs}.values():
+        queue.put(job, tags)
+    while queue.get(everything) is not None:
+        pass
+
+    busy = sorted({job["name"] for (job, _) in jobs})[:busy_pipelines]
+    busy_jobs = [(job, tags) for (job, tags) in jobs if job["name"] in busy]
+    for (job, tags) in busy_jobs:
+        queue.put(job, tags)
+    time_start = time.perf_counter()
+    while queue.get(everything) is not None:
+        pass
+    return (time.perf_counter() - time_start) / max(1, len(busy_jobs))
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--jobs", type=int, default=10000)
+    parser.add_argument("--pipelines", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=20)
+    parser.add_argument("--tags", type=int, default=6, help="Size of the tag vocabulary")
+    parser.add_argument("--busy-pipelines", type=int, default=5, help="Pipelines with jobs queued, for the mostly idle case")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    vocabulary = [f"tag{i}" for i in range(args.tags)]
+    pipelines = {}
+    for i in range(args.pipelines):
+        worker_tags = rng.sample(vocabulary, rng.randint(0, 2))
+        pipelines[f"pipeline{i}"] = {"worker-tags": worker_tags}
+    tag_sets = {name: frozenset(p["worker-tags"]) for (name, p) in pipelines.items()}
+
+    jobs = []
+    for i in range(args.jobs):
+        name = rng.choice(list(pipelines))
+        jobs.append(({"name": name, "pipeline": pipelines[name]}, tag_sets[name]))
+    workers = [frozenset(rng.sample(vocabulary, rng.randint(1, args.tags))) for _ in range(args.workers)]
+
+    print(f"{args.jobs} jobs, {args.pipelines} pipelines, {len(set(tag_sets.values()))} distinct tag sets, {args.workers} workers")
+    for queue_type in (ListScanQueue, JobQueue):
+        (time_enqueue, time_dequeue, dequeued) = run(queue_type, jobs, workers)
+        worst = run_worst_case(queue_type, jobs, 100)
+        idle = run_mostly_idle(queue_type, jobs, args.busy_pipelines)
+        print(f"{queue_type.__name__:>14}: enqueue {time_enqueue / len(jobs) * 1e6:7.2f}us/job, dequeue {time_dequeue / max(1, dequeued) * 1e6:8.2f}us/job ({dequeued} dequeued), worst case dequeue {worst * 1e6:9.2f}us, mostly idle dequeue {idle * 1e6:7.2f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Compares enqueue/dequeue throughput of the in-memory job queue against the queue persisted by bass.jobqueue.JobJournal.
+
+Jobs are enqueued from --producers concurrent threads (as concurrent webhooks would), each waiting for its job to be
+durable. With more producers, more records share each fsync (group commit).
+
+    python3 benchmarks/bench_journal.py --jobs 5000 --producers 1 16 64
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bass.jobqueue import JobQueue, JobJournal
+
+
+def run(jobs: int, producers: int, journal: None|JobJournal) -> dict:
+    queue = JobQueue()
+    tags = frozenset({"linux"})
+    latencies = []
+    lock = threading.Lock()
+
+    def produce(first: int):
+        for i in range(first, jobs, producers):
+            job = {"id": str(i), "name": "bench", "pipeline": {"worker-tags": ["linux"]}, "env": {"key": "value"}}
+            t = time.perf_counter()
+            if journal:
+                journal.enqueue(job["id"], job, tags)
+            queue.put(job, tags)
+            with lock:
+                latencies.append(time.perf_counter() - t)
+
+    time_start = time.perf_counter()
+    threads = [threading.Thread(target=produce, args=(i,)) for i in range(producers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    time_enqueue = time.perf_counter() - time_start
+
+    time_start = time.perf_counter()
+    while job := queue.get(tags):
+        if journal:
+            journal.dequeue(job["id"])
+            journal.complete(job["id"], "OK")
+    if journal:
+        # Wait for every record to be durable
+        journal.append({"op": "noop"}, wait=True)
+    time_dequeue = time.perf_counter() - time_start
+
+    q = statistics.quantiles(latencies, n=100)
+    return {
+        "enqueue/s": jobs / time_enqueue,
+        "dequeue/s": jobs / time_dequeue,
+        "p50": q[49],
+        "p99": q[98],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--jobs", type=int, default=5000)
+    parser.add_argument("--producers", type=int, nargs="+", default=[1, 16, 64])
+    parser.add_argument("--dir", type=str, default=None, help="Folder to place the journal in. Defaults to a temporary folder")
+    args = parser.parse_args()
+
+    for producers in args.producers:
+        for mode in ("memory", "journal"):
+            journal = None
+            with tempfile.TemporaryDirectory(dir=args.dir) as tmpdir:
+                if mode == "journal":
+                    journal = JobJournal(os.path.join(tmpdir, "journal"))
+                    journal.replay()
+
+                result = run(args.jobs, producers, journal)
+
+                records_pr_commit = ""
+                if journal:
+                    journal.close()
+                    records_pr_commit = f", {journal.counters['records'] / journal.counters['commits']:.1f} records/fsync"
+
+            print(f"{mode:>8}, {producers:3} producers: enqueue {result['enqueue/s']:9.0f}/s (p50={result['p50'] * 1000:.2f}ms p99={result['p99'] * 1000:.2f}ms), dequeue+complete {result['dequeue/s']:9.0f}/s{records_pr_commit}")
+
+
+if __name__ == "__main__":
+    main()
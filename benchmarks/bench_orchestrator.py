@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""Measures webhook and dequeue throughput of the orchestrator with many concurrently polling workers.
+
+Runs the orchestrator in-process against a local stand-in collector, which can be made slow to show whether
+telemetry export stalls request handling. Example:
+
+    python3 benchmarks/bench_orchestrator.py --server-mode threaded --workers 100 --jobs 2000 --collector-delay 0.2
+    python3 benchmarks/bench_orchestrator.py --server-mode single --workers 100 --jobs 2000 --collector-delay 0.2
+    python3 benchmarks/bench_orchestrator.py --server-mode threaded --workers 100 --jobs 2000 --dequeue-wait 5
+"""
+import argparse
+import http.server as server
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import bass
+import orchestrator
+
+
+def percentiles(values: list[float]) -> str:
+    if len(values) < 2:
+        return "n/a"
+    q = statistics.quantiles(values, n=100)
+    return f"p50={q[49] * 1000:.1f}ms p99={q[98] * 1000:.1f}ms max={max(values) * 1000:.1f}ms"
+
+
+def start_collector(delay: float) -> server.HTTPServer:
+    class CollectorHandler(server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            time.sleep(delay)
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    httpd = server.ThreadingHTTPServer(("127.0.0.1", 0), CollectorHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--server-mode", choices=["threaded", "single"], default="threaded")
+    parser.add_argument("--workers", type=int, default=100, help="Number of concurrently polling workers")
+    parser.add_argument("--producers", type=int, default=4, help="Number of concurrent webhook senders")
+    parser.add_argument("--jobs", type=int, default=2000, help="Number of webhooks to send")
+    parser.add_argument("--poll-interval", type=float, default=0.1, help="Worker sleep after an empty dequeue")
+    parser.add_argument("--dequeue-wait", type=float, default=0.0, help="Seconds workers let the orchestrator hold each dequeue (long-poll). Threaded mode only")
+    parser.add_argument("--collector-delay", type=float, default=0.0, help="Seconds the stand-in collector takes pr request")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Give up after this many seconds")
+    args = parser.parse_args()
+
+    orchestrator.logging.getLogger().setLevel(orchestrator.logging.WARNING)
+    orchestrator.HTTPRequestHandler.log_message = lambda *args: None
+
+    collector = start_collector(args.collector_delay)
+    collector_url = f"http://127.0.0.1:{collector.server_address[1]}"
+
+    orchestrator.config["pipelines"] = {"bench": {"repository": "", "ref": "main", "exec": ["true"], "worker-tags": []}}
+    orchestrator.config["api-keys"] = {}
+    orchestrator.config["otel"]["traces-endpoint"] = f"{collector_url}/v1/traces"
+    orchestrator.config["otel"]["logs-endpoint"] = f"{collector_url}/v1/logs"
+
+    orchestrator.KeepAliveHTTPRequestHandler.max_dequeue_wait = args.dequeue_wait
+    httpd = orchestrator.create_server(("127.0.0.1", 0), args.server_mode)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{httpd.server_address[1]}"
+
+    # Every client thread may keep its own connection alive
+    pool = bass.core.ConnectionPool(max_idle_per_host=args.workers + args.producers)
+    lock = threading.Lock()
+    webhook_latencies: list[float] = []
+    dequeue_latencies: list[float] = []
+    pickup_latencies: list[float] = []
+    errors = [0]
+    sent = [0]
+    stop = threading.Event()
+
+    def producer():
+        while True:
+            with lock:
+                if sent[0] >= args.jobs:
+                    return
+                sent[0] += 1
+            t = time.monotonic()
+            (status, _) = pool.request("POST", f"{base}/webhook?pipeline=bench")
+            with lock:
+                webhook_latencies.append(time.monotonic() - t)
+                errors[0] += status != 200
+
+    def worker():
+        body = json.dumps({"tags": []}).encode("utf-8")
+        while not stop.is_set():
+            t = time.monotonic()
+            try:
+                (status, data) = pool.request("POST", f"{base}/dequeue?wait={args.dequeue_wait}", body, {"Content-Type": "application/json"})
+            except OSError:
+                (status, data) = (0, b"")
+            now = time.monotonic()
+            with lock:
+                dequeue_latencies.append(now - t)
+            if status == 200:
+                job = json.loads(data)
+                scheduled = bass.core.datetime.datetime.fromisoformat(job["schedule-time"])
+                with lock:
+                    pickup_latencies.append((bass.utcnow() - scheduled).total_seconds())
+            else:
+                with lock:
+                    errors[0] += status != 204
+                if args.dequeue_wait == 0:
+                    time.sleep(args.poll_interval)
+
+    workers = [threading.Thread(target=worker, daemon=True) for _ in range(args.workers)]
+    for t in workers:
+        t.start()
+
+    time_start = time.monotonic()
+    producers = [threading.Thread(target=producer) for _ in range(args.producers)]
+    for t in producers:
+        t.start()
+    for t in producers:
+        t.join()
+    time_webhooks = time.monotonic() - time_start
+
+    while len(pickup_latencies) < args.jobs and time.monotonic() - time_start < args.timeout:
+        time.sleep(0.01)
+    time_total = time.monotonic() - time_start
+    stop.set()
+
+    print(f"server mode:        {args.server_mode}")
+    print(f"workers:            {args.workers} (poll interval {args.poll_interval}s, dequeue wait {args.dequeue_wait}s)")
+    print(f"collector delay:    {args.collector_delay}s")
+    print(f"webhooks:           {args.jobs} in {time_webhooks:.2f}s = {args.jobs / time_webhooks:.0f}/s ({percentiles(webhook_latencies)})")
+    print(f"dequeue requests:   {len(dequeue_latencies)} in {time_total:.2f}s = {len(dequeue_latencies) / time_total:.0f}/s ({percentiles(dequeue_latencies)})")
+    print(f"jobs picked up:     {len(pickup_latencies)}/{args.jobs} ({percentiles(pickup_latencies)} after scheduling)")
+    print(f"errors:             {errors[0]}")
+
+    bass.get_exporter().flush(timeout=30)
+    httpd.shutdown()
+    collector.shutdown()
+
+
+if __name__ == "__main__":
+    main()
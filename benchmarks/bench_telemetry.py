@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""Compares bytes and CPU time pr span/log record of the OTLP encodings in bass.otlp against building the generic
+payload dicts and json.dumps'ing them - both pr record, as the builder did before the exporter batched records, and
+pr batch, as the exporter did before bass.otlp.
+
+Records are generated as the builder does: spans pr step and log records pr batch of output lines.
+
+    python3 benchmarks/bench_telemetry.py --records 20000 --batch-size 512
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bass.core import generate_span, generate_span_record, generate_spans_payload, generate_log, generate_log_record, generate_logs_payload, generate_trace_id, generate_span_id, utcnow
+from bass.otlp import JsonEncoder, ProtobufEncoder
+
+
+def per_record(kind: str, args_list: list[tuple]) -> list[bytes]:
+    if kind == "spans":
+        return [json.dumps(generate_span(*args)).encode("utf-8") for args in args_list]
+    return [json.dumps(generate_log(*args)).encode("utf-8") for args in args_list]
+
+def records(kind: str, args_list: list[tuple]) -> list[dict]:
+    if kind == "spans":
+        return [generate_span_record(a[0], a[1], a[2], a[4], a[5], a[6], a[7]) for a in args_list]
+    return [generate_log_record(a[0], a[1], a[3], a[4]) for a in args_list]
+
+def batches(kind: str, args_list: list[tuple], batch_size: int) -> list[list[dict]]:
+    all_records = records(kind, args_list)
+    return [all_records[i:i + batch_size] for i in range(0, len(all_records), batch_size)]
+
+def batched_dicts(kind: str, args_list: list[tuple], batch_size: int, service: str) -> list[bytes]:
+    generate_payload = generate_spans_payload if kind == "spans" else generate_logs_payload
+    return [json.dumps(generate_payload({service: batch})).encode("utf-8") for batch in batches(kind, args_list, batch_size)]
+
+def encoded(encoder, kind: str, args_list: list[tuple], batch_size: int, service: str) -> list[bytes]:
+    return [encoder.encode(kind, {service: batch}) for batch in batches(kind, args_list, batch_size)]
+
+def measure(fn, repeat: int) -> tuple[float, list[bytes]]:
+    best = None
+    for _ in range(repeat):
+        t = time.process_time()
+        bodies = fn()
+        elapsed = time.process_time() - t
+        best = elapsed if best is None else min(best, elapsed)
+    return (best, bodies)
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--batch-size", type=int, default=512, help="Records pr payload, as --max-batch-size of the exporter")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs pr encoding. The fastest one is reported")
+    args = parser.parse_args()
+
+    service = "bass:pipeline:bench"
+    trace_id = generate_trace_id()
+    root_span_id = generate_span_id()
+    now = utcnow()
+
+    span_args = [(trace_id, root_span_id, generate_span_id(), service, f"step: compile module{i}", now, now, 1) for i in range(args.records)]
+    log_args = [(trace_id, root_span_id, service, "INFO", f"[{i}/{args.records}] Compiling src/module{i}/file.c\n" * 4) for i in range(args.records)]
+    args_by_kind = {"spans": span_args, "logs": log_args}
+
+    print(f"{args.records} records pr kind, {args.batch_size} pr payload. CPU time includes generating the records")
+    for kind in ("spans", "logs"):
+        args_list = args_by_kind[kind]
+        variants = [
+            ("dict + json pr record", lambda: per_record(kind, args_list)),
+            ("dict + json pr batch", lambda: batched_dicts(kind, args_list, args.batch_size, service)),
+            ("JsonEncoder", lambda: encoded(JsonEncoder(), kind, args_list, args.batch_size, service)),
+            ("ProtobufEncoder", lambda: encoded(ProtobufEncoder(), kind, args_list, args.batch_size, service)),
+        ]
+        print(f"\n{kind}:")
+        print(f"    {'':24} {'us/record':>10} {'bytes/record':>13} {'gzip bytes/record':>18}")
+        for (name, fn) in variants:
+            (elapsed, bodies) = measure(fn, args.repeat)
+            size = sum(len(body) for body in bodies)
+            gzip_size = sum(len(gzip.compress(body)) for body in bodies)
+            print(f"    {name:24} {elapsed / args.records * 1e6:10.2f} {size / args.records:13.1f} {gzip_size / args.records:18.1f}")
+
+
+if __name__ == "__main__":
+    main()
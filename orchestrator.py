@@ -3,25 +3,77 @@ import logging
 import http.server as server
 import json
 import os
+import sys
 import signal
 import argparse
+import threading
+import time
+import re
+import datetime
+import math
+import heapq
 import bass
+from bass.jobqueue import JobQueue, JobJournal, JournalError
+from bass.metrics import Registry, Counter, Gauge, Histogram
 
 logging.getLogger().setLevel(logging.INFO)
 
-# Will be propulated with configurations read from files according to arguments passed upon startup
+# Will be propulated with configurations read from files according to arguments passed upon startup.
+# Never modified once loaded, but replaced as a whole upon reload - see reload_config(). Request handlers
+# shall read the global once, to see a consistent configuration throughout a request
 config = {
     "pipelines": {}, # <pipelinename>: {}-entries
     "env": {}, # <key>:<value>-entries
     "api-keys": {}, # <key>:True-entries
+    "tag-sets": {}, # <pipelinename>: frozenset of worker-tags
+    "tag-patterns": {}, # <pipelinename>: compiled tag-pattern, for pipelines having one
     "otel": {
         "traces-endpoint": "http://localhost:4318/v1/traces",
         "logs-endpoint": "http://localhost:4318/v1/logs"
     }
 }
 
-# The job queue to be processed
-job_queue = []
+# The job queue to be processed. Thread-safe, and indexed by the worker-tags required by each job
+job_queue = JobQueue()
+
+# Optional persistence of the job queue, see --journal-file
+job_journal: None|JobJournal = None
+
+# <job id>: (<pipelinename>, <worker id>, <time dequeued>) of jobs handed out to workers, for releasing their pipeline's concurrency upon completion
+in_flight_jobs: dict[str, tuple[str, str, float]] = {}
+# (<time dequeued>, <job id>) of in-flight jobs, oldest first, for expireJobs. Entries of jobs since completed are skipped
+in_flight_heap: list[tuple[float, str]] = []
+# Guards in_flight_jobs, in_flight_heap and workers_seen
+in_flight_jobs_lock = threading.Lock()
+# Seconds a job may be in flight before its pipeline's concurrency is released anyway, in case its completion is never reported
+in_flight_lease = 6 * 3600.0
+
+# <worker id>: time last seen polling /dequeue. Workers not seen for this many seconds are no longer counted
+workers_seen: dict[str, float] = {}
+worker_seen_timeout = 120.0
+
+def worker_states() -> dict[tuple[str], int]:
+    now = time.monotonic()
+    with in_flight_jobs_lock:
+        for (worker_id, last_seen) in list(workers_seen.items()):
+            if now - last_seen > worker_seen_timeout:
+                del workers_seen[worker_id]
+        active = {worker_id for (_, worker_id, _) in in_flight_jobs.values()}
+        return {("active",): len(active), ("idle",): len(workers_seen.keys() - active)}
+
+def see_worker(worker_id: str):
+    with in_flight_jobs_lock:
+        workers_seen[worker_id] = time.monotonic()
+
+# Served at GET /metrics
+metrics = Registry()
+webhook_requests = metrics.register(Counter("bass_webhook_requests_total", "Webhook requests by outcome", ("outcome",)))
+request_duration = metrics.register(Histogram("bass_http_request_duration_seconds", "Request handling time by endpoint. For dequeue, including waiting for a job", ("endpoint",)))
+queue_wait = metrics.register(Histogram("bass_job_queue_wait_seconds", "Time from enqueue to dequeue of jobs", ("pipeline",)))
+metrics.register(Gauge("bass_job_queue_depth", "Jobs queued by the worker-tags they require", ("tags",), lambda: {(",".join(sorted(tags)),): n for (tags, n) in job_queue.depths().items()}))
+metrics.register(Gauge("bass_jobs_in_flight", "Jobs handed out to workers and not yet reported complete", ("pipeline",), lambda: {(name,): x["in-flight"] for (name, x) in job_queue.stats().items() if name is not None}))
+metrics.register(Gauge("bass_workers", "Workers recently seen through /dequeue, by whether they have a job in flight", ("state",), worker_states))
+job_queue.on_dequeue = lambda pipeline_name, wait: queue_wait.observe(wait, pipeline_name or "")
 
 # Called periodically to check all registered jobs who require pull-checks
 # Att! Requires local state. Can be in-memory to begin with, but would need persistence at some point
@@ -29,9 +81,132 @@ def checkForPullChanges():
     # eventually scheduleJob(...)
     pass
 
-# Result of either onIncomingJob or checkForPullChanges to schedule a job to be done
-def scheduleJob(job: dict):
-    job_queue.append(job)
+def count_webhook(outcome: str):
+    """Outcomes: received, suppressed, scheduled, merged or superseded"""
+    webhook_requests.inc(outcome)
+
+def coalesce_key(job: dict) -> None|tuple[str, str]:
+    """Jobs of pipelines with a "coalesce"-policy are combined with a queued job for the same pipeline and ref"""
+    if job["pipeline"].get("coalesce", "none") == "none":
+        return None
+    return (job["name"], job["pipeline"]["ref"])
+
+def union_changed_refs(a: list[str], b: list[str]) -> list[str]:
+    # No changed refs means everything changed
+    if not a or not b:
+        return []
+    return list(dict.fromkeys(a + b))
+
+def combine_jobs(queued: dict, job: dict) -> None|dict:
+    """"merge": the queued job also covers the changed refs of job. "supersede": job replaces the queued one, and covers its changed refs"""
+    changed_refs = union_changed_refs(queued.get("changed-refs", []), job.get("changed-refs", []))
+    if job["pipeline"].get("coalesce") == "supersede":
+        job["changed-refs"] = changed_refs
+        return job
+
+    queued["changed-refs"] = changed_refs
+    return None
+
+# Result of either onIncomingJob or checkForPullChanges to schedule a job to be done.
+# Returns the outcome: "scheduled", "merged" or "superseded", and the queued job combined with, if any
+def scheduleJob(job: dict) -> tuple[str, None|dict]:
+    tags = config["tag-sets"].get(job["name"])
+    if tags is None:
+        tags = frozenset(job["pipeline"]["worker-tags"])
+
+    # Only make the job available once it is durable
+    if job_journal:
+        job_journal.enqueue(job["id"], job, tags)
+    combined = job_queue.put(job, tags, coalesce_key(job), combine_jobs, group=job["name"])
+    if combined is None:
+        return ("scheduled", None)
+
+    if job["pipeline"].get("coalesce") == "supersede":
+        if job_journal:
+            job_journal.update(job["id"], dict(job))
+            job_journal.complete(combined["id"], "SUPERSEDED")
+        return ("superseded", combined)
+
+    if job_journal:
+        job_journal.update(combined["id"], dict(combined))
+        job_journal.complete(job["id"], "MERGED")
+    return ("merged", combined)
+
+def dequeueJob(tags: set[str], wait: float = 0, worker_id: str = "") -> None|dict:
+    """Removes and returns the first scheduled job whose worker-tags is equal to or a subset of tags.
+    Waits up to 'wait' seconds for such a job to be scheduled"""
+    job = job_queue.get(frozenset(tags), wait)
+    if job and "id" in job:
+        now = time.monotonic()
+        with in_flight_jobs_lock:
+            in_flight_jobs[job["id"]] = (job["name"], worker_id, now)
+            heapq.heappush(in_flight_heap, (now, job["id"]))
+            # Drop entries of completed jobs, rather than letting them pile up for a whole lease
+            if len(in_flight_heap) > 2 * len(in_flight_jobs) + 64:
+                in_flight_heap[:] = [(t, job_id) for (job_id, (_, _, t)) in in_flight_jobs.items()]
+                heapq.heapify(in_flight_heap)
+    if job and job_journal:
+        # Not waiting for the disk: jobs are handed out at least once, see JobJournal.dequeue()
+        job_journal.dequeue(job["id"])
+    return job
+
+def completeJob(job_id: str, status: str):
+    with in_flight_jobs_lock:
+        in_flight = in_flight_jobs.pop(job_id, None)
+    if in_flight is not None:
+        job_queue.release(in_flight[0])
+    if job_journal:
+        job_journal.complete(job_id, status)
+
+def requeueJob(job: dict):
+    """Puts back a job which was dequeued, but never reached the worker"""
+    with in_flight_jobs_lock:
+        in_flight = in_flight_jobs.pop(job["id"], None)
+    if in_flight is not None:
+        job_queue.release(in_flight[0])
+    if job_journal:
+        job_journal.requeue(job["id"])
+    tags = config["tag-sets"].get(job["name"])
+    if tags is None:
+        tags = frozenset(job["pipeline"]["worker-tags"])
+    job_queue.put(job, tags, coalesce_key(job), group=job["name"])
+
+def expireJobs(lease: float):
+    """Completes jobs in flight for more than lease seconds, as their completion is presumably lost: e.g. by a crashed worker"""
+    now = time.monotonic()
+    expired = []
+    with in_flight_jobs_lock:
+        while in_flight_heap and now - in_flight_heap[0][0] > lease:
+            (time_dequeued, job_id) = heapq.heappop(in_flight_heap)
+            in_flight = in_flight_jobs.get(job_id)
+            # Unless completed, or requeued and dequeued again since
+            if in_flight is not None and in_flight[2] == time_dequeued:
+                expired.append((job_id, in_flight[0], in_flight[1]))
+    for (job_id, name, worker_id) in expired:
+        logging.warning("Job %s (%s) handed out to %s was not reported complete within %.0fs, releasing it", job_id, name, worker_id, lease)
+        completeJob(job_id, "EXPIRED")
+
+def configure_scheduling(cfg: dict):
+    """Applies the priority, weight and max-concurrent of each pipeline to the job queue"""
+    for (name, pipeline) in cfg["pipelines"].items():
+        job_queue.configure_group(name, pipeline.get("priority", 0), pipeline.get("weight", 1.0), pipeline.get("max-concurrent"))
+
+def restoreJobs(journal: JobJournal, requeue_in_flight: bool):
+    """Replays the journal into the job queue. Jobs handed out before a restart are either requeued or written off"""
+    (queued, in_flight) = journal.replay()
+    # In-flight jobs were dequeued before any of the queued ones, and go first if requeued
+    for (job, tags) in in_flight:
+        if requeue_in_flight:
+            journal.requeue(job["id"])
+            job_queue.put(job, tags, coalesce_key(job), group=job["name"])
+        else:
+            logging.warning("Job %s (%s) was in flight upon restart, and will not be requeued", job["id"], job["name"])
+            journal.complete(job["id"], "ABANDONED")
+
+    for (job, tags) in queued:
+        job_queue.put(job, tags, coalesce_key(job), group=job["name"])
+
+    logging.info("Restored %d queued jobs, %s %d in-flight jobs", len(queued), "requeued" if requeue_in_flight else "abandoned", len(in_flight))
 
 def parse_path(path_raw: str) -> tuple[str, dict[str:str]]:
     """Tremendously naive path-of-URL-parser. Does e.g. not support multiple params with same key. URL-encoding? Schmurlencoding!"""
@@ -56,6 +231,24 @@ def parse_path(path_raw: str) -> tuple[str, dict[str:str]]:
 
     return (base, params)
     
+def parse_wait(raw: str, max_wait: float) -> float:
+    """Parses the seconds a dequeue request may wait, capped at max_wait. Raises ValueError unless a finite, non-negative number"""
+    wait = float(raw)
+    if not (math.isfinite(wait) and wait >= 0):
+        raise ValueError(f"Invalid wait: {raw}")
+    return min(wait, max_wait)
+
+def test_parse_wait():
+    assert parse_wait("0", 30) == 0
+    assert parse_wait("12.5", 30) == 12.5
+    assert parse_wait("1e9", 30) == 30
+    for raw in ("nan", "inf", "-inf", "-1", "soon"):
+        try:
+            parse_wait(raw, 30)
+            assert False, raw
+        except ValueError:
+            pass
+
 def test_parse_path():
     assert ("path", {}) == parse_path("path")
     assert ("path", {"key": True}) == parse_path("path?key")
@@ -63,31 +256,57 @@ def test_parse_path():
     assert ("path", {"key": "val", "some": "else"}) == parse_path("path?key=val&some=else")
 
 class HTTPRequestHandler(server.BaseHTTPRequestHandler):
+    # Max seconds a /dequeue-request may be held waiting for a job. Long-polling would block a single-threaded server
+    max_dequeue_wait = 0.0
+
     def send_CORS_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
 
+    def send_body(self, code: int, body: bytes = b"", content_type: None|str = None, cors: bool = False):
+        self.send_response(code)
+        if cors:
+            self.send_CORS_headers()
+        if content_type:
+            self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
     def do_GET(self):
         (path, _) = parse_path(self.path)
+        cfg = config
         if path == "/pipelines":
-            self.send_response(200)
-            self.send_CORS_headers()
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(config["pipelines"]).encode("utf-8"))
+            self.send_body(200, json.dumps(cfg["pipelines"]).encode("utf-8"), 'application/json', cors=True)
+        elif path == "/metrics":
+            self.send_body(200, metrics.render().encode("utf-8"), 'text/plain; version=0.0.4')
+        elif path == "/stats":
+            webhooks = {outcome: 0 for outcome in ("received", "suppressed", "scheduled", "merged", "superseded")}
+            webhooks.update({outcome: int(n) for ((outcome,), n) in webhook_requests.values().items()})
+            stats = {"webhooks": webhooks, "queued": len(job_queue)}
+            # Queue wait time in seconds, jobs queued, in flight and dequeued pr pipeline
+            stats["pipelines"] = {name: x for (name, x) in job_queue.stats().items() if name is not None}
+            self.send_body(200, json.dumps(stats).encode("utf-8"), 'application/json', cors=True)
+        else:
+            self.send_error(404, "Not found")
 
     # TODO: Support common webhook formats (bitbucket, github)
     def do_POST_webhook(self, params: dict) -> None:
         time_start = bass.utcnow()
+        cfg = config
+        count_webhook("received")
+        # Payload not yet used, but must be consumed to keep the connection usable
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
         # Parameter checks
         if "pipeline" not in params:
             self.send_error(400, "Invalid request")
             return
 
-        if params["pipeline"] not in config["pipelines"]:
+        if params["pipeline"] not in cfg["pipelines"]:
             self.send_error(404, "No such job")
             return
         
-        pipeline = config["pipelines"][params["pipeline"]]
+        pipeline = cfg["pipelines"][params["pipeline"]]
         
         changed_refs = []
         if "changed-refs" in params:
@@ -95,12 +314,12 @@ class HTTPRequestHandler(server.BaseHTTPRequestHandler):
 
         # TODO: Experimental: need to verify exact behaviour with actual webhooks triggered by tag-adds
         tags = []
-        if "tag-pattern" in pipeline:
-            if not "tags" in params or not bass.core.any_item_matches(params["tags"].split(","), pipeline["tag-pattern"]):
+        if params["pipeline"] in cfg["tag-patterns"]:
+            tag_pattern = cfg["tag-patterns"][params["pipeline"]]
+            if not "tags" in params or not any(tag_pattern.search(tag) for tag in params["tags"].split(",")):
                 # Suppress request
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write(b"")
+                count_webhook("suppressed")
+                self.send_body(200)
                 return
 
 
@@ -109,40 +328,57 @@ class HTTPRequestHandler(server.BaseHTTPRequestHandler):
         root_span_id = bass.generate_span_id()
         service_name = f"bass:pipeline:{params['pipeline']}"
 
-        scheduleJob({
+        (outcome, combined) = scheduleJob({
+            "id": trace_id,
             "name": params["pipeline"],
             "schedule-time": bass.utcnow().isoformat(),
-            "env": config["env"],
-            "pipeline": config["pipelines"][params["pipeline"]],
+            "env": cfg["env"],
+            "pipeline": pipeline,
             "changed-refs": changed_refs,
-            "otel": {**dict(config["otel"]), **{
+            "otel": {**dict(cfg["otel"]), **{
                 "service-name": service_name,
                 "trace-id": trace_id,
                 "root-span-id": root_span_id
             }}
         })
 
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write(b"")
+        count_webhook(outcome)
+        self.send_body(200)
 
-        schedule_span = bass.generate_span(trace_id, root_span_id, bass.generate_span_id(), service_name, "onSchedule", time_start, bass.utcnow(), 1)
-        (code, msg) = bass.request("POST", config["otel"]["traces-endpoint"], schedule_span, {"Content-Type": "application/json"})
-        if code != 200:
-            logging.error(f"Could not post schedule span: {code}, {msg}")
+        # Queued for export by the background exporter, to keep the collector off the request path
+        if outcome == "merged":
+            # The request is covered by the queued job, and is part of its trace
+            spanner = bass.create_span_sender(cfg["otel"]["traces-endpoint"], service_name, combined["otel"]["trace-id"])
+            spanner("onSchedule - merged", combined["otel"]["root-span-id"], bass.generate_span_id(), time_start, bass.utcnow(), 1)
+            return
 
+        if outcome == "superseded":
+            # The superseded job will never be built: conclude its trace
+            superseded_spanner = bass.create_span_sender(cfg["otel"]["traces-endpoint"], service_name, combined["otel"]["trace-id"])
+            superseded_spanner(f"Build: {combined['name']} - SUPERSEDED", None, combined["otel"]["root-span-id"], datetime.datetime.fromisoformat(combined["schedule-time"]), bass.utcnow(), 0)
 
-    def do_POST_dequeue(self, params: dict) -> None:
-        # If auth'd
-        if len(config["api-keys"].keys()) > 0:
+        spanner = bass.create_span_sender(cfg["otel"]["traces-endpoint"], service_name, trace_id)
+        spanner("onSchedule", root_span_id, bass.generate_span_id(), time_start, bass.utcnow(), 1)
+
+
+    def authorize_worker(self) -> bool:
+        """Verifies the worker's api key, if any are configured. Sends error response and returns False if not authorized"""
+        api_keys = config["api-keys"]
+        if len(api_keys.keys()) > 0:
             api_key = self.headers.get("X-API-KEY", None)
             if not api_key:
                 self.send_error(401, "Unauthenticated")
-                return
+                return False
             
-            if not config["api-keys"].get(api_key, False):
+            if not api_keys.get(api_key, False):
                 self.send_error(403, "Unauthorized")
-                return
+                return False
+
+        return True
+
+    def do_POST_dequeue(self, params: dict) -> None:
+        if not self.authorize_worker():
+            return
             
         # Get worker tags from payload
         content_len = int(self.headers.get('Content-Length'))
@@ -150,38 +386,75 @@ class HTTPRequestHandler(server.BaseHTTPRequestHandler):
         body = json.loads(post_body)
         tags = set(body["tags"])
 
-        # Find first (if any) scheduled job whose worker-tags is equal or a subset of the polling worker's tags
-        dequeue_i = -1
-        if len(job_queue) > 0:
-            for i, job in enumerate(job_queue):
-                # Find first job whose all tags exists in the set of worker tags.
-                # Converting from list to set on each check is suboptimal, but negligeble for now.
-                # Consider having a cached set pr pipeline available lookupable by pipeline name
-                if set(job["pipeline"]["worker-tags"]).issubset(tags):
-                    dequeue_i = i
-                    break
-
-        if dequeue_i > -1:
-            job = job_queue.pop(dequeue_i)
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(job).encode("utf-8"))
-        else:
-            self.send_response(204)
-            self.end_headers()
-            self.wfile.write(b"")
+        # Optionally hold the request until a matching job arrives: ?wait=<seconds>
+        try:
+            wait = parse_wait(params.get("wait", "0"), self.max_dequeue_wait)
+        except ValueError:
+            self.send_error(400, "Invalid wait")
+            return
+
+        # Workers identify themselves to be counted as active or idle. Fall back to the address for those not doing so
+        worker_id = self.headers.get("X-Worker-Id") or self.client_address[0]
+        see_worker(worker_id)
 
+        expireJobs(in_flight_lease)
+        job = dequeueJob(tags, wait, worker_id)
+        see_worker(worker_id)
+        if not job:
+            self.send_body(204)
+            return
+
+        try:
+            self.send_body(200, json.dumps(job).encode("utf-8"), 'application/json')
+        except OSError as e:
+            # The worker gave up waiting. Not noticed if the response fits in the socket's buffer - then the lease applies
+            logging.warning("Could not hand out job %s to %s, requeueing it: %s", job.get("id"), worker_id, e)
+            if "id" in job:
+                requeueJob(job)
+            raise
+
+
+    def do_POST_complete(self, params: dict) -> None:
+        """Reported by workers once a job is processed: {"id": <job id>, "status": <ExecStatus name>}"""
+        if not self.authorize_worker():
+            return
+
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b"{}")
+        if "id" not in body:
+            self.send_error(400, "Invalid request")
+            return
+
+        completeJob(body["id"], body.get("status", "UNKNOWN"))
+        self.send_body(204)
 
     def do_POST(self) -> None:
         """Save a file following a HTTP PUT request"""
         (path, params) = parse_path(self.path)
 
-        if path == "/dequeue":
-            return self.do_POST_dequeue(params)
-        elif path == "/webhook":
-            return self.do_POST_webhook(params)
-        
+        handler = {
+            "/dequeue": self.do_POST_dequeue,
+            "/complete": self.do_POST_complete,
+            "/webhook": self.do_POST_webhook,
+        }.get(path)
+        if not handler:
+            self.send_error(404, "Not found")
+            return
+
+        time_start = time.monotonic()
+        try:
+            handler(params)
+        except JournalError as e:
+            # Raised before any response is sent. Jobs can not be recorded durably, so refuse them
+            logging.error("%s", e)
+            self.send_error(503, "Job journal unavailable")
+        finally:
+            request_duration.observe(time.monotonic() - time_start, path[1:])
+
+class KeepAliveHTTPRequestHandler(HTTPRequestHandler):
+    """Lets workers keep their connection alive between polls, and long-poll. Only viable with a thread pr connection"""
+    protocol_version = "HTTP/1.1"
+    max_dequeue_wait = 30.0
+
 def test_HTTPRequestHandler():
     pass
 
@@ -195,35 +468,335 @@ def orch_argparse():
     
     parser.add_argument("-t", "--traces-endpoint", type=str, action="store", default="http://localhost:4318/v1/traces", help="")
     parser.add_argument("-l", "--logs-endpoint", type=str, action="store", default="http://localhost:4318/v1/logs", help="")
-    # TBD: support pipeline-config from URL? And live reload/periodic sync?
+    # TBD: support pipeline-config from URL?
     parser.add_argument("-f", "--pipelines-file", type=str, action="store", default="orchestrator-pipelines.json", help="Local path to pipeline configurations")
     parser.add_argument("-e", "--env-file", type=str, action="store", default="orchestrator.env", help="Local path to file containing variables definitions as key=value pairs. Supports $envvariable")
     parser.add_argument("-w", "--worker-keys-file", type=str, action="store", default="worker-keys", help="Local path to file containing list of api-keys for agent authentication")
+    parser.add_argument("--watch-config", type=float, action="store", default=0, help="Seconds between checking the config files for changes, reloading them if changed. 0 to only reload upon SIGHUP")
     parser.add_argument("-p", "--port", type=int, action="store", default=8080, help="Port to listen for requests at")
+    parser.add_argument("-s", "--server-mode", choices=["threaded", "single"], default="threaded", help="Handle requests concurrently in a thread pr connection, or one at a time")
+    parser.add_argument("-j", "--journal-file", type=str, action="store", default=None, help="Local path to journal persisting the job queue across restarts. In-memory only if not set")
+    parser.add_argument("--journal-compact-every", type=int, action="store", default=10000, help="Compact the journal after this many records")
+    parser.add_argument("--requeue-in-flight", action="store_true", default=False, help="Upon restart, requeue jobs which were dequeued but not reported complete. These are otherwise abandoned")
+    parser.add_argument("--in-flight-lease", type=float, action="store", default=6 * 3600.0, help="Seconds a job may be in flight before its pipeline's max-concurrent slot is released, should its completion never be reported. Keep above the longest build")
+    parser.add_argument("--max-dequeue-wait", type=float, action="store", default=30.0, help="Max seconds a worker may wait for a job in a single /dequeue-request. Threaded server mode only")
     
     return parser.parse_args()
 
 
-if __name__ == '__main__':
-    signal.signal(signal.SIGTERM, lambda: exit(1))
-    args = orch_argparse()
-
-    # Load configs
+def load_config(args, strict: bool = True) -> dict:
+    """Reads and validates the config files into a new config snapshot. Raises ValueError (or OSError) if invalid.
+    Unless strict, pipelines lacking what is only needed to run their jobs - repository, ref and exec - are only
+    warned about, as before these were validated"""
     with(open(args.pipelines_file, "r") as f):
-        tmp_pipelines = json.load(f)
-        for k in tmp_pipelines:
-            if not "worker-tags" in tmp_pipelines[k]:
-                tmp_pipelines[k]["worker-tags"] = []
-            
-        config["pipelines"] = tmp_pipelines
-
+        pipelines = json.load(f)
+
+    if type(pipelines) != dict:
+        raise ValueError(f"{args.pipelines_file}: expected an object of pipelines")
+
+    def invalid_job_field(message: str):
+        if strict:
+            raise ValueError(message)
+        logging.warning(f"{message}, its jobs will fail")
+
+    tag_patterns = {}
+    for (name, pipeline) in pipelines.items():
+        if type(pipeline) != dict:
+            raise ValueError(f"{args.pipelines_file}: pipeline '{name}' is not an object")
+        for field in ("repository", "ref"):
+            if type(pipeline.get(field)) != str:
+                invalid_job_field(f"{args.pipelines_file}: pipeline '{name}' lacks '{field}'")
+        if type(pipeline.get("exec")) != list:
+            invalid_job_field(f"{args.pipelines_file}: pipeline '{name}' lacks 'exec' as a list")
+
+        pipeline.setdefault("worker-tags", [])
+        if type(pipeline["worker-tags"]) != list or not all(type(x) == str for x in pipeline["worker-tags"]):
+            raise ValueError(f"{args.pipelines_file}: pipeline '{name}' has invalid 'worker-tags'")
+
+        if type(pipeline.get("priority", 0)) != int:
+            raise ValueError(f"{args.pipelines_file}: pipeline '{name}' has invalid 'priority': expected an integer")
+        if type(pipeline.get("weight", 1)) not in (int, float) or pipeline.get("weight", 1) <= 0:
+            raise ValueError(f"{args.pipelines_file}: pipeline '{name}' has invalid 'weight': expected a positive number")
+        if pipeline.get("max-concurrent") is not None and (type(pipeline["max-concurrent"]) != int or pipeline["max-concurrent"] < 1):
+            raise ValueError(f"{args.pipelines_file}: pipeline '{name}' has invalid 'max-concurrent': expected a positive integer")
+
+        if pipeline.get("coalesce", "none") not in ("none", "merge", "supersede"):
+            raise ValueError(f"{args.pipelines_file}: pipeline '{name}' has invalid 'coalesce': expected none, merge or supersede")
+
+        if pipeline.get("tag-pattern"):
+            try:
+                tag_patterns[name] = re.compile(pipeline["tag-pattern"])
+            except re.error as e:
+                raise ValueError(f"{args.pipelines_file}: pipeline '{name}' has invalid 'tag-pattern': {e}")
+
+    env = {}
     with(open(args.env_file, "r") as f):
-        tmp_env_raw = { k: os.path.expandvars(v) for (k,v) in [l.split("=") for l in f.readlines()]}
-        config["env"] = tmp_env_raw
+        for (i, line) in enumerate(f):
+            if not line.strip():
+                continue
+            if "=" not in line:
+                raise ValueError(f"{args.env_file}:{i + 1}: expected key=value")
+            (k, v) = line.rstrip("\n").split("=", 1)
+            env[k] = os.path.expandvars(v)
 
     # TODO: store only hashes?
     with(open(args.worker_keys_file, "r") as f):
-        config["api-keys"] = {x.strip(): True for x in f.readlines()}
+        api_keys = {x.strip(): True for x in f.readlines() if x.strip()}
+
+    return {
+        "pipelines": pipelines,
+        "env": env,
+        "api-keys": api_keys,
+        "tag-sets": {k: frozenset(v["worker-tags"]) for (k, v) in pipelines.items()},
+        "tag-patterns": tag_patterns,
+        "otel": {
+            "traces-endpoint": args.traces_endpoint,
+            "logs-endpoint": args.logs_endpoint
+        }
+    }
+
+def config_diff(old: dict, new: dict) -> list[str]:
+    """Describes the differences between two config snapshots. Does not reveal values of variables or keys"""
+    changes = []
+    for (kind, key) in (("pipeline", "pipelines"), ("variable", "env")):
+        for name in sorted(new[key].keys() - old[key].keys()):
+            changes.append(f"Added {kind}: {name}")
+        for name in sorted(old[key].keys() - new[key].keys()):
+            changes.append(f"Removed {kind}: {name}")
+        for name in sorted(old[key].keys() & new[key].keys()):
+            if old[key][name] != new[key][name]:
+                changes.append(f"Changed {kind}: {name}")
+
+    (added_keys, removed_keys) = (len(new["api-keys"].keys() - old["api-keys"].keys()), len(old["api-keys"].keys() - new["api-keys"].keys()))
+    if added_keys or removed_keys:
+        changes.append(f"Api keys: {added_keys} added, {removed_keys} removed")
+    return changes
+
+# Serializes reloads triggered by SIGHUP and by --watch-config
+config_reload_lock = threading.Lock()
+
+def reload_config(args) -> bool:
+    """Loads the config files, and swaps the new snapshot in if valid. Requests in progress keep the snapshot they started with"""
+    global config
+    with config_reload_lock:
+        try:
+            new_config = load_config(args)
+        except (OSError, ValueError) as e:
+            logging.error(f"Config not reloaded, keeping the current one: {e}")
+            return False
+
+        changes = config_diff(config, new_config)
+        configure_scheduling(new_config)
+        config = new_config
+
+    for change in changes:
+        logging.info(change)
+    logging.info(f"Config reloaded: {len(changes)} changes")
+    return True
+
+def watch_config(args, interval: float):
+    """Reloads the config whenever any of the config files are modified"""
+    def mtimes():
+        result = []
+        for path in (args.pipelines_file, args.env_file, args.worker_keys_file):
+            try:
+                result.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                result.append(None)
+        return result
+
+    last = mtimes()
+    while True:
+        time.sleep(interval)
+        current = mtimes()
+        if current != last:
+            last = current
+            reload_config(args)
+
+def test_reload_config_validates_and_reports_changes(tmp_path, monkeypatch):
+    args = argparse.Namespace(pipelines_file=str(tmp_path / "pipelines.json"), env_file=str(tmp_path / "env"), worker_keys_file=str(tmp_path / "keys"),
+                              traces_endpoint="http://localhost:4318/v1/traces", logs_endpoint="http://localhost:4318/v1/logs")
+    pipeline = {"repository": "file:///tmp/repo", "ref": "main", "exec": ["python3", "job.py"]}
+    (tmp_path / "pipelines.json").write_text(json.dumps({"a": pipeline, "b": {**pipeline, "tag-pattern": "^v[0-9]+"}}))
+    (tmp_path / "env").write_text("KEY=some=value\n\n")
+    (tmp_path / "keys").write_text("key1\n")
+    monkeypatch.setattr(sys.modules[__name__], "config", load_config(args))
+    assert config["env"] == {"KEY": "some=value"}
+    assert config["tag-sets"]["a"] == frozenset()
+    assert config["tag-patterns"]["b"].search("v12")
+
+    (tmp_path / "pipelines.json").write_text(json.dumps({"a": {**pipeline, "tag-pattern": "("}}))
+    assert not reload_config(args)
+    assert set(config["pipelines"]) == {"a", "b"}
+
+    # Loaded at startup, as before pipelines were validated, but not reloaded
+    (tmp_path / "pipelines.json").write_text(json.dumps({"a": {"exec": "job.py"}}))
+    assert set(load_config(args, strict=False)["pipelines"]) == {"a"}
+    assert not reload_config(args)
+    assert set(config["pipelines"]) == {"a", "b"}
+
+    (tmp_path / "pipelines.json").write_text(json.dumps({"a": {**pipeline, "ref": "dev"}, "c": pipeline}))
+    (tmp_path / "keys").write_text("key1\nkey2\n")
+    previous = config
+    assert reload_config(args)
+    assert config is not previous
+    assert config_diff(previous, config) == ["Added pipeline: c", "Removed pipeline: b", "Changed pipeline: a", "Api keys: 1 added, 0 removed"]
+
+class ThreadingHTTPServer(server.ThreadingHTTPServer):
+    # Many workers may (re)connect at once. The default backlog of 5 makes them hit connection resets and SYN retries
+    request_queue_size = 128
+    # Let pending long-lived connections not block shutdown
+    daemon_threads = True
+
+def create_server(address: tuple[str, int], mode: str = "threaded") -> server.HTTPServer:
+    if mode == "threaded":
+        return ThreadingHTTPServer(address, KeepAliveHTTPRequestHandler)
+
+    return server.HTTPServer(address, HTTPRequestHandler)
+
+def test_dequeue_waits_for_matching_job():
+    job_queue.clear()
+    threading.Timer(0.05, scheduleJob, [{"name": "other", "pipeline": {"worker-tags": ["other"]}}]).start()
+    threading.Timer(0.1, scheduleJob, [{"name": "mine", "pipeline": {"worker-tags": ["mine"]}}]).start()
+    time_start = time.monotonic()
+    assert dequeueJob({"mine"}, wait=5)["name"] == "mine"
+    assert time.monotonic() - time_start < 1
+    assert dequeueJob({"mine"}, wait=0.05) is None
+
+def test_journaled_jobs_survive_restart(tmp_path, monkeypatch):
+    job_queue.clear()
+    journal = JobJournal(str(tmp_path / "journal"))
+    journal.replay()
+    monkeypatch.setattr(sys.modules[__name__], "job_journal", journal)
+    for i in range(3):
+        (outcome, combined) = scheduleJob({"id": str(i), "name": str(i), "pipeline": {"worker-tags": []}})
+    dequeueJob(set())
+    dequeueJob(set())
+    completeJob("0", "OK")
+    journal.close()
+
+    job_queue.clear()
+    restoreJobs(JobJournal(str(tmp_path / "journal")), requeue_in_flight=True)
+    assert [job["name"] for job in job_queue.jobs()] == ["1", "2"]
+
+def test_webhooks_coalesce_pr_policy(tmp_path, monkeypatch):
+    job_queue.clear()
+    journal = JobJournal(str(tmp_path / "journal"))
+    journal.replay()
+    monkeypatch.setattr(sys.modules[__name__], "job_journal", journal)
+    def job(id: str, policy: str, refs: list[str]) -> dict:
+        return {"id": id, "name": policy, "changed-refs": refs, "pipeline": {"ref": "main", "worker-tags": [], "coalesce": policy}}
+
+    assert scheduleJob(job("1", "merge", ["a"]))[0] == "scheduled"
+    assert scheduleJob(job("2", "supersede", ["a"]))[0] == "scheduled"
+    assert scheduleJob(job("3", "none", ["a"]))[0] == "scheduled"
+    assert scheduleJob(job("4", "merge", ["b", "a"])) == ("merged", job("1", "merge", ["a", "b"]))
+    assert scheduleJob(job("5", "supersede", ["b"]))[1]["id"] == "2"
+    assert scheduleJob(job("6", "none", ["b"]))[0] == "scheduled"
+    assert [(job["id"], job["changed-refs"]) for job in job_queue.jobs()] == [("1", ["a", "b"]), ("3", ["a"]), ("5", ["a", "b"]), ("6", ["b"])]
+
+    # Building everything covers any changed refs
+    assert scheduleJob(job("7", "merge", []))[0] == "merged"
+    journal.close()
+
+    job_queue.clear()
+    restoreJobs(JobJournal(str(tmp_path / "journal")), requeue_in_flight=True)
+    assert [(job["id"], job["changed-refs"]) for job in job_queue.jobs()] == [("1", []), ("3", ["a"]), ("5", ["a", "b"]), ("6", ["b"])]
+
+def test_pipeline_concurrency_is_released_upon_completion():
+    job_queue.clear()
+    configure_scheduling({"pipelines": {"capped": {"max-concurrent": 1}}})
+    for i in range(2):
+        scheduleJob({"id": str(i), "name": "capped", "pipeline": {"ref": "main", "worker-tags": []}})
+    assert dequeueJob(set())["id"] == "0"
+    assert dequeueJob(set()) is None
+    completeJob("0", "OK")
+    assert dequeueJob(set())["id"] == "1"
+    completeJob("1", "OK")
+
+def test_lost_completions_expire(monkeypatch):
+    job_queue.clear()
+    in_flight_jobs.clear()
+    in_flight_heap.clear()
+    clock = [time.monotonic()]
+    monkeypatch.setattr(time, "monotonic", lambda: clock[0])
+    configure_scheduling({"pipelines": {"capped": {"max-concurrent": 1}}})
+    for i in range(3):
+        scheduleJob({"id": str(i), "name": "capped", "pipeline": {"ref": "main", "worker-tags": []}})
+    assert dequeueJob(set())["id"] == "0"
+    expireJobs(60)
+    assert dequeueJob(set()) is None
+
+    # Lost to a worker which crashed
+    clock[0] += 61
+    expireJobs(60)
+    job = dequeueJob(set())
+    assert job["id"] == "1"
+
+    # Lost on the way to the worker
+    requeueJob(job)
+    assert [job["id"] for job in job_queue.jobs()] == ["2", "1"]
+    assert dequeueJob(set())["id"] == "2"
+    completeJob("2", "OK")
+    completeJob("0", "OK")
+    assert list(in_flight_jobs) == []
+    # Only the stale entries of completed jobs remain, not to expire anything
+    clock[0] += 61
+    expireJobs(60)
+    assert in_flight_heap == []
+
+def test_metrics_endpoint_can_be_scraped(monkeypatch):
+    job_queue.clear()
+    monkeypatch.setattr(sys.modules[__name__], "config", {**config, "pipelines": {"metered": {"repository": "", "ref": "main", "exec": ["true"], "worker-tags": ["linux"]}}, "tag-sets": {}, "tag-patterns": {}, "api-keys": {}})
+    monkeypatch.setattr(bass.core, "_exporter", bass.TelemetryExporter())
+    monkeypatch.setattr(HTTPRequestHandler, "log_message", lambda *args: None)
+    httpd = create_server(("127.0.0.1", 0))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    try:
+        for _ in range(2):
+            assert bass.request("POST", f"{url}/webhook?pipeline=metered")[0] == 200
+        (status, body) = bass.request("POST", f"{url}/dequeue", {"tags": ["linux"]}, headers={"X-Worker-Id": "worker-1"})
+        assert status == 200
+
+        (status, body) = bass.request("GET", f"{url}/metrics")
+        assert status == 200
+        lines = body.splitlines()
+        assert 'bass_job_queue_depth{tags="linux"} 1' in lines
+        assert 'bass_job_queue_wait_seconds_count{pipeline="metered"} 1' in lines
+        assert 'bass_workers{state="active"} 1' in lines
+        assert any(line.startswith('bass_http_request_duration_seconds_count{endpoint="webhook"}') for line in lines)
+        assert any(line.startswith('bass_webhook_requests_total{outcome="scheduled"}') for line in lines)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        bass.core._exporter.shutdown(0)
+
+def test_concurrent_dequeue_hands_out_each_job_once():
+    job_queue.clear()
+    for i in range(200):
+        (outcome, combined) = scheduleJob({"name": str(i), "pipeline": {"worker-tags": []}})
+
+    dequeued = []
+    def poll():
+        while job := dequeueJob(set()):
+            dequeued.append(job["name"])
+
+    threads = [threading.Thread(target=poll) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sorted(dequeued) == sorted(str(i) for i in range(200))
+
+if __name__ == '__main__':
+    signal.signal(signal.SIGTERM, lambda signum, frame: exit(1))
+    args = orch_argparse()
+
+    # Load configs. Reloads are strict, keeping the current config if invalid
+    config = load_config(args, strict=False)
+    configure_scheduling(config)
 
     # Inform of loaded configs
     logging.info("Loaded pipelines:")
@@ -236,6 +809,16 @@ if __name__ == '__main__':
 
     logging.info("Loaded %d api keys", len(config["api-keys"].items()))
 
-    server = server.HTTPServer(('0.0.0.0', args.port), HTTPRequestHandler)
-    server.serve_forever()
+    # Reload in a thread of its own, to not hold up request handling
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=reload_config, args=(args,), daemon=True).start())
+    if args.watch_config > 0:
+        threading.Thread(target=watch_config, args=(args, args.watch_config), name="bass-config-watch", daemon=True).start()
+
+    if args.journal_file:
+        job_journal = JobJournal(args.journal_file, compact_every=args.journal_compact_every)
+        restoreJobs(job_journal, args.requeue_in_flight)
 
+    in_flight_lease = args.in_flight_lease
+    KeepAliveHTTPRequestHandler.max_dequeue_wait = args.max_dequeue_wait
+    httpd = create_server(('0.0.0.0', args.port), args.server_mode)
+    httpd.serve_forever()
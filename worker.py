@@ -2,15 +2,25 @@
 import json
 import logging
 import time
+import random
 import tempfile
 import os
 import subprocess
 import signal
+import sys
 import argparse
+import shutil
+import socket
+import threading
+import queue
+import re
+from contextlib import contextmanager
+from typing import Callable
 from string import Template
 import bass
-from bass import create_log_sender, notification
-from bass.core import ExecStatus, exec_status_to_otel
+from bass import create_log_sender, create_span_sender, notification
+from bass.core import ExecStatus, Severity, exec_status_to_otel, parse_size
+from bass.otlp import create_encoder
 
 logging.getLogger().setLevel(logging.INFO)
 
@@ -28,66 +38,199 @@ def handle_notifications(notifications_config: dict, job_status: ExecStatus, var
         
 
 
-def process(job: dict, args) -> ExecStatus:
+def git(*git_args: str, cwd: None|str = None) -> str:
+    """Runs git, raising CalledProcessError upon failure. Returns stdout"""
+    return subprocess.run(["git", *git_args], cwd=cwd, check=True, stdout=subprocess.PIPE).stdout.decode()
+
+@contextmanager
+def phase(spanner, parent_span_id: str, name: str):
+    """Times the enclosed block, and reports it as a span of its own"""
+    time_start = bass.utcnow()
+    status = ExecStatus.OK
+    try:
+        yield
+    except:
+        status = ExecStatus.ERROR
+        raise
+    finally:
+        spanner(f"phase:{name}", parent_span_id, bass.generate_span_id(), time_start, bass.utcnow(), exec_status_to_otel[status.value])
+
+def sync_mirror(repository: str, mirror_dir: str, args):
+    """Ensures mirror_dir is a bare mirror of repository, updated by a single incremental fetch"""
+    shallow_args = ["--depth", str(args.git_depth)] if args.git_depth else []
+    if os.path.exists(f"{mirror_dir}/HEAD"):
+        logging.info("Fetching '%s' to mirror: '%s'", repository, mirror_dir)
+        git("fetch", "--prune", *shallow_args, "origin", cwd=mirror_dir)
+    else:
+        logging.info("Mirroring '%s' to: '%s'", repository, mirror_dir)
+        filter_args = [f"--filter={args.git_filter}"] if args.git_filter else []
+        tmp_dir = f"{mirror_dir}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        git("clone", "--mirror", *shallow_args, *filter_args, repository, tmp_dir)
+        # An interrupted clone shall not leave a half-made mirror behind
+        os.rename(tmp_dir, mirror_dir)
+
+def write_changeset(repo_dir: str, refs: list[str], f) -> int:
+    """Writes the files changed by any of refs to f, one pr line, as resolved by a single git invocation.
+    Returns the number of files"""
+    proc = subprocess.Popen(["git", "-c", "core.quotepath=off", "diff-tree", "--stdin", "--no-commit-id", "--name-only", "-r"],
+                            cwd=repo_dir, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+
+    # Feed refs from a thread of its own, as git may fill its output pipe before having read all of them
+    def feed():
+        try:
+            proc.stdin.writelines(ref + "\n" for ref in refs)
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+
+    seen = set()
+    for line in proc.stdout:
+        if line not in seen:
+            seen.add(line)
+            f.write(line)
+    feeder.join()
+
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    return len(seen)
+
+_mirror_locks: dict[str, threading.Lock] = {}
+_mirror_locks_lock = threading.Lock()
+
+def mirror_lock(mirror_dir: str) -> threading.Lock:
+    """Lock serializing modifications of a mirror by concurrent jobs"""
+    with _mirror_locks_lock:
+        return _mirror_locks.setdefault(mirror_dir, threading.Lock())
+
+def checkout_worktree(mirror_dir: str, workspace: str, ref: str):
+    """Ensures workspace is a clean worktree of mirror_dir, with ref checked out"""
+    if os.path.isfile(f"{workspace}/.git"):
+        logging.info("Checking out '%s' in: '%s'", ref, workspace)
+        # Under the mirror's lock, as a checkout reads refs of the mirror and may fetch blobs missing from a partial clone
+        with mirror_lock(mirror_dir):
+            git("checkout", "--detach", "--force", ref, cwd=workspace)
+        # Only touching the workspace
+        git("clean", "-xdf", cwd=workspace)
+    else:
+        # Replace workspaces from before the mirror was introduced, or left by an interrupted checkout
+        shutil.rmtree(workspace, ignore_errors=True)
+        os.makedirs(os.path.dirname(workspace), exist_ok=True)
+        logging.info("Creating worktree of '%s' in: '%s'", ref, workspace)
+        with mirror_lock(mirror_dir):
+            git("worktree", "prune", cwd=mirror_dir)
+            git("worktree", "add", "--detach", "--force", workspace, ref, cwd=mirror_dir)
+
+# Build processes in progress. Each runs in a process group of its own, not reached by signals to the worker's group
+builds: set[subprocess.Popen] = set()
+builds_lock = threading.Lock()
+
+def terminate_builds():
+    """Signals every build in progress to cancel its steps and stop"""
+    with builds_lock:
+        procs = list(builds)
+    for proc in procs:
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+def test_terminate_builds_reaches_their_process_group():
+    proc = subprocess.Popen(["sh", "-c", "sleep 10 & wait"], start_new_session=True)
+    with builds_lock:
+        builds.add(proc)
+    try:
+        terminate_builds()
+        assert proc.wait(5) == -signal.SIGTERM
+    finally:
+        with builds_lock:
+            builds.discard(proc)
+        bass.core.kill_process_group(proc)
+
+# Level prefix of lines in Python's default logging format, e.g. "WARNING:root:..." as the builder writes to stderr
+_log_level = re.compile(r"^(DEBUG|INFO|WARNING|ERROR|CRITICAL):", re.MULTILINE)
+_severities: list[Severity] = ["DEBUG", "INFO", "WARN", "ERROR", "FATAL"]
+_severity_of_level: dict[str, Severity] = {"DEBUG": "DEBUG", "INFO": "INFO", "WARNING": "WARN", "ERROR": "ERROR", "CRITICAL": "FATAL"}
+
+def output_severity(text: str) -> Severity:
+    """Severity of a batch of build output: the most severe level of its logging lines. Other lines count as INFO -
+    whether the build failed is only known once it exits"""
+    levels = _log_level.findall(text)
+    severities = [_severity_of_level[level] for level in levels]
+    if len(levels) < text.count("\n") or not levels:
+        severities.append("INFO")
+    return max(severities, key=_severities.index)
+
+def test_output_severity():
+    assert output_severity("compiling\n") == "INFO"
+    assert output_severity("DEBUG:root:a\nDEBUG:bass:b\n") == "DEBUG"
+    assert output_severity("DEBUG:root:a\nwarning: unused variable\n") == "INFO"
+    assert output_severity("INFO:root:a\nERROR:root:Step failed\n") == "ERROR"
+
+def run_build(command: list[str], env: dict[str, str], cwd: str, log: Callable[[Severity, str], None], max_output: None|int = None, spill_path: None|str = None) -> bass.core.UsagePopen:
+    """Runs the build command in a process group of its own, logging its output as it arrives - to not keep the
+    entire build output in memory. Returns the exited process"""
+    proc = bass.core.UsagePopen(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True, cwd=cwd)
+    with builds_lock:
+        builds.add(proc)
+    try:
+        bass.core.stream_output(proc, lambda stream, text: log(output_severity(text), text), max_output=max_output, spill_path=spill_path)
+    finally:
+        with builds_lock:
+            builds.discard(proc)
+    return proc
+
+def test_run_build_logs_stderr_of_successful_build_by_level(tmp_path):
+    logged = []
+    script = "import logging, sys; logging.getLogger().setLevel(logging.DEBUG); logging.debug('resolving'); logging.info('building'); print('out'); print('note', file=sys.stderr)"
+    proc = run_build([sys.executable, "-c", script], dict(os.environ), str(tmp_path), lambda severity, text: logged.append((severity, text)))
+    assert proc.returncode == 0
+    assert logged and all(severity in ("DEBUG", "INFO") for (severity, _) in logged)
+    assert "".join(text for (_, text) in logged).count("\n") == 4
+
+def process(job: dict, args, slot: int = 0, on_usage: None|Callable[[dict[str, int|float]], None] = None) -> ExecStatus:
+    """Builds job in the workspace of the given worker slot. Does not change the cwd of the worker process, so
+    jobs may be processed concurrently in separate slots. The resource usage of the build is passed on to on_usage"""
     logger = create_log_sender(job["otel"]["logs-endpoint"], job["otel"]["service-name"], job["otel"]["trace-id"])
+    spanner = create_span_sender(job["otel"]["traces-endpoint"], job["otel"]["service-name"], job["otel"]["trace-id"])
+    root_span_id = job["otel"]["root-span-id"]
     logging.info("Processing: %s", job["name"])
     status = ExecStatus.UNKNOWN
 
-    # Create workspace specific for the pipeline, ignore if already exists
-    # Ensure local clone/workspace represents both pipeline and repository
+    # Every repository is fetched once into a bare mirror shared by all pipelines, while every pipeline
+    # gets a worktree of its own from the mirror.
     # TBD: Capture all output and log as part of root span?
     repository_escaped = job["pipeline"]["repository"].replace("\\", "-").replace("/", "-")
-    tmpdir = f"{args.workspace_root}/pipeline/{job["name"]}/{repository_escaped}"
+    mirror_dir = f"{args.workspace_root}/mirrors/{repository_escaped}.git"
+    tmpdir = f"{args.workspace_root}/pipeline/{job["name"]}/{repository_escaped}" + (f"@{slot}" if slot else "")
     tmpfile_changeset = None
 
     try:
-        # Setup temporary area
         logging.info("Workspace: %s", tmpdir)
         try:
-            try:
-                os.makedirs(tmpdir)
-            except FileExistsError:
-                pass
-
-            os.chdir(tmpdir)
-        except:
-           logging.critical("Could not ensure workspace")
-           return ExecStatus.ERROR
-
-
-        # Ensure repo is up to date
-        logging.info("Synchronize repo")
-        if os.path.exists(f"{tmpdir}/.git"):
-            logging.info("Updating repository '%s' in: '%s'", job["pipeline"]["repository"], tmpdir)
-            if subprocess.call(["git", "clean", "-xdf"]) != 0:
-                logging.critical("Could not git clean")
-                return ExecStatus.ERROR
-            if subprocess.call(["git", "pull"]) != 0:
-                logging.critical("Could not git pull")
-                return ExecStatus.ERROR
-        else:
-            logging.info("Cloning repository '%s' to: '%s'", job["pipeline"]["repository"], tmpdir)
-            if subprocess.call(["git", "clone", job["pipeline"]["repository"], "."]) != 0:
-                logging.critical("Could not git clone")
-                return ExecStatus.ERROR
-
-        logging.info(f"Checking out: {job["pipeline"]["ref"]}")
-        if subprocess.call(["git", "checkout", job["pipeline"]["ref"], "."]) != 0:
-           logging.critical("Could not checkout ref")
-           return ExecStatus.ERROR
+            with phase(spanner, root_span_id, "fetch"), mirror_lock(mirror_dir):
+                sync_mirror(job["pipeline"]["repository"], mirror_dir, args)
+            with phase(spanner, root_span_id, "checkout"):
+                checkout_worktree(mirror_dir, tmpdir, job["pipeline"]["ref"])
+        except (OSError, subprocess.CalledProcessError) as e:
+            logging.critical(f"Could not prepare workspace: {e}")
+            logger(root_span_id, "ERROR", f"Could not prepare workspace: {e}")
+            return ExecStatus.ERROR
 
         # Print exact revision getting built
         try:
-            ref = subprocess.check_output(["git", "show-ref"])
-            logging.info(f"git show-ref: {ref.decode()}")
+            revision = git("rev-parse", "HEAD", cwd=tmpdir).strip()
+            logging.info(f"Building revision: {revision}")
+            logger(root_span_id, "INFO", f"Building revision: {revision}")
         except:
-            logging.critical("Could not call git show-ref")
-            logger(job["otel"]["root-span-id"], "WARN", "Could not call git show-ref")
+            logging.critical("Could not call git rev-parse")
+            logger(root_span_id, "WARN", "Could not call git rev-parse")
             return ExecStatus.ERROR
         
         # Prepare execution of pipeline
-        if "cwd" in job["pipeline"]:
-            os.chdir(job["pipeline"]["cwd"])
+        build_cwd = os.path.join(tmpdir, job["pipeline"].get("cwd", ""))
 
         # Execute job, will create sub spans - pass on trace and root span
         try:
@@ -108,53 +251,38 @@ def process(job: dict, args) -> ExecStatus:
             ]
 
             # Get changes - resolve from list of git revisions to list of files
-            changed_files = set()
-            if "changed-refs" in job and len(job["changed-refs"])>0:
-                for changed_ref in job["changed-refs"]:
-                    result = subprocess.check_output(["git", "diff-tree", "--no-commit-id", "--name-only", "-r", changed_ref]).decode("utf-8")
-                    changed_files = changed_files.union(set(result.splitlines()))
-                    # TODO: append directly to file?
-
             # For very large sets of files we might hit OS-limits for exec arguments. We therefore write them to a temporary file and pass this to the build command
-            if len(changed_files) > 0:
-                tmpfile_changeset = tempfile.mktemp(prefix=f"bass-{job['name']}-changeset")
-                with open(tmpfile_changeset, "w") as f:
-                    f.writelines([x + "\n" for x in changed_files])
-
+            if len(job.get("changed-refs", [])) > 0:
+                (fd, tmpfile_changeset) = tempfile.mkstemp(prefix=f"bass-{job['name']}-changeset")
+                with phase(spanner, root_span_id, "changeset"), os.fdopen(fd, "w") as f:
+                    count = write_changeset(tmpdir, job["changed-refs"], f)
+                logging.info(f"Changeset: {count} files")
                 command += ["--changeset", tmpfile_changeset]
 
             logging.info("Executing command: %s", command)
-            result = subprocess.run(command, env={**os.environ, **job["env"], **{"PYTHONPATH":os.environ.get("PYTHONPATH", "")}}, capture_output=True)
-
-            # Get response and log it!
-
-            if result.returncode == ExecStatus.OK.value:
+            spill_path = None
+            if args.output_spill_dir:
+                os.makedirs(args.output_spill_dir, exist_ok=True)
+                spill_path = f"{args.output_spill_dir}/{job["otel"]["trace-id"]}.log"
+
+            env = {**os.environ, **job["env"], **{"PYTHONPATH":os.environ.get("PYTHONPATH", "")}}
+            proc = run_build(command, env, build_cwd, lambda severity, text: logger(job["otel"]["root-span-id"], severity, text), args.max_job_output, spill_path)
+            returncode = proc.returncode
+            if proc.rusage:
+                usage = bass.core.rusage_attributes(proc.rusage)
+                logging.info(f"Build resource usage: {usage}")
+                if on_usage:
+                    on_usage(usage)
+
+            if returncode == ExecStatus.OK.value:
                 logging.info("Build finished successfully")
-
-                if len(result.stderr) > 0:
-                    logger(job["otel"]["root-span-id"], "INFO", result.stderr.decode())
-
-                if len(result.stdout) > 0:
-                    logger(job["otel"]["root-span-id"], "INFO", result.stdout.decode())
-
                 logger(job["otel"]["root-span-id"], "INFO", "Build finished successfully")
                 status = ExecStatus.OK
             else:
-                logging.error(f"Build finished with error code: {result.returncode}")
-
-                if len(result.stderr) > 0:
-                    logger(job["otel"]["root-span-id"], "ERROR", result.stderr.decode())
-
-                if len(result.stdout) > 0:
-                    logger(job["otel"]["root-span-id"], "ERROR", result.stdout.decode())
-
-                logger(job["otel"]["root-span-id"], "ERROR", f"Build finished with error code: {result.returncode}")
+                logging.error(f"Build finished with error code: {returncode}")
+                logger(job["otel"]["root-span-id"], "ERROR", f"Build finished with error code: {returncode}")
                 status = ExecStatus.ERROR
 
-            # Add behind print level / verbose setting?
-            # logging.info(f"stdout: {result.stdout.decode()}")
-            # logging.info(f"stderr: {result.stderr.decode()}")
-
             # Notifications
             if "notifications" in job["pipeline"]:
                 # TODO: establish all variables that shall be supported
@@ -181,11 +309,17 @@ def process(job: dict, args) -> ExecStatus:
     return status
 
 
-def check_for_job(args, api_key: str, tags: list):
-    (status, body) = bass.request("POST", args.dequeue_endpoint, {"tags": tags}, headers={"X-API-KEY": api_key})
+def check_for_job(args, api_key: str, tags: list) -> tuple[int, None|dict]:
+    """Asks the orchestrator for a job, letting it hold the request up to --dequeue-wait seconds. Returns (status, job)"""
+    url = args.dequeue_endpoint
+    if args.dequeue_wait > 0:
+        url += ("&" if "?" in url else "?") + f"wait={args.dequeue_wait}"
+
+    # Allow for the orchestrator holding the request
+    (status, body) = bass.request("POST", url, {"tags": tags}, headers={"X-API-KEY": api_key, "X-Worker-Id": args.worker_id}, timeout=args.dequeue_wait + 30)
 
     if status == 200:
-        return json.loads(body)
+        return (status, json.loads(body))
     
     if status == 204:
         logging.debug("No job")
@@ -196,38 +330,238 @@ def check_for_job(args, api_key: str, tags: list):
     if status == 0:
         logging.error("Error checking for job (network error?)")
 
-    return None
-
-
-def main(args, api_key):
-    logging.info(f"Dequeue endpoint: {args.dequeue_endpoint}")
-    logging.info(f"Workspace root: {args.workspace_root}")
-
+    return (status, None)
+
+def report_completion(args, api_key: str, job: dict, status: ExecStatus, attempts: int = 8, timeout: float = 30.0):
+    """Lets the orchestrator know the job is processed, so it is not replayed upon orchestrator restart, and its
+    pipeline's concurrency is released. Retried with backoff while the orchestrator is unreachable, slow or failing"""
+    if "id" not in job:
+        return
+
+    complete_endpoint = args.dequeue_endpoint.rsplit("/", 1)[0] + "/complete"
+    for attempt in range(1, attempts + 1):
+        (code, msg) = bass.request("POST", complete_endpoint, {"id": job["id"], "status": status.name}, headers={"X-API-KEY": api_key}, timeout=timeout)
+        if code == 204:
+            return
+        if code != 0 and code < 500:
+            break
+        if attempt < attempts:
+            logging.warning(f"Could not report job completion: {code}, {msg}. Retrying")
+            time.sleep(backoff_delay(attempt))
+    logging.error(f"Could not report job completion: {code}, {msg}")
+
+def backoff_delay(failures: int, base: float = 1.0, max_delay: float = 60.0) -> float:
+    """Exponential backoff with jitter, for the n'th consecutive failure"""
+    return min(max_delay, base * 2 ** (failures - 1)) * random.uniform(0.5, 1.0)
+
+def test_report_completion_retries(monkeypatch):
+    responses = [(0, "Connection refused"), (503, ""), (204, "")]
+    requests = []
+    def fake_request(method, url, payload, headers, timeout):
+        assert timeout is not None
+        requests.append((url, payload))
+        return responses.pop(0)
+    monkeypatch.setattr(bass, "request", fake_request)
+    monkeypatch.setattr(sys.modules[__name__], "backoff_delay", lambda failures: 0)
+
+    args = argparse.Namespace(dequeue_endpoint="http://orchestrator/dequeue")
+    report_completion(args, "", {"id": "1"}, ExecStatus.OK)
+    assert requests == [("http://orchestrator/complete", {"id": "1", "status": "OK"})] * 3
+
+    # Not retrying what would fail again
+    responses[:] = [(403, "")]
+    report_completion(args, "", {"id": "1"}, ExecStatus.OK)
+    assert len(requests) == 4
+
+def test_mirror_and_worktrees_follow_the_repository(tmp_path):
+    repository = tmp_path / "repository"
+    def commit(name: str):
+        (repository / name).write_text(name)
+        git("add", name, cwd=repository)
+        git("-c", "user.name=test", "-c", "user.email=test@localhost", "commit", "-qm", name, cwd=repository)
+
+    repository.mkdir()
+    git("init", "-q", "-b", "main", cwd=repository)
+    commit("a")
+
+    args = argparse.Namespace(git_filter="blob:none", git_depth=None)
+    mirror_dir = str(tmp_path / "mirrors" / "repository.git")
+    sync_mirror(f"file://{repository}", mirror_dir, args)
+    checkout_worktree(mirror_dir, str(tmp_path / "ws1"), "main")
+    assert os.path.exists(tmp_path / "ws1" / "a")
+
+    commit("b")
+    (tmp_path / "ws1" / "untracked").write_text("")
+    sync_mirror(f"file://{repository}", mirror_dir, args)
+    checkout_worktree(mirror_dir, str(tmp_path / "ws1"), "main")
+    checkout_worktree(mirror_dir, str(tmp_path / "ws2"), "main")
+    for ws in ("ws1", "ws2"):
+        assert sorted(os.listdir(tmp_path / ws)) == [".git", "a", "b"]
+
+def test_checkout_worktree_holds_the_mirror_lock(tmp_path, monkeypatch):
+    mirror_dir = str(tmp_path / "mirror.git")
+    workspace = tmp_path / "ws"
+    workspace.mkdir()
+    (workspace / ".git").write_text("gitdir: ...")
+    locked = []
+    monkeypatch.setattr(sys.modules[__name__], "git", lambda *args, cwd: locked.append((args[0], mirror_lock(mirror_dir).locked())))
+    checkout_worktree(mirror_dir, str(workspace), "main")
+    assert locked == [("checkout", True), ("clean", False)]
+
+def test_write_changeset_resolves_all_refs_at_once(tmp_path):
+    git("init", "-q", "-b", "main", cwd=tmp_path)
+    refs = []
+    for names in (["a", "b"], ["b", "c"], ["d"]):
+        for name in names:
+            (tmp_path / name).write_text(str(len(refs)))
+        git("add", *names, cwd=tmp_path)
+        git("-c", "user.name=test", "-c", "user.email=test@localhost", "commit", "-qm", "x", cwd=tmp_path)
+        refs.append(git("rev-parse", "HEAD", cwd=tmp_path).strip())
+
+    with open(tmp_path / "changeset", "w") as f:
+        assert write_changeset(str(tmp_path), refs[1:], f) == 3
+    assert sorted((tmp_path / "changeset").read_text().splitlines()) == ["b", "c", "d"]
+
+def test_backoff_delay():
+    assert 0.5 <= backoff_delay(1) <= 1
+    assert 4 <= backoff_delay(4) <= 8
+    assert backoff_delay(20) <= 60
+
+
+def run_job(args, api_key: str, job: dict, slot: int):
+    time_start = bass.utcnow()
+    usage = {}
+    status = process(job, args, slot, usage.update)
+    time_finished = bass.utcnow()
+    report_completion(args, api_key, job, status)
+
+    otel_status = exec_status_to_otel[status.value]
+
+    # Finally send root span. Through the exporter, so it is spooled rather than lost if the collector is down
+    spanner = create_span_sender(job["otel"]["traces-endpoint"], job["otel"]["service-name"], job["otel"]["trace-id"])
+    spanner(f"Build: {job["name"]} - {status.name}", None, job["otel"]["root-span-id"], time_start, time_finished, otel_status, usage)
+
+def run_worker(args, api_key: str, stopping: threading.Event):
+    """Processes up to --concurrency jobs at once, each in a slot of its own. Only asks for a job while a slot is
+    free. Once stopping is set, no more jobs are requested, and the jobs in progress are waited for"""
     tags = args.tags.split(",")
+    free_slots: queue.Queue[int] = queue.Queue()
+    for slot in range(args.concurrency):
+        free_slots.put(slot)
+    jobs_in_progress: list[threading.Thread] = []
 
-    # Check for new job from orch
-    while True:
+    def run_in_slot(job: dict, slot: int):
         try:
-            job = check_for_job(args, api_key, tags)
-            if not job:
-                time.sleep(1)
-                continue
+            run_job(args, api_key, job, slot)
+        except Exception as e:
+            logging.exception("Exception: %s", e)
+        finally:
+            free_slots.put(slot)
 
-            time_start = bass.utcnow()
-            status = process(job, args)
-            time_finished = bass.utcnow()
+    # Check for new job from orch
+    failures = 0
+    while not stopping.is_set():
+        try:
+            slot = free_slots.get(timeout=1)
+        except queue.Empty:
+            continue
 
-            otel_status = exec_status_to_otel[status.value]
+        job = None
+        try:
+            time_poll = time.monotonic()
+            (status, job) = check_for_job(args, api_key, tags)
+            if status not in (200, 204):
+                failures += 1
+                stopping.wait(backoff_delay(failures))
+                continue
+            failures = 0
 
-            # Finally send root span
-            root_span = bass.generate_span(job["otel"]["trace-id"], None, job["otel"]["root-span-id"], job["otel"]["service-name"], f"Build: {job["name"]} - {status.name}", time_start, time_finished, otel_status)
-            (code, msg) = bass.request("POST", job["otel"]["traces-endpoint"], root_span, {"Content-Type": "application/json"})
-            if code != 200:
-                logging.error(f"Could not post root span: {code}, {msg}")
+            if not job:
+                # Orchestrator did not hold the request (e.g. not supporting long-polling): don't poll more than once a second
+                stopping.wait(max(0.0, 1 - (time.monotonic() - time_poll)))
+                continue
 
+            logging.info(f"Starting job in slot {slot}")
+            thread = threading.Thread(target=run_in_slot, args=(job, slot), name=f"bass-worker-slot-{slot}", daemon=True)
+            thread.start()
+            jobs_in_progress = [t for t in jobs_in_progress if t.is_alive()] + [thread]
         except Exception as e:
             logging.exception("Exception: %s", e)
-            time.sleep(1)
+            failures += 1
+            stopping.wait(backoff_delay(failures))
+        finally:
+            if not job:
+                free_slots.put(slot)
+
+    logging.info(f"Stopping: waiting for {sum(t.is_alive() for t in jobs_in_progress)} job(s) in progress")
+    for thread in jobs_in_progress:
+        thread.join()
+
+def test_worker_runs_jobs_concurrently_and_drains_on_stop(monkeypatch):
+    jobs = [{"name": str(i)} for i in range(6)]
+    stopping = threading.Event()
+    lock = threading.Lock()
+    running = 0
+    max_running = 0
+    finished = []
+
+    def fake_check_for_job(args, api_key, tags):
+        with lock:
+            if not jobs:
+                stopping.set()
+                return (204, None)
+            return (200, jobs.pop(0))
+
+    def fake_run_job(args, api_key, job, slot):
+        nonlocal running, max_running
+        with lock:
+            running += 1
+            max_running = max(max_running, running)
+        time.sleep(0.1)
+        with lock:
+            running -= 1
+            finished.append(job["name"])
+
+    monkeypatch.setattr(sys.modules[__name__], "check_for_job", fake_check_for_job)
+    monkeypatch.setattr(sys.modules[__name__], "run_job", fake_run_job)
+    run_worker(argparse.Namespace(tags="", concurrency=3), "", stopping)
+    assert max_running == 3
+    assert sorted(finished) == [str(i) for i in range(6)]
+
+def main(args, api_key):
+    logging.info(f"Dequeue endpoint: {args.dequeue_endpoint}")
+    logging.info(f"Workspace root: {args.workspace_root}")
+    logging.info(f"Concurrency: {args.concurrency}")
+
+    # Builds spool their telemetry in the same place, which this worker replays once the collector is back
+    spool_dir = args.telemetry_spool or f"{args.workspace_root}/spool"
+    logging.info(f"Telemetry spool: {spool_dir}")
+    bass.set_telemetry_spool(spool_dir, args.telemetry_spool_max_size, poll_interval=30)
+    os.environ["BASS_TELEMETRY_SPOOL"] = spool_dir
+    os.environ["BASS_TELEMETRY_SPOOL_MAX_SIZE"] = str(args.telemetry_spool_max_size)
+    bass.get_exporter().encoder = create_encoder(args.telemetry_encoding)
+    os.environ["BASS_TELEMETRY_ENCODING"] = args.telemetry_encoding
+
+    # The cpu and memory budgets of a build are its own. Builds running at once get a share each, not to oversubscribe the machine
+    if args.concurrency > 1:
+        os.environ.setdefault("BASS_CPU_BUDGET", str(bass.core.detect_cpus() / args.concurrency))
+        mem = bass.core.detect_available_memory()
+        if mem:
+            os.environ.setdefault("BASS_MEM_BUDGET", str(mem // args.concurrency))
+        logging.info(f"Resource budget pr build: {os.environ['BASS_CPU_BUDGET']} cpus, {os.environ.get('BASS_MEM_BUDGET', 'all')} bytes memory")
+
+    stopping = threading.Event()
+    def on_signal(signum, frame):
+        if stopping.is_set():
+            logging.warning("Stopping without waiting for jobs in progress, terminating them")
+            terminate_builds()
+            exit(1)
+        logging.info("Stopping once jobs in progress are finished. Signal again to stop right away")
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    run_worker(args, api_key, stopping)
 
 
 def worker_argparse():
@@ -239,14 +573,23 @@ def worker_argparse():
         )
     
     parser.add_argument("-d", "--dequeue-endpoint", type=str, action="store", default="http://localhost:8080/dequeue", help="URL to bass orchestrator dequeue endpoint")
+    parser.add_argument("--dequeue-wait", type=float, action="store", default=20.0, help="Seconds the orchestrator may hold each dequeue request waiting for a job. 0 to poll every second")
     parser.add_argument("-t", "--tags", type=str, action="store", default="", help="Comma-separated list of tags identifying this worker")
     parser.add_argument("-w", "--workspace-root", type=str, action="store", default=tempfile.gettempdir(), help="Root folder under which data required for pipeline processing will be stored")
+    parser.add_argument("--worker-id", type=str, action="store", default=f"{socket.gethostname()}-{os.getpid()}", help="Identifies the worker to the orchestrator, e.g. in its metrics")
+    parser.add_argument("-c", "--concurrency", type=int, action="store", default=1, help="Number of jobs to process at once, each in a workspace of its own")
+    parser.add_argument("--git-filter", type=str, action="store", default=None, help="Partial clone filter for repository mirrors, e.g. 'blob:none' to fetch file contents on demand")
+    parser.add_argument("--git-depth", type=int, action="store", default=None, help="Create shallow repository mirrors, fetching only this many commits pr ref")
+    parser.add_argument("--max-job-output", type=int, action="store", default=256 * 1024 * 1024, help="Max bytes of job output to log pr job")
+    parser.add_argument("--output-spill-dir", type=str, action="store", default=None, help="Folder to write job output exceeding --max-job-output to. Discarded if not set")
+    parser.add_argument("--telemetry-encoding", choices=["json", "protobuf"], default="json", help="Encoding of telemetry payloads posted to the otel collector, by the worker and the builds it runs")
+    parser.add_argument("--telemetry-spool", type=str, action="store", default=None, help="Folder to spool telemetry to while the otel collector is unavailable. Default: <workspace-root>/spool")
+    parser.add_argument("--telemetry-spool-max-size", type=parse_size, action="store", default=parse_size("256M"), help="Size (e.g. 256M) of the telemetry spool, beyond which telemetry is dropped")
     # --clean ? To nuke any temp-pipelines
     
     return parser.parse_args()
 
 if __name__ == "__main__":
-    signal.signal(signal.SIGTERM, lambda: exit(1))
     args = worker_argparse()
     api_key = os.environ.get("BASS_API_KEY")
     if not api_key: